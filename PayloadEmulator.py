@@ -0,0 +1,642 @@
+#RFD900 Payload Emulator
+#...Plays the payload end of the link on a pseudo-terminal so the ground station can be run without the radios or the Pi
+#...Answers every command RFD900_PC_REFACTORED.py sends ('1'-'7', 'T', 'G', 'V', 'W', ping 'P'/'D', the sync handshake, 'Y'/'N')
+#...in the original base64 word framing, binary frames or windowed transfers, and can throttle, corrupt, drop and delay the bytes
+
+#Usage (Python 2 like the ground station, Linux/macOS, ptys only):
+#   python PayloadEmulator.py --baud 38400 --ber 1e-5 --latency 0.2
+#   python RFD900_PC_REFACTORED.py /dev/pts/5            the port the emulator prints
+#Options:
+#   --framing b64|framed    how '1' and '3' are answered, b64 is the original payload
+#   --caps TEXT             capability report for 'V', "" makes it an original payload that ignores 'V' and 'W'
+#   --baud N                bytes leave at N/10 per second, 0 for no limit
+#   --ber P                 probability each bit the payload sends is flipped
+#   --drop P                probability each byte the payload sends is lost
+#   --latency S             one way delay in seconds
+#   --uplink                corrupt and drop the ground station's bytes as well
+#   --images DIR            serve these files instead of generated test images
+#   --gps-text              send the location as text like older payloads
+
+import Queue
+import argparse
+import base64
+import datetime
+import hashlib
+import math
+import os
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+import zlib
+from io import BytesIO
+from RFD900_Protocol import *
+
+try:
+    import PIL.Image
+    import PIL.ImageChops
+    import PIL.features
+except ImportError:
+    PIL = None                                                      #No re-encoding, "codecs" is left out of the capabilities
+
+WORD_LENGTH = 3000                      #Must match wordlength in the ground station
+NAME_LENGTH = 15                        #Legacy file names are sent as exactly 15 characters, e.g. image00001b.png
+REPLY_TIMEOUT = 10.0                    #Seconds to wait for the ground station before giving up on a transfer
+RESEND_INTERVAL = 3.0                   #Seconds without a status before the oldest unacknowledged frame is sent again
+SYNC_SETTLE = 0.5                       #The ground station flushes its input right after 'S', a resend that beats the flush is lost
+DEFAULT_CAPS = "chunk=256-8192,fec=32,req=1,telem=1,ver=2,win=16"
+MAX_LAYERS = 5                          #Deepest residual pyramid offered, 640x480 -> 40x30 thumbnail
+CODEC_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}      #Request codec -> PIL format
+DEFAULT_SETTINGS = [650, 450, 0, 50, 0, 0, 100]
+
+# ----- SIMULATED RADIO LINK ----- #
+
+#Everything the payload sends goes through a queue that releases it after the latency, at the throttled rate and
+#with bit errors and drops applied, the way the modems would deliver it. Errors are placed a geometric gap apart
+#so a clean stretch of a long transfer costs nothing to impair.
+
+def gap(rate):                                                      #Bits (or bytes) until the next error
+    if (rate <= 0):
+        return sys.maxsize
+    return int(math.log(1.0 - random.random()) / math.log(1.0 - min(rate, 0.999999)))
+
+class Impairment:
+    def __init__(self, ber, drop):
+        self.ber = ber
+        self.drop = drop
+        self.flip = gap(ber)                                        #Bit position of the next flip, carried over from one write to the next
+        self.skip = gap(drop)                                       #Byte position of the next drop
+
+    def apply(self, data):
+        data = bytearray(data)
+        bits = len(data) * 8
+        while (self.flip < bits):
+            data[self.flip // 8] ^= 1 << (self.flip % 8)
+            self.flip += 1 + gap(self.ber)
+        self.flip -= bits
+        if (self.skip < len(data)):
+            kept = bytearray()
+            start = 0
+            while (self.skip < len(data)):
+                kept += data[start:self.skip]
+                start = self.skip + 1
+                self.skip = start + gap(self.drop)
+            kept += data[start:]
+            self.skip -= len(data)
+            data = kept
+        else:
+            self.skip -= len(data)
+        return bytes(data)
+
+class Radio:                                                        #Looks like a pyserial port to the payload code, wrap it in SerialReader
+    def __init__(self, fd, options):
+        self.fd = fd
+        self.timeout = 3
+        self.latency = options.latency
+        self.rate = options.baud / 10.0                             #8N1, ten bits on the wire per byte
+        self.down = Impairment(options.ber, options.drop)
+        self.up = None
+        if options.uplink:
+            self.up = Impairment(options.ber, options.drop)
+        self.outgoing = Queue.Queue()
+        self.delayed = Queue.Queue()                                #Ground station bytes waiting out the latency
+        self.incoming = bytearray()
+        self.arrived = threading.Condition()
+        for target in (self.transmit, self.receive, self.deliver):
+            thread = threading.Thread(target = target)
+            thread.daemon = True
+            thread.start()
+
+    def transmit(self):
+        free = time.time()                                          #When the simulated modem finishes what it is already sending
+        while True:
+            due, data = self.outgoing.get()
+            delay = due - time.time()
+            if (delay > 0):
+                time.sleep(delay)
+            data = self.down.apply(data)
+            piece = len(data)
+            if (self.rate > 0):
+                piece = max(1, int(self.rate / 50))                 #20 ms worth at a time so the ground station sees a steady stream
+            for start in range(0, len(data), piece):
+                os.write(self.fd, data[start:start + piece])
+                if (self.rate > 0):
+                    free = max(free, time.time()) + (min(piece, len(data) - start) / self.rate)
+                    delay = free - time.time()
+                    if (delay > 0):
+                        time.sleep(delay)
+
+    def receive(self):
+        while True:
+            select.select([self.fd], [], [])
+            self.delayed.put((time.time() + self.latency, os.read(self.fd, 4096)))
+
+    def deliver(self):
+        while True:
+            due, data = self.delayed.get()
+            delay = due - time.time()
+            if (delay > 0):
+                time.sleep(delay)
+            if (self.up is not None):
+                data = self.up.apply(data)
+            with self.arrived:
+                self.incoming += data
+                self.arrived.notify()
+
+    def read(self, size = 1):
+        deadline = time.time() + self.timeout
+        with self.arrived:
+            while (len(self.incoming) == 0):
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    return b""
+                self.arrived.wait(remaining)
+            data = bytes(self.incoming[:size])
+            del self.incoming[:size]
+        return data
+
+    def inWaiting(self):
+        with self.arrived:
+            return len(self.incoming)
+
+    def write(self, data):
+        self.outgoing.put((time.time() + self.latency, data))
+        return len(data)
+
+    def flushInput(self):
+        with self.arrived:
+            del self.incoming[:]
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        pass
+
+# ----- SIMULATED PAYLOAD DATA ----- #
+
+def make_png(width, height, seed):                                  #Test card without needing PIL, compresses about as well as a photo of the sky
+    rows = []
+    noise = random.Random(seed)
+    for y in range(height):
+        row = bytearray(b"\x00")
+        for x in range(width):
+            row += struct.pack("BBB", (x * 255 // width) ^ (seed * 40 & 255), (y * 255 // height), ((x // 16 + y // 16) % 2) * 200 + noise.randint(0, 55))
+        rows.append(bytes(row))
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(b"".join(rows), 9)) + chunk(b"IEND", b"")
+
+def load_images(directory):                                         #[(name, data)] oldest first, the last one is the "most recent"
+    images = []
+    if (directory is None):
+        for number in range(1, 4):
+            images.append(("image%05da.png" % number, make_png(640, 480, number)))  #'a' high resolution
+            images.append(("image%05db.png" % number, make_png(160, 120, number)))  #'b' low resolution, the ground station checks name[10]
+        return images
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    for path in sorted([path for path in paths if os.path.isfile(path)], key = os.path.getmtime):
+        with open(path, "rb") as image:
+            images.append((os.path.basename(path), image.read()))
+    return images
+
+class Flight:                                                       #Balloon track, 5 m/s up to 30 km then 10 m/s down, drifting east
+    def __init__(self, text):
+        self.start = time.time()
+        self.text = text
+
+    def position(self):
+        elapsed = time.time() - self.start
+        alt = 5.0 * elapsed
+        if (alt > 30000.0):
+            alt = max(0.0, 30000.0 - 10.0 * (elapsed - 6000.0))
+        return (30.4133 + 0.00001 * elapsed, -91.1800 + 0.00005 * elapsed, alt)
+
+    def slot(self):                                                 #The 35 byte GPS slot
+        lat, lon, alt = self.position()
+        if self.text:
+            return format_gps_text(lat, lon, alt)
+        return pack_gps(time.time(), lat, lon, alt, GPS_FIX_3D, 9)
+
+# ----- PAYLOAD PROTOCOL ----- #
+
+class Payload:
+    def __init__(self, ser, options):
+        self.ser = ser
+        self.framing = options.framing
+        self.caps = decode_params(options.caps)
+        if ((len(self.caps) > 0) and (PIL is not None)):
+            codecs = [codec for codec in ("jpeg", "png", "webp") if ((codec != "webp") or PIL.features.check("webp"))]
+            self.caps["codecs"] = "/".join(codecs)
+            self.caps["tiles"] = 1
+            self.caps["layers"] = MAX_LAYERS
+        self.encoded = {}                                           #(name, codec, quality, tile) -> (bytes, box, full size), so a resumed transfer gets the same file
+        self.wordlength = options.wordlength
+        self.mux = ChannelMux(ser, options.baud / 10.0)              #Windowed transfers go through it, everything else writes to ser directly
+        self.images = load_images(options.images)
+        self.flight = Flight(options.gps_text)
+        self.settings = list(DEFAULT_SETTINGS)
+        self.started = time.time()
+        self.request = None                                         #(request ID, command) while serving a command that came as a frame
+        self.commands = {"1": self.most_recent, "2": self.image_list, "3": self.specific_image, "4": self.send_settings,
+                         "5": self.receive_settings, "6": self.ping, "7": self.runtime_data, "T": self.time_sync, "G": self.gps,
+                         "V": self.capabilities, "W": self.windowed}
+
+    def run(self):
+        while True:
+            command = self.ser.read()
+            if ((command == FRAME_MAGIC[:1]) and self.caps.get("req")):
+                command = self.command_frame()
+            if (command in self.commands):
+                print("command " + command)
+                self.commands[command]()                            #Anything else ('S', 'Y', 'N', 'P', 'D' outside their exchange) is a leftover and ignored
+            self.request = None
+
+    def command_frame(self):                                        #The command byte of a "cmd=" frame, whose request ID goes back in the acknowledge
+        self.ser.unread(FRAME_MAGIC[:1])
+        frame = self.next_frame(1.0)
+        if ((frame is None) or ((frame[0] & FRAME_CTRL) == 0)):
+            return ""
+        command = decode_params(frame[3]).get("cmd", "")
+        self.request = (frame[1], command)
+        return command
+
+    def acknowledge(self):
+        if (self.request is None):
+            self.ser.write("A")
+        else:
+            self.ser.write(pack_acknowledge(*self.request))
+
+    def find_image(self, name):
+        if (name == ""):
+            return self.images[-1]
+        for image in self.images:
+            if (image[0][:NAME_LENGTH] == name[:NAME_LENGTH]):
+                return image
+        return None
+
+    def encode(self, name, data, codec, quality, tile = None):      #The image (or one grid cell of it, tile is (col, row, grid)) re-encoded for the downlink
+        key = (name, codec, quality, tile)
+        if (key not in self.encoded):
+            image = PIL.Image.open(BytesIO(data)).convert("RGB")
+            box = (0, 0) + image.size
+            if (tile is not None):
+                col, row, grid = tile
+                width, height = image.size
+                box = (col * width // grid, row * height // grid, (col + 1) * width // grid, (row + 1) * height // grid)
+                image = image.crop(box)
+            output = BytesIO()
+            image.save(output, CODEC_FORMATS[codec], quality = quality, optimize = True)
+            self.encoded[key] = (output.getvalue(), box, (width, height) if tile else image.size)
+        return self.encoded[key]
+
+    def layer(self, name, data, level, count):                      #One layer of the image's residual pyramid, see LAYERED IMAGES in RFD900_Protocol
+        key = (name, "layer", level, count)
+        if (key not in self.encoded):
+            image = PIL.Image.open(BytesIO(data)).convert("RGB")
+            target = image
+            if (level < count - 1):
+                target = image.resize(layer_size(image.size, level, count), PIL.Image.ANTIALIAS)
+            if (level > 0):                                         #The ground station holds layer level - 1 exactly, only the difference is sent
+                previous = image.resize(layer_size(image.size, level - 1, count), PIL.Image.ANTIALIAS)
+                offset = PIL.Image.new("RGB", target.size, (LAYER_OFFSET,) * 3)
+                residual = PIL.ImageChops.subtract_modulo(target, previous.resize(target.size, PIL.Image.NEAREST))
+                target = PIL.ImageChops.add_modulo(residual, offset)
+            output = BytesIO()
+            target.save(output, "PNG", optimize = True)
+            self.encoded[key] = (output.getvalue(), None, image.size)
+        return self.encoded[key]
+
+    def sync(self):                                                 #Payload half of the ground station's sync()
+        self.ser.write("sync")
+        found = self.ser.find("S", REPLY_TIMEOUT)
+        time.sleep(SYNC_SETTLE)
+        return found
+
+    def reply(self, choices):                                       #Next byte from the ground station that is one of choices, "" on timeout
+        deadline = time.time() + REPLY_TIMEOUT
+        while (time.time() < deadline):
+            byte = self.ser.read_exact(1, deadline - time.time())
+            if ((byte != "") and (byte in choices)):
+                return byte
+        return ""
+
+    # ----- Original commands ----- #
+
+    def most_recent(self):
+        self.acknowledge()
+        name, data = self.images[-1]
+        self.ser.write(name.ljust(NAME_LENGTH)[:NAME_LENGTH])
+        self.send_image(data)
+
+    def specific_image(self):
+        self.acknowledge()
+        self.sync()
+        name = self.ser.read_exact(NAME_LENGTH, REPLY_TIMEOUT)
+        image = self.find_image(name)
+        if (image is None):
+            print("no image named " + repr(name))
+            return
+        self.send_image(image[1])
+
+    def send_image(self, data):
+        if (self.framing == "framed"):
+            self.send_frames(data)
+        else:
+            self.send_words(data)
+
+    def send_words(self, data):                                     #hex md5 (32) | GPS slot (35) | wordlength base64 characters, 'Y' for the next word, 'N' to sync and resend
+        text = base64.b64encode(data)
+        position = 0
+        while (position < len(text)):
+            gps = self.flight.slot()
+            word = text[position:position + self.wordlength]
+            self.ser.write(hashlib.md5(gps + word).hexdigest() + gps + word)
+            answer = self.reply("YN")
+            if (answer == "Y"):
+                position += len(word)
+            elif (answer == "N"):
+                self.sync()
+            else:
+                print("no answer to word at " + str(position) + ", giving up")
+                return
+        print("sent " + str(len(data)) + " bytes")                  #The ground station notices the end when no more words come
+
+    def send_frames(self, data):                                    #Stop-and-wait binary frames, 'Y' for the next one, anything else resends
+        seq = 0
+        offset = 0
+        tries = 0
+        while True:
+            body = data[offset:offset + self.wordlength]
+            flags = FRAME_GPS
+            if (offset + len(body) >= len(data)):
+                flags |= FRAME_LAST
+            self.ser.write(pack_frame(seq, self.flight.slot() + body, flags, offset))
+            answer = self.reply("YN")
+            if (answer == "Y"):
+                tries = 0
+                seq += 1
+                offset += len(body)
+                if (flags & FRAME_LAST):
+                    print("sent " + str(len(data)) + " bytes")
+                    return
+            else:
+                tries += 1
+                if (tries > 6):                                     #The ground station stops after five resends
+                    print("no answer to frame " + str(seq) + ", giving up")
+                    return
+
+    def image_list(self):
+        self.acknowledge()
+        for name, data in self.images:
+            self.ser.write("{} {}\n".format(name.ljust(NAME_LENGTH)[:NAME_LENGTH], len(data)))
+
+    def send_settings(self):
+        self.acknowledge()
+        self.ser.write("\n".join(str(value) for value in self.settings) + "\r")
+
+    def receive_settings(self):
+        self.acknowledge()
+        values = []
+        for index in range(len(DEFAULT_SETTINGS)):
+            line = self.ser.read_until("\n", REPLY_TIMEOUT)
+            try:
+                values.append(int(line))
+            except ValueError:
+                print("bad settings line " + repr(line))
+                return
+        self.settings = values
+        print("camera settings " + str(values))
+        self.acknowledge()
+
+    def ping(self):                                                 #Echoes every 'P' until 'D'
+        self.acknowledge()
+        while True:
+            byte = self.reply("PD")
+            if (byte != "P"):
+                return
+            self.ser.write("P")
+
+    def runtime_data(self):
+        self.acknowledge()
+        self.ser.write("uptime {:.0f} s\n".format(time.time() - self.started))
+        self.ser.write("images {}\n".format(len(self.images)))
+        self.ser.write("\r")
+
+    def time_sync(self):
+        self.acknowledge()
+        self.ser.write(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S") + "\n")
+
+    def gps(self):
+        self.acknowledge()
+        self.ser.write(self.flight.slot())
+
+    # ----- Upgraded commands ----- #
+
+    def capabilities(self):
+        if (len(self.caps) == 0):
+            return                                                  #An original payload never answers 'V'
+        self.acknowledge()
+        self.ser.write(pack_frame(0, encode_params(self.caps), FRAME_CTRL))
+
+    def next_frame(self, timeout):                                  #(flags, seq, offset, body) of the next intact frame, None after timeout
+        deadline = time.time() + timeout
+        while (self.ser.find(FRAME_MAGIC, max(0, deadline - time.time()))):
+            header = FRAME_MAGIC + self.ser.read_exact(FRAME_HEADER.size - len(FRAME_MAGIC))
+            fields = unpack_header(header)
+            if (fields is None):
+                continue
+            body = self.ser.read_exact(fields[3])
+            if (check_frame(header, body, self.ser.read_exact(FRAME_CRC.size))):
+                return (fields[0], fields[1], fields[2], body)
+        return None
+
+    def windowed(self):
+        if (len(self.caps) == 0):
+            return
+        self.acknowledge()
+        frame = self.next_frame(REPLY_TIMEOUT)
+        while ((frame is not None) and (frame[0] & FRAME_CTRL)):
+            request = decode_params(frame[3])
+            if ("name" not in request):
+                frame = self.next_frame(REPLY_TIMEOUT)
+                continue
+            frame = WindowedSender(self, request).run()             #Returns a new request if the ground station asked again
+        print("windowed transfer finished")
+
+class WindowedSender:                                               #Sending end of the selective-repeat transfer in RFD900_Protocol
+    def __init__(self, payload, request):
+        self.payload = payload
+        self.ser = payload.ser
+        self.window = max(1, min(int(request.get("win", 1)), int(payload.caps.get("win", 1))))
+        smallest, largest = payload.caps.get("chunk", "{0}-{0}".format(payload.wordlength)).split("-")
+        self.smallest = int(smallest)
+        self.largest = int(largest)
+        self.chunk = self.clamp(request.get("chunk", payload.wordlength))
+        self.fec = 0
+        if ("fec" in request):
+            self.fec = min(int(request["fec"]), int(payload.caps.get("fec", 0)))
+        self.telemetry = None                                       #Seconds between telemetry frames, None puts GPS in every image frame instead
+        if (request.get("telem") and payload.caps.get("telem")):
+            self.telemetry = max(float(request["telem"]), 0.1)
+        image = payload.find_image(request["name"])
+        self.name = ""
+        self.data = b""
+        self.header = {}
+        if (image is not None):
+            self.name, self.data = image
+            codec = request.get("codec")
+            quality = min(max(int(request.get("quality", 75)), 1), 100)
+            if (request.get("tile") and payload.caps.get("tiles")):
+                tile = tuple(int(value) for value in request["tile"].split(":"))
+                if (codec not in payload.caps["codecs"].split("/")):
+                    codec = "png"                                   #A crop has to be encoded in something, lossless unless asked otherwise
+                original = len(self.data)
+                self.data, box, full = payload.encode(self.name, self.data, codec, quality, tile)
+                area = float((box[2] - box[0]) * (box[3] - box[1])) / (full[0] * full[1])
+                self.header = {"codec": codec, "quality": quality, "original": int(original * area), "tile": request["tile"],
+                               "box": ":".join(str(value) for value in box), "full": "{}:{}".format(*full)}
+            elif ((request.get("layer") is not None) and payload.caps.get("layers")):
+                count = min(max(int(request.get("layers", MAX_LAYERS)), 1), MAX_LAYERS)
+                level = min(max(int(request["layer"]), 0), count - 1)
+                original = len(self.data)
+                self.data, box, full = payload.layer(self.name, self.data, level, count)
+                self.header = {"layer": level, "layers": count, "full": "{}:{}".format(*full), "original": original}
+            elif (codec in payload.caps.get("codecs", "").split("/")):
+                self.header = {"codec": codec, "quality": quality, "original": len(self.data)}
+                self.data = payload.encode(self.name, self.data, codec, quality)[0]
+        self.plan = [(0, len(self.data))]                           #Byte ranges still to be cut into frames
+        if request.get("ranges"):
+            ranges = [[int(value) for value in item.split("-")] for item in request["ranges"].split(";")]
+            self.plan = [(start, min(end, len(self.data))) for start, end in ranges if start < min(end, len(self.data))]
+            if (len(self.plan) == 0):
+                self.plan = [(len(self.data), len(self.data))]      #Nothing inside the image, a lone empty last frame ends the transfer
+        self.frames = []
+        self.next = 0                                               #First sequence number not sent yet
+        self.base = None                                            #Base of the last status, to spot a receiver that has stalled
+
+    def clamp(self, size):
+        return min(max(int(size), self.smallest), self.largest)
+
+    def frame(self, seq):                                           #Frames are cut as they are first sent so a chunk size change applies to everything still unsent
+        while ((len(self.frames) <= seq) and self.plan):
+            start, end = self.plan[0]
+            stop = min(start + self.chunk, end)
+            self.plan[0] = (stop, end)
+            if (stop >= end):
+                self.plan.pop(0)
+            flags = 0
+            body = self.data[start:stop]
+            if (self.telemetry is None):
+                flags = FRAME_GPS
+                body = self.payload.flight.slot() + body
+            if (len(self.plan) == 0):
+                flags |= FRAME_LAST
+            if (self.fec > 0):
+                flags |= FRAME_FEC
+                body = fec_encode(body, self.fec)
+            self.frames.append(pack_frame(len(self.frames), body, flags, start))
+        if (seq < len(self.frames)):
+            return self.frames[seq]
+        return None
+
+    def fill(self, base):
+        while ((self.next < base + self.window) and (self.frame(self.next) is not None)):
+            self.mux.send(CHANNEL_BULK, self.frames[self.next], self.next)
+            self.next += 1
+
+    def resend(self, seq):                                          #Skipped while an earlier copy is queued or may still be on its way, a status can be older than it
+        if self.mux.resendable(seq):
+            self.mux.send(CHANNEL_BULK, self.frames[seq], seq)
+
+    def run(self):                                                  #The telemetry clock only runs for the transfer, the mux is emptied before returning
+        self.mux = self.payload.mux
+        if (self.telemetry is not None):
+            self.mux.telemetry(self.telemetry, lambda: pack_frame(0, self.payload.flight.slot(), FRAME_TELEM))
+        try:
+            return self.serve()
+        finally:
+            self.mux.telemetry(None)
+            self.mux.clear(CHANNEL_BULK)                            #Whatever is still queued belongs to a transfer that has ended
+            self.mux.drain()
+
+    def serve(self):
+        header = {"name": self.name, "size": len(self.data)}
+        header.update(self.header)
+        if (self.fec > 0):
+            header["fec"] = self.fec
+        if (self.telemetry is not None):
+            header["telem"] = self.telemetry
+        self.mux.send(CHANNEL_CONTROL, pack_frame(0, encode_params(header), FRAME_CTRL))
+        self.fill(0)
+        heard = time.time()
+        while True:
+            frame = self.payload.next_frame(RESEND_INTERVAL)
+            if (frame is None):
+                if (time.time() - heard > 3*REPLY_TIMEOUT):
+                    print("ground station went quiet, stopping transfer")
+                    return None
+                oldest = self.base or 0
+                if (oldest < self.next):                            #Our frames or its statuses are being lost, this draws a fresh status
+                    self.resend(oldest)
+                continue
+            heard = time.time()
+            flags, seq, offset, body = frame
+            if (flags & FRAME_CTRL):
+                params = decode_params(body)
+                if ("name" in params):
+                    return frame                                    #Our header was lost and the request repeated
+                if ("abort" in params):
+                    print("transfer aborted")
+                    return None
+                if ("chunk" in params):
+                    self.chunk = self.clamp(params["chunk"])
+                continue
+            if ((flags & FRAME_ACK) == 0):
+                continue
+            base, missing = unpack_ack(body)
+            if (self.frame(base) is None):
+                print("sent {} in {} frames".format(self.name, len(self.frames)))
+                return None
+            for seq in missing:
+                if (seq < self.next):
+                    self.resend(seq)
+            if ((len(missing) == 0) and (base == self.base)):       #Same status twice with nothing missing: the rest of the window was lost
+                for seq in range(base, self.next):
+                    self.resend(seq)
+            self.base = base
+            self.fill(base)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Emulate the payload end of the RFD900 link on a pseudo-terminal")
+    parser.add_argument("--framing", choices = ("b64", "framed"), default = "b64")
+    parser.add_argument("--caps", default = DEFAULT_CAPS)
+    parser.add_argument("--baud", type = int, default = 38400)
+    parser.add_argument("--ber", type = float, default = 0.0)
+    parser.add_argument("--drop", type = float, default = 0.0)
+    parser.add_argument("--latency", type = float, default = 0.0)
+    parser.add_argument("--uplink", action = "store_true")
+    parser.add_argument("--images")
+    parser.add_argument("--gps-text", action = "store_true")
+    parser.add_argument("--wordlength", type = int, default = WORD_LENGTH)
+    parser.add_argument("--seed", type = int)
+    options = parser.parse_args(argv)
+    if (options.seed is not None):
+        random.seed(options.seed)
+
+    master, slave = os.openpty()
+    tty.setraw(slave)                                               #No echo or newline translation, bytes pass through untouched
+    print("Payload emulator on " + os.ttyname(slave))               #The slave stays open here so the pty survives the ground station reconnecting
+    sys.stdout.flush()
+    payload = Payload(SerialReader(Radio(master, options)), options)
+    try:
+        payload.run()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
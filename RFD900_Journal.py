@@ -0,0 +1,131 @@
+#RFD900 Image Journal
+#...Verified chunks go straight into the image file at their offset, and "<image>.journal" next to it records which
+#...byte ranges are in place. Memory use stays flat no matter how big the image is, and a transfer that dies partway
+#...(retries exhausted, link lost, GUI closed) can be resumed by asking only for the missing ranges
+#...Kept free of serial/GUI state so the ground station and the tests can both import it
+
+import os
+import struct
+from RFD900_Protocol import crc32, encode_params
+
+JOURNAL_HEADER = struct.Struct(">4sII")      #magic, total image size (0 when the payload didn't say), identity of the image
+JOURNAL_RECORD = struct.Struct(">IHI")       #offset, length, crc32 of the bytes written there
+JOURNAL_MAGIC = b"RJN3"
+JOURNAL_IDENTITY = ("name", "size", "codec", "quality", "tile", "layer", "layers")   #Transfer header keys that tell one image from another
+COPY_BLOCK = 65536                           #Read size when moving a partial image between sessions
+
+partialJournals = {}                         #Image file name -> journal left behind by an earlier session
+
+def journal_identity(info):                                         #crc32 of what the transfer header says about the image, 0 for transfers without one
+    if (info is None):
+        return 0
+    return crc32(encode_params(dict((key, info[key]) for key in JOURNAL_IDENTITY if key in info)).encode("utf-8"))
+
+def read_journal(path):                                             #Returns (size, identity, {offset: length}) keeping only ranges whose bytes in the image still match their crc
+    ranges = {}
+    with open(path, "rb") as fl:
+        header = fl.read(JOURNAL_HEADER.size)
+        if (len(header) != JOURNAL_HEADER.size):
+            return (0, 0, ranges)
+        magic, size, identity = JOURNAL_HEADER.unpack(header)
+        if (magic != JOURNAL_MAGIC):
+            return (0, 0, ranges)
+        records = []
+        record = fl.read(JOURNAL_RECORD.size)
+        while (len(record) == JOURNAL_RECORD.size):                 #A torn record at the end is just dropped
+            records.append(JOURNAL_RECORD.unpack(record))
+            record = fl.read(JOURNAL_RECORD.size)
+    imagepath = path[:-len(".journal")]
+    if (os.path.exists(imagepath) == False):
+        return (size, identity, ranges)
+    with open(imagepath, "rb") as image:
+        for offset, length, crc in records:
+            image.seek(offset)
+            if (crc32(image.read(length)) == crc):
+                ranges[offset] = length
+    return (size, identity, ranges)
+
+def find_journal(savepath):                                         #This session's journal for the image, or one recovered from an earlier session
+    if os.path.exists(savepath + ".journal"):
+        return savepath + ".journal"
+    return partialJournals.get(os.path.basename(savepath))
+
+def missing_ranges(ranges, size):                                   #Byte ranges [start, end) not yet covered, ranges is {offset: length}
+    missing = []
+    position = 0
+    for offset in sorted(ranges):
+        if (offset > position):
+            missing.append((position, offset))
+        position = max(position, offset + ranges[offset])
+    if (position < size):
+        missing.append((position, size))
+    return missing
+
+class ImageWriter:                                                  #Streams verified chunks to disk as they arrive instead of building the image in memory
+    def __init__(self, savepath, size = 0, identity = 0):
+        self.savepath = savepath
+        self.journalpath = savepath + ".journal"
+        self.size = size
+        self.identity = identity
+        self.ranges = {}
+        self.preview = True                                         #False for files that aren't a picture on their own (residual layers)
+        self.discarded = False                                      #True when a journal under this name belonged to another image
+        old = find_journal(savepath)
+        oldranges = {}
+        if (old is not None):
+            oldsize, oldidentity, oldranges = read_journal(old)
+            if ((size == 0) or (oldsize != size) or (oldidentity != identity)):
+                self.discarded = (len(oldranges) > 0)               #Another image under the same name, or a legacy transfer that can't restart partway: start over
+                oldranges = {}
+        moving = (old is not None) and (os.path.abspath(old) != os.path.abspath(self.journalpath))
+        if ((moving == False) and (len(oldranges) > 0) and os.path.exists(savepath)):
+            self.fl = open(savepath, "r+b")                         #Resuming in this session, the verified bytes are already in place
+        else:
+            self.fl = open(savepath, "w+b")
+        if (self.size > 0):
+            self.fl.truncate(self.size)                             #Preallocate so chunks can land at any offset
+        self.journal = open(self.journalpath, "wb")                 #Rewritten in full so a journal from an older session moves into this one
+        self.journal.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.size, self.identity))
+        if moving:
+            oldpath = old[:-len(".journal")]
+            if os.path.exists(oldpath):
+                with open(oldpath, "rb") as oldimage:
+                    for offset in sorted(oldranges):
+                        oldimage.seek(offset)
+                        for start in range(offset, offset + oldranges[offset], COPY_BLOCK):
+                            self.write(start, oldimage.read(min(COPY_BLOCK, offset + oldranges[offset] - start)))
+                os.remove(oldpath)                                  #Its bytes live in this session now, a leftover sparse file would be cataloged as an image
+            os.remove(old)
+            partialJournals.pop(os.path.basename(savepath), None)
+        else:
+            for offset in sorted(oldranges):
+                self.fl.seek(offset)
+                self.record(offset, self.fl.read(oldranges[offset]))
+        self.fl.flush()
+        self.journal.flush()
+
+    def record(self, offset, data):
+        self.ranges[offset] = len(data)
+        self.journal.write(JOURNAL_RECORD.pack(offset, len(data), crc32(data)))
+
+    def write(self, offset, data, verified = True):                 #Unverified data still lands in the image but is never claimed by the journal
+        if (self.ranges.get(offset) == len(data)):
+            return
+        self.fl.seek(offset)
+        self.fl.write(data)
+        self.fl.flush()                                             #Image bytes reach the file before the journal claims them
+        if verified:
+            self.record(offset, data)
+            self.journal.flush()
+
+    def received(self):
+        return sum(self.ranges.values())
+
+    def missing(self):
+        return missing_ranges(self.ranges, self.size)
+
+    def close(self, complete):                                      #A complete image doesn't need its journal any more, a partial one keeps it for a resume
+        self.fl.close()
+        self.journal.close()
+        if complete:
+            os.remove(self.journalpath)
@@ -19,6 +19,7 @@ import datetime
 import base64
 import hashlib 
 import os
+import glob
 
 import struct #for unpacking data
 
@@ -27,13 +28,101 @@ import traceback #traceback functionality for error handling
 import serial #for communication with RFD900 over USB
 import subprocess
 import sys
+import threading
+import Queue
+import collections
+import sqlite3
+import json
+import bisect
+import socket
+import BaseHTTPServer
 import PIL.Image # = for image processing
+import PIL.ImageChops
+import PIL.ImageFile
 
 from multiprocessing.connection import Client
 
-# ----- INITIALIZE SERVO PROCESS COMMUNICATION ----- #
-
-clientGPS = Client(('localhost',5000))
+from RFD900_Protocol import * #binary framing shared with the payload
+from RFD900_Journal import * #chunk journal, resumable image files
+from RFD900_Tracking import * #track prediction for the antenna between fixes
+import SessionArchive #post-flight search catalog, kept current for the live session
+
+# ----- SERVO PROCESS COMMUNICATION ----- #
+
+#The servo tracker gets the payload position from its own thread. Publishing only replaces the one fix waiting to go out,
+#so a slow or missing servo process can never hold up the serial link, and it only ever receives the newest position
+
+SERVO_ADDRESS = ('localhost',5000)
+SERVO_RETRY_MIN = 1.0                       #Seconds before the first reconnect attempt, doubled after every failure
+SERVO_RETRY_MAX = 30.0
+SERVO_MAX_AGE = 15.0                        #A fix still waiting after this many seconds is dropped rather than sent
+
+class ServoFeed(threading.Thread):
+    def __init__(self, address):
+        threading.Thread.__init__(self, name = "servo feed")
+        self.daemon = True
+        self.address = address
+        self.client = None
+        self.latest = None                                          #(time published, position), replaced by every newer fix
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.halt = threading.Event()                               #Only stop() cuts a backoff short, new fixes don't
+        self.retry = SERVO_RETRY_MIN
+
+    def publish(self, position):                                    #Never blocks, safe from any thread
+        with self.condition:
+            self.latest = (time.time(), position)                   #Any fix still waiting is superseded, not queued behind
+            self.condition.notify()
+
+    def next_fix(self):                                             #Waits for a fix that is still fresh, None once stopped
+        with self.condition:
+            while True:
+                while ((self.latest is None) and (self.stopped == False)):
+                    self.condition.wait()
+                if self.stopped:
+                    return None
+                stamp, position = self.latest
+                self.latest = None
+                if (time.time() - stamp <= SERVO_MAX_AGE):
+                    return (stamp, position)
+
+    def backoff(self):                                              #Sleeps before the next attempt, cut short by stop()
+        self.halt.wait(self.retry)
+        self.retry = min(self.retry * 2, SERVO_RETRY_MAX)
+
+    def run(self):
+        while True:
+            fix = self.next_fix()
+            if (fix is None):
+                break
+            try:
+                if (self.client is None):
+                    self.client = Client(self.address)
+                    print "Connected to servo tracker"
+                    log_event("Connected to servo tracker at {}:{}".format(*self.address))
+                self.client.send(fix[1])
+                self.retry = SERVO_RETRY_MIN
+            except (IOError, OSError, EOFError) as error:           #socket.error is an IOError
+                if (self.retry == SERVO_RETRY_MIN):                 #Only the first failure of an outage is logged
+                    print "Servo tracker unavailable:", error
+                    log_event("ERROR: Servo tracker unavailable, {}, retrying with backoff".format(error))
+                if (self.client is not None):
+                    self.client.close()
+                    self.client = None
+                with self.condition:
+                    if (self.latest is None):
+                        self.latest = fix                           #Try this fix again unless a newer one turns up meanwhile
+                self.backoff()
+        if (self.client is not None):
+            self.client.close()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.halt.set()
+
+servoFeed = ServoFeed(SERVO_ADDRESS)
 
 # ----- SESSION TIME AND DIRECTORY ----- #
 
@@ -48,52 +137,173 @@ if not os.path.exists(sessionDir):
 event_logFileName = "{}Event_Log_File_{}.txt".format(sessionDir,sessionTime)
 runtime_logFileName = "{}Runtime_Log_File_{}.txt".format(sessionDir,sessionTime)
 
-with open(event_logFileName, "w+") as event_logFile:
-    event_logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-    event_logFile.write(" (aka {} UTC Epoch) -- Ground Station Software Starts\r\n".format(time.time()))	
-
-#unbuffered class is used to output console writing to the runtime logging file 
-class Unbuffered:
-    def __init__(self,stream):
+LOG_QUEUE_SIZE = 10000                  #Messages waiting for the writer thread, past this they are counted and dropped instead of stalling the caller
+LOG_BATCH = 500                         #Most messages written in one go
+LOG_SYNC_INTERVAL = 5.0                 #Seconds between fsyncs, so a crash or power cut loses at most this much of the log
+LOG_ROTATE_BYTES = 10 * 1024 * 1024     #A log this big is renamed to _part<n> and a fresh file started under the original name
+RUNLOG_LINES = 500                      #Lines of the runtime log kept in the GUI panel
+
+class SessionLog(threading.Thread):
+    #Owns one session log file. Callers only put messages on a queue, the file is written in batches by this thread,
+    #so logging never costs an open/write/close in the middle of a serial exchange.
+
+    def __init__(self, path, tail = None):
+        threading.Thread.__init__(self, name = "log " + os.path.basename(path))
+        self.daemon = True
+        self.path = path
+        self.tail = tail                                            #Optional LogTail that also gets every batch written
+        self.queue = Queue.Queue(LOG_QUEUE_SIZE)
+        self.dropped = 0
+        self.part = 0
+        self.file = open(path, "w+")
+
+    def put(self, item):                                            #Never blocks, safe from any thread
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+
+    def render(self, item):                                         #Text for one queued message
+        return item
+
+    def note(self, message):                                        #Text for a message from the logger itself
+        return "--- {} ---\r\n".format(message)
+
+    def rotate(self):
+        self.file.close()
+        self.part += 1
+        root, ext = os.path.splitext(self.path)
+        os.rename(self.path, "{}_part{}{}".format(root, self.part, ext))
+        self.file = open(self.path, "w+")
+
+    def run(self):
+        synced = time.time()
+        running = True
+        while running:
+            try:
+                batch = [self.queue.get(timeout = LOG_SYNC_INTERVAL)]
+            except Queue.Empty:
+                batch = []
+            while (len(batch) < LOG_BATCH):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if (None in batch):                                     #stop() was called, write what came before it and finish
+                running = False
+                batch = batch[:batch.index(None)]
+            text = "".join([self.render(item) for item in batch])
+            if (self.dropped > 0):
+                dropped = self.dropped
+                self.dropped -= dropped
+                text += self.note("{} log messages dropped, queue was full".format(dropped))
+            if (text != ""):
+                self.file.write(text)
+                self.file.flush()
+                if (self.tail is not None):
+                    self.tail.feed(text)
+            if ((running == False) or (time.time() - synced >= LOG_SYNC_INTERVAL)):
+                os.fsync(self.file.fileno())
+                synced = time.time()
+            if (self.file.tell() >= LOG_ROTATE_BYTES):
+                self.rotate()
+        self.file.close()
+
+    def stop(self):                                                 #Waits for everything queued so far to reach the disk
+        self.queue.put(None)
+        self.join(10)
+
+class LogTail:
+    #The last lines a log has written, for the GUI to pick up without reading the file back
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.fresh = collections.deque(maxlen = size)               #Lines the GUI hasn't shown yet, oldest dropped if it falls behind
+        self.partial = ""
+
+    def feed(self, text):                                           #Log thread
+        with self.lock:
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()                              #Keep an unfinished line until the rest of it arrives
+            self.fresh.extend([line.rstrip("\r") for line in lines])
+
+    def take(self):                                                 #GUI thread, new lines oldest first
+        with self.lock:
+            lines = list(self.fresh)
+            self.fresh.clear()
+        return lines
+
+class EventLog(SessionLog):
+    #Messages are queued as (epoch, message, detail) and only turned into text on the writer thread
+
+    def render(self, item):
+        stamp, message, detail = item
+        date = datetime.datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S')
+        if (detail is None):
+            return "{} (aka {} UTC Epoch) -- {}\r\n".format(date, stamp, message)
+        return "\r\n--- {} (aka {} UTC Epoch) -- {} ---\r\n\r\n{}".format(date, stamp, message, detail)
+
+    def note(self, message):
+        return self.render((time.time(), "ERROR: " + message, None))
+
+def log_event(message):                                             #Adds one timestamped line to the event log
+    eventLog.put((time.time(), message, None))
+
+def log_critical(section):                                          #Call from an except block, records the exception and its traceback
+    e = sys.exc_info()
+    detail = "{}\r\n{}\r\n{}".format(e[0], e[1], traceback.format_exc(e[2]))
+    eventLog.put((time.time(), "CRITICAL ERROR: {}".format(section), detail))
+
+eventLog = EventLog(event_logFileName)
+eventLog.start()
+log_event("Ground Station Software Starts")
+
+#console class copies console writing to the runtime logging file, the copy is written by the log thread
+class ConsoleLog:
+    def __init__(self,stream,log):
         self.stream = stream
+        self.log = log
     def write(self,data):
         self.stream.write(data)
-        self.stream.flush()
-        runtime_logFile.write(data)
-        runtime_logFile.flush()
+        if ("\n" in data):                                          #Line buffered, the console still shows every finished line right away
+            self.stream.flush()
+        self.log.put(data)
     def flush(self):
         self.stream.flush()
     def close(self):
         self.stream.close()
 
-runtime_logFile = open(runtime_logFileName,'w+')
-sys.stdout = Unbuffered(sys.stdout) #create unbuffered output to runtime log file
+runTail = LogTail(RUNLOG_LINES)
+runtimeLog = SessionLog(runtime_logFileName, runTail)
+runtimeLog.start()
+sys.stdout = ConsoleLog(sys.stdout, runtimeLog) #copy console output to the runtime log file
 
 # ----- MODEM CONNECTION INITIALIZATION ----- #
 
 try:
     #Serial Variables
     port = "COM6"              #This is a computer dependent setting. Open Device Manager to determine which port the RFD900 Modem is plugged into
+    if (len(sys.argv) > 1):
+        port = sys.argv[1]      #e.g. the pseudo-terminal PayloadEmulator.py prints, for testing without the radios
     baud = 38400				#baud rate in bits/s, need to be adjusted to match the modem's baud rate (note: independent of *air* data rate!)
     timeout = 3                 #Sets the ser.read() timeout period, or when to continue in the code when no data is received after the timeout period (in seconds)
 
     #Initializations
-    ser = serial.Serial(port = port, baudrate = baud, timeout = timeout)
+    ser = SerialReader(serial.Serial(port = port, baudrate = baud, timeout = timeout))   #Buffered, reads pull in everything the port holds at once
     wordlength = 3000          #Variable to determine spacing of checksum. Ex. wordlength = 1000 will send one thousand bits before calculating and verifying checksum
     imagedatasize = 10000
     extension = ".png"
+    windowSize = 8              #Frames an upgraded payload may keep in flight before it needs our status (windowed transfers only)
+    chunkSize = wordlength      #Frame body size windowed transfers start with, adapted to the link and remembered between transfers
+    fecParity = 0               #Reed-Solomon parity bytes per 255 byte block asked of upgraded payloads, 0 turns FEC off (set from the GUI per session)
+    telemetryInterval = 2.0     #Seconds between position frames upgraded payloads send alongside image frames (ChannelMux), 0 keeps GPS in every frame
     timeupdateflag = 0          #determines whether to update timevar on the camera settings
 except:
-    with open(event_logFileName, "a") as logFile:
-        logFile.write("\r\n--- ")
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- CRITICAL ERROR: INTIALIZATION ---\r\n\r\n".format(time.time()))
-        e = sys.exc_info()
-        logFile.write("{}\r\n".format(e[0]))
-        logFile.write("{}\r\n".format(e[1]))
-        logFile.write("{}".format(traceback.format_exc(e[2])))
-        print("There was a critical error! Stopping Program, please see \"{}\" for details.".format(event_logFileName))
-        sys.exit()
+    log_critical("INTIALIZATION")
+    print("There was a critical error! Stopping Program, please see \"{}\" for details.".format(event_logFileName))
+    eventLog.stop()                                                 #Writes out the traceback before we exit
+    runtimeLog.stop()
+    sys.exit()
 		
 # ------ CAMERA INITIAL VALUES ----- #
 
@@ -106,10 +316,604 @@ saturation = 0              #Default = 0; range = (-100 to 100)
 iso = 400                   #Unknown Default; range = (100 to 800)
 
 payloadGPS = ""
+payloadCaps = {}            #Filled in by probe_payload(), stays empty for payloads that only know the original commands
 
 pingGPS = -1.0
+gpsTimer = None             #Pending after() id of the next automatic GPS request
+lastTelemetry = 0.0         #When the last position arrived on the telemetry channel, automatic requests are skipped while they flow
 GPSLength = 35
 
+# ------ PROGRESSIVE PREVIEW ----- #
+
+truncatedLock = threading.Lock()            #Held while PIL is allowed to render a cut off file, see partial_image()
+PREVIEW_INTERVAL = 2.0                      #Minimum seconds between preview redraws while an image is arriving
+PREVIEW_SHARE = 10                          #A redraw waits at least this many times as long as the last one took to decode
+
+abortTransfer = False                       #Set by the Abort button, checked by the receive loops
+lastPreview = 0.0
+previewBytes = 0
+previewCost = 0.0
+
+# ------ LINK WORKER ----- #
+
+#Everything that touches ser runs on one background thread, fed by a priority queue, so a multi-minute
+#download never freezes the GUI. The worker never touches Tk directly: it hands GUI work back through
+#gui_call(), which the Tk loop drains every GUI_PUMP_MS (GUI_IDLE_MS while nothing comes back)
+
+PRIORITY_GPS = 0                            #Lower number runs first once the current command finishes
+PRIORITY_CONTROL = 1
+PRIORITY_BULK = 2
+GUI_PUMP_MS = 16                            #~60 fps while the link worker is handing back results
+GUI_IDLE_MS = 100                           #Slower polling once nothing has come back, keeps an idle GUI near zero CPU
+LINK_STOP_TIMEOUT = 15.0                    #Longest wait at close for the command on the link, longer than a command's deadline
+
+guiQueue = Queue.Queue()
+guiThread = threading.current_thread()
+
+def gui_call(function, *args, **kwargs):                            #Runs function on the Tk thread, safe to call from anywhere
+    if (threading.current_thread() is guiThread):
+        function(*args, **kwargs)
+    else:
+        guiQueue.put((function, args, kwargs))
+
+def pump_gui():
+    delay = GUI_IDLE_MS
+    try:
+        while True:
+            function, args, kwargs = guiQueue.get_nowait()
+            delay = GUI_PUMP_MS
+            try:
+                function(*args, **kwargs)
+            except TclError:
+                pass                                                #Widget went away (e.g. subGui closed)
+    except Queue.Empty:
+        pass
+    except Exception:
+        log_critical("GUI update")                                  #One bad update mustn't stop the pump, everything after it would never be shown
+    finally:
+        mainGui.after(delay, pump_gui)
+
+class LinkWorker(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.commands = Queue.PriorityQueue()
+        self.count = 0                                              #Keeps equal priorities in the order they were asked for
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.busy = None                                            #Name of the command on the link right now
+        self.stopping = False                                       #Set by stop(), a transfer that starts after it is aborted at once
+
+    def submit(self, priority, name, function, *args):              #Returns False if the same command is already waiting
+        with self.lock:
+            if (name in self.pending):
+                return False
+            self.pending.add(name)
+            self.count += 1
+            self.commands.put((priority, self.count, name, function, args))
+        return True
+
+    def run(self):
+        while True:
+            priority, count, name, function, args = self.commands.get()
+            if (function is None):
+                return
+            with self.lock:
+                self.pending.discard(name)
+            self.busy = name
+            gui_call(statusVar.set, "Link: " + name)
+            try:
+                function(*args)
+            except:
+                log_critical("LINK WORKER ({})".format(name))
+                print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+            self.busy = None
+            gui_call(statusVar.set, "Link: idle")
+            sys.stdout.flush()
+
+    def stop(self):                                                 #Skips whatever is still queued, join() to wait for the command on the link
+        self.stopping = True
+        self.commands.put((-1, 0, "stop", None, ()))
+
+linkWorker = LinkWorker()
+
+# ------ COMMAND REQUESTS ----- #
+
+#Every command the ground station sends goes through command(): sent, then resent with exponentially growing waits
+#until the payload acknowledges it or the deadline passes (send_command in RFD900_Protocol), so no command handler
+#can spin forever or flood the half-duplex link. Payloads that report "req" get each command with a request ID and
+#echo it in their acknowledge, older ones get the plain byte and answer 'A'.
+
+requestId = int(time.time() * 10) & 0x7fffffff  #Starts from the clock so a late acknowledge from an earlier session never matches
+lastRequest = None                              #ID of the last command, later acknowledges in the same exchange carry it too
+
+def waiting_for_acknowledge(attempt):
+    print "Waiting for Acknowledge"
+    sys.stdout.flush()
+
+def command(code, timeout = COMMAND_DEADLINE):                      #True once the payload acknowledged code, False (logged) when timeout seconds pass first
+    global requestId
+    global lastRequest
+    lastRequest = None
+    if payloadCaps.get("req"):
+        requestId = (requestId + 1) & 0xffffffff
+        lastRequest = requestId
+    try:
+        attempts = send_command(ser, code, lastRequest, timeout, waiting_for_acknowledge)
+    except CommandTimeout:
+        log_event("ERROR: no acknowledge for '{}' in {:.0f} s, connection error".format(code, timeout))
+        print "No Acknowledge Recieved, Connection Error"
+        sys.stdout.flush()
+        return False
+    if (attempts > 1):
+        log_event("'{}' acknowledged after {} attempts".format(code, attempts))
+    return True
+
+# ------ IMAGE RECEIVING ----- #
+
+#Chunks land in the image file through an ImageWriter and its journal (RFD900_Journal.py). Legacy base64 words are
+#decoded here as they arrive, and journals left by an earlier session are picked up at startup for a resume
+
+class B64Decoder:                                                   #Decodes the original base64 words as they arrive, carrying any partial quad to the next word
+    def __init__(self):
+        self.carry = ""
+        self.offset = 0                                             #Position of the next decoded byte in the image
+
+    def feed(self, word):
+        text = self.carry + word
+        whole = len(text) - len(text) % 4
+        self.carry = text[whole:]
+        data = text[:whole].decode('base64')
+        self.offset += len(data)
+        return data
+
+def resume_ranges(savepath):                                        #"start-end;start-end" still needed for a journaled image, None when there is nothing to resume
+    path = find_journal(savepath)
+    if (path is None):
+        return None
+    size, identity, ranges = read_journal(path)
+    if ((size == 0) or (len(ranges) == 0)):
+        return None                                                 #Base64 word transfers don't report a size and can't be restarted partway
+    missing = missing_ranges(ranges, size)
+    if (len(missing) == 0):
+        return None
+    print "Resuming", os.path.basename(savepath), "-", sum(end - start for start, end in missing), "bytes still missing"
+    return ";".join("{}-{}".format(start, end) for start, end in missing)
+
+def recover_partial_images():                                       #Checks what earlier sessions were receiving when they died and remembers their journals for a resume
+    for path in sorted(glob.glob("SESSIONS/Session_*/*.journal")):
+        if (os.path.dirname(os.path.abspath(path)) == os.path.abspath(sessionDir).rstrip(os.sep)):
+            continue
+        try:
+            size, identity, ranges = read_journal(path)
+            savepath = path[:-len(".journal")]
+            if ((size > 0) and (len(missing_ranges(ranges, size)) == 0)):
+                os.remove(path)                                     #The image made it to disk, only the cleanup was missed
+                print "Recovered complete image", savepath
+                log_event("Recovered complete image {} from journal".format(savepath))
+            else:
+                partialJournals[os.path.basename(savepath)] = path
+                print "Recovered partial image", savepath
+                log_event("Recovered partial image {} ({} bytes), can be resumed".format(savepath, sum(ranges.values())))
+        except:
+            e = sys.exc_info()
+            print "Could not recover", path, e[1]
+            log_event("ERROR: Could not recover journal {}, {}".format(path, e[1]))
+    sys.stdout.flush()
+
+# ------ GPS TRACK ----- #
+
+#Every decoded payload fix is appended to "GPS_Track_<session>.sqlite" in the session directory. Inserts are batched
+#on their own thread (one commit per batch, never in the serial path) and the table is indexed on the ground receive
+#time, so a whole flight's trajectory comes back from one query instead of a search through the text logs
+
+GPS_TRACK_BATCH = 200                       #Most fixes written per commit
+
+class GPSTrack(threading.Thread):
+    def __init__(self, path):
+        threading.Thread.__init__(self, name = "gps track")
+        self.daemon = True
+        self.path = path
+        self.queue = Queue.Queue(LOG_QUEUE_SIZE)
+        self.ready = threading.Event()                              #Set once the table exists, queries wait on it
+
+    def put(self, fix, source):                                     #source is "image" or "request", never blocks
+        try:
+            self.queue.put_nowait((time.time(), fix["time"], fix["lat"], fix["lon"], fix["alt"], fix["fix"], fix["sats"], source))
+        except Queue.Full:
+            pass
+
+    def run(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")               #Readers (queries, other tools) don't block the inserts
+        connection.execute("CREATE TABLE IF NOT EXISTS fixes (received REAL, time REAL, lat REAL, lon REAL, alt REAL, fix INTEGER, sats INTEGER, source TEXT)")
+        connection.execute("CREATE INDEX IF NOT EXISTS fixes_received ON fixes (received)")
+        connection.commit()
+        self.ready.set()
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while (len(batch) < GPS_TRACK_BATCH):
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if (None in batch):
+                running = False
+                batch = batch[:batch.index(None)]
+            connection.executemany("INSERT INTO fixes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            connection.commit()
+        connection.close()
+
+    def track(self, start = 0, end = None):                         #Fixes received between two epochs, oldest first, any thread
+        if (end is None):
+            end = time.time()
+        self.ready.wait(5)
+        connection = sqlite3.connect(self.path)
+        try:
+            return connection.execute("SELECT received, time, lat, lon, alt, fix, sats, source FROM fixes WHERE received BETWEEN ? AND ? ORDER BY received", (start, end)).fetchall()
+        finally:
+            connection.close()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join(10)
+
+gpsTrack = GPSTrack("{}GPS_Track_{}.sqlite".format(sessionDir, sessionTime))
+gpsTrack.start()
+
+undecodedGPS = 0
+
+def record_gps(raw, source):                                        #Decodes the payload's GPS slot and adds it to the track, returns the fix or None
+    global undecodedGPS
+    fix = decode_gps(raw)
+    if (fix is None):
+        if (undecodedGPS % 100 == 0):                               #A payload with an unknown text format would otherwise fill the log
+            log_event("ERROR: Could not decode payload GPS {} ({} so far)".format(repr(raw), undecodedGPS + 1))
+        undecodedGPS += 1
+        return None
+    gpsTrack.put(fix, source)
+    predictor.add(fix, time.time())
+    print "GPS Location: {:.6f}, {:.6f}, {:.1f} m".format(fix["lat"], fix["lon"], fix["alt"])
+    return fix
+
+# ------ PREDICTIVE POINTING ----- #
+
+#Between real fixes the servo tracker is fed positions predicted from the recent track (RFD900_Tracking.py), in the
+#same form as the payload's own slots so the tracker never sees a mix of text and packed records
+
+predictor = TrackPredictor(servoFeed.publish)
+
+# ------ IMAGE CACHE ----- #
+
+#Finished images are decoded and resized on a small pool of threads, never on the GUI thread. The screen sized preview
+#and the gallery thumbnail are saved under "<session>/previews/" so an image is only ever decoded from the original once,
+#and the most recently used ones are kept decoded in memory up to IMAGE_CACHE_BYTES, so switching between them is instant
+
+PREVIEW_SIZE = (650,450)
+THUMB_SIZE = (96,66)
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024        #Decoded pixels kept in memory, least recently shown dropped first
+DECODE_WORKERS = 2
+
+class ImageCache:
+    def __init__(self, limit):
+        self.limit = limit
+        self.entries = collections.OrderedDict()                    #key -> (image, bytes), oldest first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if (entry is None):
+                return None
+            self.entries[key] = entry                               #Now the most recently used
+            return entry[0]
+
+    def put(self, key, image):
+        cost = image.size[0] * image.size[1] * len(image.getbands())
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if (old is not None):
+                self.size -= old[1]
+            self.entries[key] = (image, cost)
+            self.size += cost
+            while ((self.size > self.limit) and (len(self.entries) > 1)):
+                dropped = self.entries.popitem(last = False)[1]
+                self.size -= dropped[1]
+
+class DecodePool:
+    def __init__(self, count):
+        self.jobs = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target = self.run, name = "decode {}".format(n)) for n in range(count)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, function, *args):                         #Same key already waiting -> not queued twice
+        with self.lock:
+            if (key in self.pending):
+                return False
+            self.pending.add(key)
+        self.jobs.put((key, function, args))
+        return True
+
+    def run(self):
+        while True:
+            key, function, args = self.jobs.get()
+            with self.lock:
+                self.pending.discard(key)
+            try:
+                function(*args)
+            except:
+                e = sys.exc_info()
+                print "Could not decode", key[1], e[1]
+                log_event("ERROR: Could not decode {}, {}".format(key[1], e[1]))
+
+imageCache = ImageCache(IMAGE_CACHE_BYTES)
+decodePool = DecodePool(DECODE_WORKERS)
+shownImage = None                           #Path of the image the main view should show
+
+def cached_file(path, kind):                                        #Where the preview or thumbnail of an image is kept on disk
+    return os.path.join(sessionDir, "previews", "{}.{}.jpg".format(os.path.basename(path), kind))
+
+def load_image(path, kind):                                         #Decode pool only, kind is "preview" or "thumb"
+    mtime = os.path.getmtime(path)
+    key = (path, mtime, kind)                                       #A resumed or repeated download changes mtime, so stale entries just age out
+    image = imageCache.get(key)
+    if (image is not None):
+        return image
+    saved = cached_file(path, kind)
+    if (os.path.exists(saved) and (os.path.getmtime(saved) >= mtime)):
+        image = PIL.Image.open(saved)
+        image.load()
+        imageCache.put(key, image)
+        return image
+    full = PIL.Image.open(path)
+    full.draft("RGB", PREVIEW_SIZE)                                 #JPEGs decode straight at preview size
+    preview = full.convert("RGB").resize(PREVIEW_SIZE, PIL.Image.ANTIALIAS)
+    thumb = preview.resize(THUMB_SIZE, PIL.Image.ANTIALIAS)
+    if (not os.path.exists(os.path.dirname(saved))):
+        os.makedirs(os.path.dirname(saved))
+    preview.save(cached_file(path, "preview"), "JPEG", quality = 90)
+    thumb.save(cached_file(path, "thumb"), "JPEG", quality = 90)
+    imageCache.put((path, mtime, "preview"), preview)
+    imageCache.put((path, mtime, "thumb"), thumb)
+    if (kind == "thumb"):
+        return thumb
+    return preview
+
+# ------ SESSION ARCHIVE ----- #
+
+#SESSIONS/archive.sqlite catalogs every session for post-flight search (see SessionArchive.py). This session's
+#images, GPS fixes and events are added to it every ARCHIVE_INTERVAL seconds, only what is new each time
+
+ARCHIVE_INTERVAL = 60.0
+
+archiveHalt = threading.Event()
+
+def archive_session():                                              #Own thread, an sqlite connection has to stay on the thread that opened it
+    try:
+        archive = SessionArchive.Archive(os.path.dirname(os.path.normpath(sessionDir)))
+    except:
+        log_critical("SESSION ARCHIVE")
+        return
+    while True:
+        finished = archiveHalt.wait(ARCHIVE_INTERVAL)
+        try:
+            archive.index_session(sessionDir)
+        except:
+            e = sys.exc_info()
+            log_event("ERROR: Could not update the session archive, {}".format(e[1]))
+        if finished:
+            break
+    archive.close()
+
+archiveThread = threading.Thread(target = archive_session, name = "archive")
+archiveThread.daemon = True
+
+# ------ IMAGE CODING ----- #
+
+#Upgraded payloads that list "codecs" in their capabilities re-encode an image before sending it when the request
+#names a codec and quality, so a PNG of terrain can come down as a much smaller JPEG or WebP. The transfer header
+#then carries codec, quality and the original size, and the image is saved under the matching extension.
+
+CODEC_EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp"}
+CODEC_OPTIONS = ["original", "jpeg", "webp", "png"]                 #"original" sends the file as the payload stored it
+QUALITY_OPTIONS = ["95", "85", "75", "60", "40", "20"]
+
+def codec_request(codec, quality):                                  #Request parameters for a re-encode, None if it's not wanted or the payload can't do it
+    if (codec not in payloadCaps.get("codecs", "").split("/")):
+        return None
+    return {"codec": codec, "quality": quality}
+
+def coded_extension(info):                                          #Extension of the codec the payload sent in, info is the transfer header (or the request)
+    if ((info is None) or (info.get("codec") not in CODEC_EXTENSIONS)):
+        return extension
+    return CODEC_EXTENSIONS[info["codec"]]
+
+def coded_name(name, info):                                         #The payload's file name with that extension
+    if ((info is None) or (info.get("codec") not in CODEC_EXTENSIONS)):
+        return name
+    return os.path.splitext(name)[0] + coded_extension(info)
+
+
+# ------ REGION TILES ----- #
+
+#Payloads that report "tiles" can send one cell of an image cut into a TILE_GRID x TILE_GRID grid, so a region picked
+#on the low resolution preview comes down at full resolution without paying for the rest of the image. Each tile is
+#its own windowed transfer with its own file and journal under "<session>/tiles/<image>/", and the tiles received so
+#far are pasted over the upscaled low resolution image into "<image>_mosaic.jpg", which fills in as they arrive.
+#Image names follow the payload's imageNNNNNa / imageNNNNNb convention, 'a' full resolution and 'b' low (see cmd3).
+
+TILE_GRID = 8
+MOSAIC_FADE = 0.5                       #Brightness of the upscaled low resolution image where no tile has arrived yet
+
+mosaicLock = threading.Lock()           #Tile layouts are written by the link worker and read by the decode pool
+regionStart = None                      #Preview fractions where the operator pressed the mouse
+selectedRegion = None                   #(x0, y0, x1, y1) as fractions of the shown image
+
+def full_resolution_name(path):                                     #Payload name of the full resolution image behind a shown image or mosaic, None if it doesn't follow the convention
+    stem = os.path.splitext(os.path.basename(path))[0]
+    for suffix in ("_mosaic", "_layered"):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    if ((len(stem) != 11) or (stem[10] not in "ab")):
+        return None
+    return stem[:10] + "a" + extension
+
+def tile_dir(stem):
+    return os.path.join(sessionDir, "tiles", stem)
+
+def mosaic_path(stem):
+    return os.path.join(sessionDir, stem + "_mosaic.jpg")
+
+def read_layout(stem):                                              #{"full": [w, h], "grid": n, "tiles": {"col_row": [file, box]}}
+    with mosaicLock:
+        try:
+            with open(os.path.join(tile_dir(stem), "layout.json")) as layoutFile:
+                return json.load(layoutFile)
+        except (IOError, ValueError):
+            return {"grid": TILE_GRID, "tiles": {}}
+
+def write_layout(stem, layout):
+    with mosaicLock:
+        with open(os.path.join(tile_dir(stem), "layout.json"), "w") as layoutFile:
+            json.dump(layout, layoutFile)
+
+def region_cells(region):                                           #Grid cells covering region, the ones nearest its middle first
+    x0, y0, x1, y1 = region
+    cols = range(int(x0 * TILE_GRID), min(TILE_GRID - 1, int(x1 * TILE_GRID)) + 1)
+    rows = range(int(y0 * TILE_GRID), min(TILE_GRID - 1, int(y1 * TILE_GRID)) + 1)
+    middle = ((x0 + x1) * TILE_GRID / 2.0 - 0.5, (y0 + y1) * TILE_GRID / 2.0 - 0.5)
+    return sorted([(col, row) for col in cols for row in rows], key = lambda cell: (cell[0] - middle[0])**2 + (cell[1] - middle[1])**2)
+
+
+# ------ LAYERED TRANSFERS ----- #
+
+#Payloads that report "layers" can send an image as a residual pyramid (LAYERED IMAGES in RFD900_Protocol): a small
+#thumbnail first, then layers that each double the size and build on everything already received instead of starting
+#the full image from scratch. Each "Refine Image" fetches the next layer of the shown image into "<session>/layers/<image>/"
+#and the layers so far are added up into "<image>_layered.png", so the operator can stop at whatever size is enough.
+#The last layer gives the full resolution image pixel for pixel.
+
+LAYER_COUNT = 5                         #Layers asked for (640x480 starts at 40x30), the payload may offer fewer
+
+def layer_dir(stem):
+    return os.path.join(sessionDir, "layers", stem)
+
+def layer_path(stem, level, count):                                 #The count is part of the name, layers of different pyramids never add up
+    return os.path.join(layer_dir(stem), "L{}of{}.png".format(level, count))
+
+def layered_path(stem):
+    return os.path.join(sessionDir, stem + "_layered.png")
+
+def layers_received(stem, count):                                   #Complete layers from the thumbnail up, a missing or journaled one ends the run
+    level = 0
+    while ((level < count) and os.path.exists(layer_path(stem, level, count)) and (not os.path.exists(layer_path(stem, level, count) + ".journal"))):
+        level += 1
+    return level
+
+
+# ------ TRANSFER METRICS ----- #
+
+#Each image transfer is measured while it runs: chunks, bytes that crossed the port against image bytes kept,
+#the time between accepted chunks as a histogram, retries, sync() calls and the time lost in them. Finished
+#transfers (and ping tests) are appended as one JSON line to the session's metrics file, and the recent ones
+#plus the transfer in progress are served as JSON on http://127.0.0.1:METRICS_PORT/ for live monitoring.
+
+METRICS_PORT = 8900
+METRICS_KEEP = 50                       #Records kept in memory for the endpoint, the file has all of them
+LATENCY_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)   #Upper bounds in seconds, one more bucket holds anything slower
+
+metricsFileName = sessionDir + "Transfer_Metrics_{}.jsonl".format(sessionTime)
+recentMetrics = collections.deque(maxlen = METRICS_KEEP)
+currentTransfer = None                  #TransferMetrics of the image being received, None between transfers
+
+class TransferMetrics:
+    def __init__(self, path):
+        self.path = path
+        self.kind = None                #"windowed", "framed" or "b64" once the payload's framing is known
+        self.started = time.time()
+        self.last = self.started
+        self.received = ser.received - len(ser.buffer)  #Port counters at the start (bytes already pulled in but not read yet belong to this transfer),
+        self.sent = ser.sent            #the difference at the end is what the transfer cost
+        self.chunks = 0
+        self.useful = 0
+        self.retries = 0
+        self.bad = 0
+        self.duplicates = 0
+        self.timeouts = 0
+        self.syncs = 0
+        self.syncTime = 0.0
+        self.telemetry = 0              #Telemetry frames that arrived in the middle of the transfer
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.coding = {}                #codec, quality, original size and ratio of a re-encoded image
+
+    def chunk(self, useful):                                        #An accepted chunk with useful image bytes
+        now = time.time()
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, now - self.last)] += 1
+        self.last = now
+        self.chunks += 1
+        self.useful += useful
+
+    def report(self, complete = None):
+        elapsed = max(time.time() - self.started, 0.001)
+        air = (ser.received - self.received) + (ser.sent - self.sent)
+        record = {"kind": self.kind, "image": os.path.basename(self.path), "start": self.started, "seconds": elapsed, "complete": complete,
+                "chunks": self.chunks, "useful_bytes": self.useful, "air_bytes": air, "effective_bps": self.useful * 8 / elapsed, "air_bps": air * 8 / elapsed,
+                "retries": self.retries, "bad_chunks": self.bad, "duplicates": self.duplicates, "timeouts": self.timeouts,
+                "syncs": self.syncs, "sync_seconds": self.syncTime, "telemetry_frames": self.telemetry, "latency_buckets": list(LATENCY_BUCKETS), "latency_histogram": self.histogram}
+        record.update(self.coding)
+        return record
+
+def save_metrics(record):                                           #Link worker, appends one record to the session's metrics file
+    recentMetrics.append(record)
+    try:
+        with open(metricsFileName, "a") as metricsFile:
+            metricsFile.write(json.dumps(record, sort_keys = True) + "\n")
+    except IOError as error:
+        log_event("ERROR: Could not write transfer metrics, {}".format(error))
+
+def finish_transfer(complete):
+    global currentTransfer
+    record = currentTransfer.report(complete)
+    currentTransfer = None
+    save_metrics(record)
+    print "Transfer: {} chunks, {} of {} bytes useful, {:.0f} bit/s, {} retries, {} syncs ({:.1f} s)".format(record["chunks"], record["useful_bytes"],
+        record["air_bytes"], record["effective_bps"], record["retries"], record["syncs"], record["sync_seconds"])
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        current = currentTransfer
+        if (current is not None):
+            current = current.report()
+        body = json.dumps({"session": sessionTime, "current": current, "recent": list(recentMetrics)}, sort_keys = True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):                           #Keeps every request out of the runtime log
+        return
+
+def serve_metrics():
+    try:
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", METRICS_PORT), MetricsHandler)    #Local only
+    except socket.error as error:
+        log_event("ERROR: Metrics endpoint not started, {}".format(error))
+        return
+    server.serve_forever()
+
+metricsThread = threading.Thread(target = serve_metrics, name = "metrics")
+metricsThread.daemon = True
+
 
 # ------ FUNCTION DECLARATIONS ----- #
 
@@ -210,376 +1014,785 @@ def reset_cam():
         sys.stdout.flush()
     return
 
-def b64_to_image(data,savepath):                                    #Back converts a base64 String of ASCII characters into an image, the save path dictates image format
-    fl = open(savepath, "wb")
-    fl.write(data.decode('base64'))
-    fl.close()
-
 def gen_checksum(data):
     return hashlib.md5(data).hexdigest()                            #Generates a 32 character hash up to 10000 char length String(for checksum). If string is too long I've notice length irregularities in checksum
 
 def sync():                                                         #This is module to ensure both sender and receiver at that the same point in their data streams to prevent a desync
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Attempted to Sync\r\n".format(time.time()))
+    start = time.time()
+    log_event("Attempted to Sync")
     print "Attempting to Sync - This should take approx. 2 sec"
-    sync = ""
-    addsync0 = ""
-    addsync1 = ""
-    addsync2 = ""
-    addsync3 = ""
-    while(sync != "sync"):                                          #Program is held until no data is being sent (timeout) or until the pattern 's' 'y' 'n' 'c' is found
-        addsync0 = ser.read()
-        addsync0 = str(addsync0)
-        if(addsync0 == ''):
-            break
-        sync = addsync3 + addsync2 + addsync1 + addsync0
-        addsync3 = addsync2
-        addsync2 = addsync1
-        addsync1 = addsync0
-    sync = ""
+    ser.find("sync")                                                #Program is held until no data is being sent (timeout) or until the pattern 'sync' is found
     ser.write('S')                                                  #Notifies sender that the receiving end is now synced 
     print "System Match"
     ser.flushInput()
     ser.flushOutput()
+    if (currentTransfer is not None):
+        currentTransfer.syncs += 1
+        currentTransfer.syncTime += time.time() - start
     return
 
-def receive_image(savepath, wordlength):
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Start Photo Receiving\r\n".format(time.time()))
-    onceDone = False
-    resetOnce = False
+def show_preview(writer):                                           #Redraws the partially received image, throttled so decoding never eats into receive time
+    global lastPreview
+    global previewBytes
+    global previewCost
+    if (writer.size > 0):
+        gui_call(progressVar.set, "{}: {} of {} bytes".format(os.path.basename(writer.savepath), writer.received(), writer.size))
+    else:
+        gui_call(progressVar.set, "{}: {} bytes".format(os.path.basename(writer.savepath), writer.received()))
+    waited = time.time() - lastPreview
+    if (writer.preview and (waited >= max(PREVIEW_INTERVAL, PREVIEW_SHARE*previewCost)) and (writer.received() != previewBytes)):
+        start = time.time()
+        previewBytes = writer.received()
+        try:
+            part = partial_image(writer.savepath)
+            gui_call(set_photo, part.resize((650,450),PIL.Image.NEAREST))
+        except:
+            pass                                                    #Not enough of the image yet for the decoder to find its header
+        previewCost = time.time() - start
+        lastPreview = time.time()
+
+def partial_image(path):                                            #Whatever part of a progressive JPEG or interlaced PNG has arrived. Final and gallery decodes still fail on a truncated file
+    with truncatedLock:
+        saved = PIL.ImageFile.LOAD_TRUNCATED_IMAGES
+        PIL.ImageFile.LOAD_TRUNCATED_IMAGES = True
+        try:
+            part = PIL.Image.open(path)
+            part.draft("RGB", (650,450))                            #JPEGs decode straight at preview size, much cheaper than a full decode
+            part.load()
+        finally:
+            PIL.ImageFile.LOAD_TRUNCATED_IMAGES = saved
+    return part
+
+def set_photo(image):                                               #GUI thread only, Tk images can't be created from the link worker
+    global photo
+    photo = ImageTk.PhotoImage(image)
+    tmplabel.configure(image = photo)
+    tmplabel.pack(fill=BOTH,expand = 1)
+
+def display_image(path):                                            #Called once an image is saved, shows it and adds it to the session gallery
+    show_image(path)
+    decodePool.submit(("thumb", path), gallery_thumb, path)
+
+def show_image(path):                                               #Any thread, a cached preview goes up at once, anything else is decoded by the pool
+    global shownImage
+    shownImage = path
+    gui_call(imageDisplay.set, path)
+    try:
+        image = imageCache.get((path, os.path.getmtime(path), "preview"))
+    except OSError:
+        return                                                      #File was moved or deleted since it was listed
+    if (image is not None):
+        gui_call(set_photo, image)
+    else:
+        decodePool.submit(("preview", path), show_decoded, path)
+
+def show_decoded(path):                                             #Decode pool
+    image = load_image(path, "preview")
+    if (shownImage == path):                                        #The operator may have moved on to another image meanwhile
+        gui_call(set_photo, image)
+
+def gallery_thumb(path):                                            #Decode pool
+    gui_call(add_thumbnail, path, load_image(path, "thumb"))
+
+def add_thumbnail(path, image):                                     #GUI thread only
+    photo = ImageTk.PhotoImage(image)
+    if (path in galleryPhotos):
+        galleryPhotos[path][0].configure(image = photo)
+        galleryPhotos[path] = (galleryPhotos[path][0], photo)       #Tk drops images nothing in python refers to
+        return
+    button = Button(galleryStrip, image = photo, text = os.path.basename(path), compound = TOP, font = "Verdana 6", command = lambda: show_image(path))
+    button.pack(side = LEFT, padx = 2)
+    galleryPhotos[path] = (button, photo)
+    galleryStrip.update_idletasks()
+    galleryCanvas.configure(scrollregion = galleryCanvas.bbox(ALL))
+    galleryCanvas.xview_moveto(1.0)                                 #Newest image in view
+
+def fill_gallery():                                                 #Images already in this session's directory, e.g. after a restart
+    paths = []
+    for kind in set([extension] + CODEC_EXTENSIONS.values()):
+        paths += glob.glob(os.path.join(sessionDir, "*" + kind))
+    for path in sorted(paths, key = os.path.getmtime):
+        decodePool.submit(("thumb", path), gallery_thumb, path)
+
+def abort_transfer():
+    global abortTransfer
+    abortTransfer = True
+    print "Abort requested, stopping after the current chunk"
+
+def hunt_frame(window = ""):                                        #Skips ahead to the next frame magic, returns "" on timeout. window is bytes already read that may hold part of it
+    ser.unread(window)
+    if (ser.find(FRAME_MAGIC) == False):
+        return ""
+    return FRAME_MAGIC
+
+def next_frame(lead, fec = 0):                                      #Reads the rest of a frame whose magic is already in lead, returns None if it fails the CRC and can't be repaired
+    frame = read_frame(ser, lead, fec)
+    if ((frame is None) or (frame[3] is None)):
+        return None
+    flags, seq, offset, body, wire, fixed = frame
+    if (fixed > 0):
+        print "repaired frame", str(seq), "-", str(fixed), "bytes corrected"
+        log_event("FEC repaired frame {} ({} bytes corrected)".format(seq, fixed))
+    return (flags, seq, offset, body)
+
+def probe_payload():                                                #Asks the payload which transfer modes it supports, older payloads don't answer 'V' and stay on the original commands
+    global payloadCaps
+    ser.flushInput()
+    payloadCaps = {}                                                #'V' always goes as the plain byte, the payload may have been swapped for an older one
+    try:
+        send_command(ser, 'V', None, 5)
+    except CommandTimeout:
+        print "Payload did not report capabilities, using original transfer commands"
+        log_event("No capability report from payload, using original transfer commands")
+        sys.stdout.flush()
+        return
+    lead = hunt_frame()
+    frame = None
+    if (lead != ""):
+        frame = next_frame(lead)
+    if ((frame is None) or ((frame[0] & FRAME_CTRL) == 0)):
+        payloadCaps = {}
+        print "Capability report was garbled, using original transfer commands"
+        log_event("ERROR: Garbled capability report from payload, using original transfer commands")
+        sys.stdout.flush()
+        return
+    payloadCaps = decode_params(frame[3])
+    print "Payload capabilities:", encode_params(payloadCaps)
+    log_event("Payload capabilities: {}".format(encode_params(payloadCaps)))
+    sys.stdout.flush()
+    return
+
+def request_windowed(name, ranges = None, extra = None):            #Starts a windowed transfer, name "" asks for the most recent image. Returns the payload's transfer header
+    ser.flushInput()
+    if (command('W') == False):
+        raise IOError("no acknowledge for windowed transfer request")
+    window = min(windowSize, int(payloadCaps.get("win", windowSize)))   #Never ask for more frames in flight than the payload can buffer
+    params = {"name": name, "win": window}
+    if (payloadCaps.get("chunk")):
+        params["chunk"] = chunkSize                                 #Start at whatever size the last transfer settled on
+    if (ranges is not None):
+        params["ranges"] = ranges                                   #Resume: the payload only sends frames covering these byte ranges
+    if (payloadCaps.get("fec") and (fecParity > 0)):
+        params["fec"] = min(fecParity, int(payloadCaps["fec"]))     #The payload reports the most parity it will compute per block
+    if (payloadCaps.get("telem") and (telemetryInterval > 0)):
+        params["telem"] = telemetryInterval                         #Position on its own channel, the image frames carry no GPS slot
+        if ("chunk" in params):
+            params["chunk"] = min(params["chunk"], telemetry_chunk(telemetryInterval))
+    if (extra is not None):
+        params.update(extra)                                        #Codec, tile, see codec_request() and download_tiles()
+    request = pack_frame(0, encode_params(params), FRAME_CTRL)
+    for attempt in range(3):                                        #The request frame itself can be corrupted, the payload stays quiet until it gets a clean one
+        ser.write(request)
+        lead = hunt_frame()
+        if (lead == ""):
+            continue
+        frame = next_frame(lead)
+        if ((frame is not None) and (frame[0] & FRAME_CTRL)):
+            info = decode_params(frame[3])
+            info.setdefault("win", window)
+            info.setdefault("fec", 0)                               #Payloads that ignore the fec parameter send plain frames
+            log_event("Windowed transfer header: {}".format(encode_params(info)))
+            return info
+    raise IOError("no transfer header from payload")
+
+def receive_image(savepath, wordlength, info = None):              #info is the transfer header when the request went out as a windowed transfer
+    log_event("Start Photo Receiving")
 
     print "confirmed photo request"                                 #Notifies User we have entered the receiveimage() module
     #sys.stdout.flush()
-    
+
+    size = 0
+    if (info is not None):
+        size = int(info.get("size", 0))
+    identity = journal_identity(info)
+    try:                                                            #This will attempt to open the image as the given filename, if it for some reason errors out, the image will go to the except line
+        writer = ImageWriter(savepath, size, identity)
+        gui_call(imageDisplay.set, savepath)
+    except:
+        e = sys.exc_info()
+        print e[0]
+        print e[1]
+        print "Error with filename, saved as newimage" + extension
+        sys.stdout.flush()
+        writer = ImageWriter("newimage" + extension, size, identity)    #Save image as newimage.jpg due to a naming error
+        log_event("ERROR: File save name error, saving as \"newimage.jpg\"")
+    if writer.discarded:
+        print "Journal for", os.path.basename(writer.savepath), "was for another image, starting over"
+        log_event("Journal for {} belonged to another image, starting over".format(os.path.basename(writer.savepath)))
+    elif (writer.received() > 0):
+        log_event("Resuming {} from journal, {} bytes already on disk".format(os.path.basename(writer.savepath), writer.received()))
+
+    global abortTransfer
+    global currentTransfer
+    abortTransfer = linkWorker.stopping
+    currentTransfer = TransferMetrics(writer.savepath)
+    if ((info is not None) and (int(info.get("layer", 0)) > 0)):
+        writer.preview = False                                      #A residual is grey noise, the rebuilt pyramid is shown once it lands
+    if ((info is not None) and ("codec" in info) and (size > 0)):
+        original = int(info.get("original", size))
+        currentTransfer.coding = {"codec": info["codec"], "quality": int(info.get("quality", 0)), "original_bytes": original, "ratio": original / float(size)}
+        print "Re-encoded as {} (quality {}): {} -> {} bytes, {:.1f}x smaller".format(info["codec"], info.get("quality", "-"), original, size, original / float(size))
+        log_event("Image re-encoded as {} quality {}, {} -> {} bytes".format(info["codec"], info.get("quality", "-"), original, size))
+    complete = False
+    gui_call(abortbutton.configure, state = NORMAL)
+    try:
+        if (info is not None):
+            complete = receive_windowed(info, writer)
+        else:
+            lead = ser.read_exact(len(FRAME_MAGIC))                 #Upgraded payloads open with the frame magic, older ones open with their hex checksum
+            if (lead == FRAME_MAGIC):
+                complete = receive_framed(lead, writer)
+            else:
+                complete = receive_b64(lead, wordlength, writer)
+    finally:
+        writer.close(complete)                                      #Also on an exception, the file and journal handles would leak otherwise
+        gui_call(abortbutton.configure, state = DISABLED)
+        gui_call(progressVar.set, "")
+        finish_transfer(complete)
+
+    if (complete == False):
+        print "Partial image kept in journal, request it again to resume"
+    print "Image Saved"
+    sys.stdout.flush()
+    log_event("End Photo Receiving")
+
+def receive_framed(lead, writer):                                   #Stop-and-wait over binary frames, a bad CRC only costs a resend of that frame (no 2 sec sync needed)
+    log_event("Payload is sending binary frames")
+    print "binary framing detected"
+    currentTransfer.kind = "framed"
+
+    trycnt = 0
+    emptycnt = 0
+    expected = 0                                                    #Sequence number of the next frame we still need
+    complete = False
+    while True:
+        if abortTransfer:
+            print "Transfer aborted"                                #The original handshake has no abort, the payload gives up once its retries run out
+            log_event("Photo transfer aborted by operator")
+            ser.flushInput()
+            break
+        if (lead != FRAME_MAGIC):
+            lead = hunt_frame(lead)                                 #After a bad frame the resend is found by its magic instead of a full sync()
+        if (lead == ""):
+            if (emptycnt == 0):
+                print "frame stream was empty, trying again"
+                ser.write('N')                                      #If our last 'Y' was lost the payload resends that frame and the duplicate is dropped below
+                emptycnt += 1
+                currentTransfer.timeouts += 1
+                log_event("Payload frame stream was empty, retrying")
+                continue
+            print "frame stream was empty twice, stopping"
+            log_event("Frame stream empty twice, ending photo receiving")
+            break
+        emptycnt = 0
+        frame = next_frame(lead)
+        lead = ""
+        if (frame is None):
+            currentTransfer.bad += 1
+            if (trycnt < 5):
+                ser.write('N')
+                trycnt += 1
+                currentTransfer.retries += 1
+                print "try number:", str(trycnt)
+                print "\tresend frame", str(expected)
+                log_event("Frame Failure, Retry Number {}".format(trycnt))
+                continue
+            print "ran out of send attempts"
+            ser.write('N')
+            log_event("ERROR: Ran out of retry attempts, truncating photo")
+            break
+        trycnt = 0
+        ser.write('Y')
+        flags, seq, offset, body = frame
+        if (seq != expected):                                       #Duplicate of a frame we already have, our 'Y' for it went missing
+            currentTransfer.duplicates += 1
+            continue
+        if (flags & FRAME_GPS):
+            payloadGPS = body[:GPSLength]
+            body = body[GPSLength:]
+            servoFeed.publish(payloadGPS)
+            record_gps(payloadGPS, "image")
+        writer.write(offset, body)
+        currentTransfer.chunk(len(body))
+        expected += 1
+        print "Current Recieve Position: ", str(writer.received())
+        show_preview(writer)
+        if (flags & FRAME_LAST):
+            complete = True
+            break
+    return complete
+
+def chunk_sizer(info):                                              #None unless the payload can change its frame size mid-transfer
+    if (not payloadCaps.get("chunk")):
+        return None
+    smallest, largest = [int(value) for value in payloadCaps["chunk"].split("-")]   #The payload reports the range it supports, e.g. "256-8192"
+    if info.get("telem"):
+        largest = max(smallest, min(largest, telemetry_chunk(float(info["telem"]))))
+    return ChunkSizer(int(info.get("chunk", chunkSize)), smallest, largest)
+
+def telemetry_chunk(interval):                                      #Largest frame body that is on the air for no longer than interval, so a due telemetry frame never waits longer than that
+    return int(baud / 10.0 * interval)
+
+def receive_windowed(info, writer):                                 #Selective-repeat transfer, several frames in flight and only the missing ones are resent
+    global chunkSize
+    window = WindowReceiver(int(info.get("win", windowSize)))
+    sizer = chunk_sizer(info)
+    fec = int(info.get("fec", 0))
+    asked = None                                                    #Chunk size we asked for and haven't seen a frame of yet
+    heard = time.time()                                             #Last frame of the transfer itself, telemetry doesn't count
+    currentTransfer.kind = "windowed"
+    while (window.complete() == False):
+        if abortTransfer:
+            print "Transfer aborted"
+            log_event("Photo transfer aborted by operator")
+            ser.write(pack_frame(0, encode_params({"abort": 1}), FRAME_CTRL))  #Tells the payload to stop streaming, the journal keeps what we have
+            ser.flushInput()
+            return False
+        if window.stale():                                          #Telemetry keeps hunt_frame from timing out, so lost statuses are repeated on a timer
+            ser.write(pack_frame(0, window.status(), FRAME_ACK))
+        lead = hunt_frame()
+        if (lead == ""):
+            currentTransfer.timeouts += 1
+            if (time.time() - heard > 5*timeout):
+                print "payload went quiet, truncating photo"
+                log_event("ERROR: No frames for {:.0f} seconds, truncating photo".format(time.time() - heard))
+                break
+            print "no frames, resending status"
+            currentTransfer.retries += 1
+            ser.write(pack_frame(0, window.status(), FRAME_ACK))    #Our last status may have been lost, this restarts the payload
+            if (sizer is not None):
+                sizer.record(False)
+            continue
+        frame = next_frame(lead, fec)
+        if (frame is None):
+            print "bad frame, will be reported missing"             #No need to NACK right away, the gap shows up in the next status
+            currentTransfer.bad += 1
+            currentTransfer.retries += 1
+            log_event("Frame Failure after frame {}".format(window.highest))
+            if (sizer is not None):
+                sizer.record(False)
+            if window.hurry():
+                ser.write(pack_frame(0, window.status(), FRAME_ACK))  #Asks for the resend now instead of after half a window or a timeout
+            continue
+        flags, seq, offset, body = frame
+        if (flags & FRAME_TELEM):                                   #Interleaved by the payload on its own clock, not part of the window
+            receive_telemetry(body)
+            if (window.missing() and window.hurry()):               #Still waiting on resends, the payload may not have our last status
+                ser.write(pack_frame(0, window.status(), FRAME_ACK))
+            continue
+        heard = time.time()
+        if (flags & (FRAME_CTRL | FRAME_ACK)):                      #A repeat of the transfer header, the payload didn't see our first status yet
+            continue
+        skipped = window.gap(seq)
+        if (window.accept(seq, flags) == False):
+            currentTransfer.duplicates += 1
+            continue
+        if (skipped and window.hurry()):                            #Frames before this one were lost outright, report them right away
+            ser.write(pack_frame(0, window.status(), FRAME_ACK))
+        if (flags & FRAME_GPS):
+            payloadGPS = body[:GPSLength]
+            body = body[GPSLength:]
+            servoFeed.publish(payloadGPS)
+            record_gps(payloadGPS, "image")
+        writer.write(offset, body)                                  #Frames can land out of order, each one goes straight to its offset
+        currentTransfer.chunk(len(body))
+        print "Current Recieve Position: ", str(writer.received())
+        show_preview(writer)
+        if (sizer is not None):
+            sizer.record(True, len(body))
+            if (len(body) == asked):
+                asked = None
+            change = sizer.decide()
+            if (change is not None):
+                print "Chunk size now", change[0], "-", change[1]
+                log_event("Chunk size {} -> {} bytes, {}".format(chunkSize, change[0], change[1]))
+                asked = change[0]
+                chunkSize = change[0]
+                ser.write(pack_frame(0, encode_params({"chunk": asked}), FRAME_CTRL))
+        if (window.due()):
+            ser.write(pack_frame(0, window.status(), FRAME_ACK))
+            if (asked is not None):                                 #Repeated until frames of the new size show up, in case the first request was lost
+                ser.write(pack_frame(0, encode_params({"chunk": asked}), FRAME_CTRL))
+    ser.write(pack_frame(0, window.status(), FRAME_ACK))            #Final status tells the payload everything arrived
+    return window.complete() and (len(writer.missing()) == 0)
+
+def receive_telemetry(body):
+    global lastTelemetry
+    payloadGPS = body[:GPSLength]
+    servoFeed.publish(payloadGPS)
+    if (record_gps(payloadGPS, "telemetry") is not None):
+        lastTelemetry = time.time()
+    currentTransfer.telemetry += 1
+
+def receive_b64(lead, wordlength, writer):                          #Original base64 word framing, kept for payloads that haven't been upgraded
+    onceDone = False
+    resetOnce = False
+
     #Module Specific Variables
     trycnt = 0                                                      #Initializes the checksum timeout (timeout value is not set here)
-    finalstring = ""                                                #Initializes the data string so that the += function can be used
+    position = 0                                                    #Base64 characters received so far
+    decoder = B64Decoder()                                          #Each verified word is decoded and written right away instead of building one long string
     done = False                                                    #Initializes the end condition
+    truncated = False                                               #A truncated image keeps its journal so it can be recovered
+    currentTransfer.kind = "b64"
     
     #Retreive Data Loop (Will end when on timeout)
     while(done == False):
+        if abortTransfer:
+            print "Transfer aborted"
+            log_event("Photo transfer aborted by operator")
+            ser.flushInput()
+            truncated = True
+            break
         if(onceDone == True):
             if(resetOnce == False):
                 resetOnce = True
             else:
                 onceDone = False
 
-        print "Current Recieve Position: ", str(len(finalstring))
+        print "Current Recieve Position: ", str(position)
         checktheirs = ""
-        checktheirs = ser.read(32)                                  #Asks first for checksum. Checksum is asked for first so that if data is less than wordlength, it won't error out the checksum data
+        checktheirs = lead + ser.read_exact(32 - len(lead))         #Asks first for checksum. Checksum is asked for first so that if data is less than wordlength, it won't error out the checksum data
+        lead = ""                                                   #The first two checksum characters were already read while checking for binary framing
         #print (checktheirs)
-        payloadGPS = ser.read(GPSLength)
-        
-        clientGPS.send(payloadGPS)
+        payloadGPS = ser.read_exact(GPSLength)
         
         #print (payloadGPS)
-        word = ser.read(wordlength)                                 #Retreives characters, wholes total string length is predetermined by variable wordlength
+        word = ser.read_exact(wordlength)                           #Retreives characters, wholes total string length is predetermined by variable wordlength
         checkours = gen_checksum(payloadGPS + word)                              #Retreives a checksum based on the received data string
         #print (checkours)
         
         #CHECKSUM
         if (checkours != checktheirs):
+            currentTransfer.bad += 1
             if(trycnt < 5):                                         #This line sets the maximum number of checksum resends. Ex. trycnt = 5 will attempt to rereceive data 5 times before erroring out                                              #I've found that the main cause of checksum errors is a bit drop or add desync, this adds a 2 second delay and resyncs both systems 
                 ser.write('N')
                 trycnt += 1
+                currentTransfer.retries += 1
                 print "try number:", str(trycnt)
                 print "\tresend last"                                 #This line is mostly used for troubleshooting, allows user to view that both devices are at the same position when a checksum error occurs
-                print "\tpos @" , str(len(finalstring))
+                print "\tpos @" , str(position)
                 #sys.stdout.flush()
                 sync()                                              #This corrects for bit deficits or excesses ######  THIS IS A MUST FOR DATA TRANSMISSION WITH THE RFD900s!!!! #####
-                with open(event_logFileName, "a") as logFile:
-                   logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                   logFile.write(" (aka {} UTC Epoch) -- Packet Failure, Retry Number {}\r\n".format(time.time(), trycnt))
+                log_event("Packet Failure, Retry Number {}".format(trycnt))
             else:
                 print "ran out of send attempts"
                 ser.write('N')                                      #Kind of a worst case, checksum trycnt is reached and so we save the image and end the receive, a partial image will render if enough data
-                finalstring += word                                 
+                offset = decoder.offset
+                writer.write(offset, decoder.feed(word), False)     #Unverified, so it isn't journaled
                 done = True
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- ERROR: Ran out of retry attempts, truncating photo\r\n".format(time.time()))
+                truncated = True
+                log_event("ERROR: Ran out of retry attempts, truncating photo")
                 break
         else:
             trycnt = 0
             ser.write('Y')
-            print ("GPS Location:" + payloadGPS)
-            finalstring += word
+            servoFeed.publish(payloadGPS)                           #Only once the checksum says the GPS slot is intact
+            record_gps(payloadGPS, "image")
+            offset = decoder.offset
+            data = decoder.feed(word)
+            writer.write(offset, data)
+            currentTransfer.chunk(len(data))
+            position += len(word)
+            show_preview(writer)
         if(word == ""):
             if(onceDone == False):
                 print "their word was empty, trying again"
+                currentTransfer.timeouts += 1
                 #ser.read(ser.inWaiting())
                 ser.write('Y')
                 #sys.stdout.flush()
                 sync()
                 resetOnce = False
                 onceDone = True
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- Payload word was empty, retrying\r\n".format(time.time()))
+                log_event("Payload word was empty, retrying")
             else:
                 print "word was empty"
                 done = True
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- Word was empty, ending photo receiving\r\n".format(time.time()))
+                log_event("Word was empty, ending photo receiving")
                 break
         if(checktheirs == ""):
             if(onceDone == False):
                 print "their check was empty, trying again"
+                currentTransfer.timeouts += 1
                 #ser.read(ser.inWaiting())
                 ser.write('Y')
                 #sys.stdout.flush()
                 sync()
                 resetOnce = False
                 onceDone = True
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- Payload check-word was empty, retrying\r\n".format(time.time()))
+                log_event("Payload check-word was empty, retrying")
             else:
                 print "their check was empty twice, stopping"
                 done = True
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- Payload check-word empty twice, ending photo receiving\r\n".format(time.time()))
+                log_event("Payload check-word empty twice, ending photo receiving")
                 break
-    try:                                                            #This will attempt to save the image as the given filename, if it for some reason errors out, the image will go to the except line
-        b64_to_image(finalstring,savepath)
-        imageDisplay.set(savepath)
-    except:
-        e = sys.exc_info()
-        print e[0]
-        print e[1]
-        print "Error with filename, saved as newimage" + extension
-        sys.stdout.flush()
-        b64_to_image(finalstring,"newimage" + extension)            #Save image as newimage.jpg due to a naming error
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- ERROR: File save name error, saving as \"newimage.jpg\"\r\n".format(time.time()))
-    
-    print "Image Saved"
-    sys.stdout.flush()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- End Photo Receiving\r\n".format(time.time()))
+    return truncated == False
 
 
-def most_Recent():     #Get Most Recent Photo
+def most_Recent(savename, codec = "original", quality = 75):     #Get Most Recent Photo, runs on the link worker with the save name, codec and quality read by the GUI
     ser.flushInput()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Requested most recent photo\r\n".format(time.time()))
-    global im
-    global photo
-    global tmplabel
-    global reim
-    ser.write('1')
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        sys.stdout.flush()
-        ser.write('1')
-    #sync()
-    sendfilename = ""
-    temp = 0
-    while(temp <= 14):
-        sendfilename += str(ser.read())
-        temp += 1
+    log_event("Requested most recent photo")
+    info = None
+    if (payloadCaps.get("win")):
+        try:
+            info = request_windowed("", None, codec_request(codec, quality))   #The transfer header names the image for us
+        except IOError as error:
+            print "Windowed request failed:", error
+            log_event("ERROR: Windowed request for most recent photo failed, {}".format(error))
+            sys.stdout.flush()
+            return
+        sendfilename = info.get("name", "")
+    else:
+        if (command('1') == False):
+            return
+        #sync()
+        sendfilename = ser.read_exact(15)
     #sendfilename = "image" + sendfilename +extension
-    imagepath = imagename.get()
+    imagepath = savename
     if (imagepath == ""):
         try:
             if(sendfilename[0] == "i"):
-                imagepath = sendfilename
+                imagepath = coded_name(sendfilename, info)
             else:
-                imagepath = "image_%s%s" % (str(datetime.datetime.now().strftime("%Y%m%d_T%H%M%S")),extension)
+                imagepath = "image_%s%s" % (str(datetime.datetime.now().strftime("%Y%m%d_T%H%M%S")),coded_extension(info))
         except:
-            imagepath = "image_%s%s" % (str(datetime.datetime.now().strftime("%Y%m%d_T%H%M%S")),extension)
+            imagepath = "image_%s%s" % (str(datetime.datetime.now().strftime("%Y%m%d_T%H%M%S")),coded_extension(info))
     else:
-        imagepath = imagepath+extension
+        imagepath = imagepath+coded_extension(info)
             
     try:
         print "Image will be saved as:", imagepath
-        tkMessageBox.showinfo("In Progress..",message = "Image request recieved.\nImage will be saved as "+imagepath)
+        gui_call(messageVar.set, "Image request recieved, saving as " + imagepath)    #Not a message box, a modal dialog would hold up every other GUI update
         timecheck = time.time()
         sys.stdout.flush()
-        receive_image(str(sessionDir + imagepath), wordlength)
-        im = PIL.Image.open(str(sessionDir + imagepath))
-        reim = im.resize((650,450),PIL.Image.ANTIALIAS)
-        photo = ImageTk.PhotoImage(reim)
-        tmplabel.configure(image = photo)
-        tmplabel.pack(fill=BOTH,expand = 1)
+        receive_image(str(sessionDir + imagepath), wordlength, info)
+        display_image(str(sessionDir + imagepath))
         print "Receive Time =", (time.time() - timecheck)
     except:
-        with open(event_logFileName, "a") as logFile:
-            logFile.write("\r\n--- ")
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- CRITICAL ERROR: MOST RECENT PHOTO ---\r\n\r\n".format(time.time()))
-            e = sys.exc_info()
-            logFile.write("{}\r\n".format(e[0]))
-            logFile.write("{}\r\n".format(e[1]))
-            logFile.write("{}".format(traceback.format_exc(e[2])))
-            print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+        log_critical("MOST RECENT PHOTO")
+        print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
     sys.stdout.flush()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Finished receiving most recent photo\r\n".format(time.time()))
+    log_event("Finished receiving most recent photo")
     return
 
-def cmd2():     #reguest imagedata.txt
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Requesting imagedata.txt\r\n".format(time.time()))
-    try:
-        listbox.delete(0,END)
-    except:
-        print "Failed to delete Listbox, window may have been destroyed"
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- ERROR: Failed to delete listbox, window may have been destroyed\n".format(time.time()))
-        sys.stdout.flush()
-    ser.write('2')
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        sys.stdout.flush()
-        ser.write('2')
+def cmd2(datafilepath):     #reguest imagedata.txt, runs on the link worker with the file name read by the GUI
+    log_event("Requesting imagedata.txt")
+    gui_call(listbox.delete, 0, END)                                #A closed subGui is caught by pump_gui()
+    if (command('2') == False):
+        return
     #sync()
     try:
-        datafilepath = datafilename.get()
         if (datafilepath == ""):
             datafilepath = "imagedata"
         file = open(datafilepath+".txt","w")
     except:
         print "Error with opening file"
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- ERROR: Error with opening imagedata file\r\n".format(time.time()))
+        log_event("ERROR: Error with opening imagedata file")
         sys.stdout.flush()
         return
     timecheck = time.time()
     temp = ser.readline()
     while(temp != ""):
         file.write(temp)
-        try:
-            listbox.insert(0,temp)
-        except:
-            print "error adding items"
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: Error adding items to listbox\r\n".format(time.time()))
-            break
+        gui_call(listbox.insert, 0, temp)
         temp = ser.readline()
     file.close()
     print "File Recieved, Attempting Listbox Update"
     sys.stdin.flush()
-    subGui.lift()
-    subGui.mainloop()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Finished receiving image list\r\n".format(time.time()))
+    gui_call(subGui.lift)
+    log_event("Finished receiving image list")
     return
 
-def cmd3():     #reguest specific image
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Requested specific photo\r\n".format(time.time()))
-    global im
-    global photo
-    global tmplabel
-    global reim
+def cmd3():     #reguest specific image, the selection and warning happen here on the GUI thread
     item = map(int,listbox.curselection())
     try:
         data = listbox.get(ACTIVE)
     except:
         print "Nothing Selected"
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- ERROR:  no photo was selected\r\n".format(time.time()))
+        log_event("ERROR:  no photo was selected")
         sys.stdout.flush()
         return
     data = data[0:15]
     print data[10]
     if (data[10] != 'b'):
-        tkMessageBox.askquestion("W A R N I N G",message = "You have selected the high resolution image.\nAre you sure you want to continue?\nThis download could take 15+ min.",icon = "warning")
-        if 'yes':
-            ser.write('3')
-            while (ser.read() != 'A'):
-                print "Waiting for Acknowledge"
-                sys.stdout.flush()
-                ser.write('3')
-            sync()
-            try:
-                imagepath = data
-                ser.write(data)
-                timecheck = time.time()
-                tkMessageBox.showinfo("In Progress...",message = "Image request recieved.\nImage will be saved as "+imagepath)
-                print "Image will be saved as:", imagepath
-                sys.stdout.flush()
-                receive_image(str(sessionDir + imagepath), wordlength)
-                im = PIL.Image.open(sessionDir + imagepath)
-                reim = im.resize((650,450),PIL.Image.ANTIALIAS)
-                photo = ImageTk.PhotoImage(reim)
-                tmplabel.configure(image = photo)
-                tmplabel.pack(fill=BOTH,expand = 1)
-                print "Receive Time =", (time.time() - timecheck)
-            except:
-                with open(event_logFileName, "a") as logFile:
-                    logFile.write("\r\n--- ")
-                    logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                    logFile.write(" (aka {} UTC Epoch) -- CRITICAL ERROR: SPECIFIC PHOTO REQUEST ---\r\n\r\n".format(time.time()))
-                    e = sys.exc_info()
-                    logFile.write("{}\r\n".format(e[0]))
-                    logFile.write("{}\r\n".format(e[1]))
-                    logFile.write("{}".format(traceback.format_exc(e[2])))
-                    print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- Finished receiving specific photo\r\n".format(time.time())) 
+        answer = tkMessageBox.askquestion("W A R N I N G",message = "You have selected the high resolution image.\nAre you sure you want to continue?\nThis download could take 15+ min.",icon = "warning")
+        if (answer != 'yes'):
             return
-        else:
+    linkWorker.submit(PRIORITY_BULK, "photo " + data, specific_image, data, codecList.get(), int(qualityList.get()))
+    return
+
+def specific_image(data, codec = "original", quality = 75):     #runs on the link worker
+    log_event("Requested specific photo")
+    if (not payloadCaps.get("win")):
+        if (command('3') == False):
             return
-            
-    else:
-        ser.write('3')
-        while (ser.read() != 'A'):
-            print "Waiting for Acknowledge"
-            sys.stdout.flush()
-            ser.write('3')
         sync()
-        try:
-            imagepath = data
+    try:
+        imagepath = data
+        info = None
+        if (payloadCaps.get("win")):
+            coding = codec_request(codec, quality)
+            imagepath = coded_name(data, coding)                    #A re-encoded image has its own file and journal
+            info = request_windowed(data, resume_ranges(sessionDir + imagepath), coding)   #Upgraded payloads get the name and any ranges a journal is still missing
+            imagepath = coded_name(data, info)                      #What the payload actually sent, it may not have re-encoded
+        else:
             ser.write(data)
-            timecheck = time.time()
-            tkMessageBox.showinfo("In Progress...",message = "Image request recieved.\nImage will be saved as "+imagepath)
-            print "Image will be saved as:", imagepath
-            sys.stdout.flush()
-            receive_image(str(sessionDir + imagepath), wordlength)
-            im = PIL.Image.open(sessionDir + imagepath)
-            reim = im.resize((650,450),PIL.Image.ANTIALIAS)
-            photo = ImageTk.PhotoImage(reim)
-            tmplabel.configure(image = photo)
-            tmplabel.pack(fill=BOTH,expand = 1)
-            print "Receive Time =", (time.time() - timecheck)
+        timecheck = time.time()
+        gui_call(messageVar.set, "Image request recieved, saving as " + imagepath)
+        print "Image will be saved as:", imagepath
+        sys.stdout.flush()
+        receive_image(str(sessionDir + imagepath), wordlength, info)
+        display_image(sessionDir + imagepath)
+        print "Receive Time =", (time.time() - timecheck)
+    except:
+        log_critical("SPECIFIC PHOTO REQUEST")
+        print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+    log_event("Finished receiving specific photo")
+    return
+
+def preview_fraction(event):                                        #Mouse position on tmplabel as fractions of the shown image
+    left = (tmplabel.winfo_width() - PREVIEW_SIZE[0]) / 2.0         #The preview is centred in the label
+    top = (tmplabel.winfo_height() - PREVIEW_SIZE[1]) / 2.0
+    return (min(max((event.x - left) / PREVIEW_SIZE[0], 0.0), 1.0), min(max((event.y - top) / PREVIEW_SIZE[1], 0.0), 1.0))
+
+def region_press(event):                                            #GUI thread
+    global regionStart
+    regionStart = preview_fraction(event)
+
+def region_release(event):                                          #GUI thread, a plain click picks the one tile under it
+    global selectedRegion
+    if (regionStart is None):
+        return
+    end = preview_fraction(event)
+    selectedRegion = (min(regionStart[0], end[0]), min(regionStart[1], end[1]), max(regionStart[0], end[0]), max(regionStart[1], end[1]))
+    print "Region selected: {:.0%}-{:.0%} across, {:.0%}-{:.0%} down, {} tiles".format(selectedRegion[0], selectedRegion[2], selectedRegion[1], selectedRegion[3], len(region_cells(selectedRegion)))
+
+def cmd_region():                                                   #GUI thread, requests the selected region of the shown image at full resolution
+    if ((shownImage is None) or (selectedRegion is None)):
+        tkMessageBox.showinfo("Region", message = "Drag across the image preview to select a region first")
+        return
+    name = full_resolution_name(shownImage)
+    if (name is None):
+        tkMessageBox.showinfo("Region", message = "Regions can only be requested for payload images (imageNNNNNa/b)")
+        return
+    linkWorker.submit(PRIORITY_BULK, "region of " + name, download_tiles, name, region_cells(selectedRegion), codecList.get(), int(qualityList.get()))
+
+def download_tiles(name, cells, codec = "original", quality = 75):  #runs on the link worker, one windowed transfer per tile not already received
+    global abortTransfer
+    if (not payloadCaps.get("tiles")):
+        print "Payload can't send regions, request the whole image instead"
+        log_event("ERROR: Region requested but the payload has no tile support")
+        return
+    stem = os.path.splitext(name)[0]
+    if (not os.path.exists(tile_dir(stem))):
+        os.makedirs(tile_dir(stem))
+    log_event("Requested {} tiles of {}".format(len(cells), name))
+    abortTransfer = linkWorker.stopping
+    for col, row in cells:
+        if abortTransfer:                                           #The operator stopped the tile in progress, don't start the rest
+            break
+        key = "{}_{}".format(col, row)
+        layout = read_layout(stem)
+        if ((key in layout["tiles"]) and os.path.exists(os.path.join(tile_dir(stem), layout["tiles"][key][0]))):
+            continue                                                #Already have it, tiles are cached for the whole session
+        try:
+            extra = {"tile": "{}:{}:{}".format(col, row, TILE_GRID)}
+            coding = codec_request(codec, quality)
+            if (coding is not None):
+                extra.update(coding)
+            path = coded_name(os.path.join(tile_dir(stem), key + extension), coding)
+            info = request_windowed(name, resume_ranges(path), extra)
+            path = coded_name(os.path.join(tile_dir(stem), key + extension), info)
+            print "Tile", key, "of", name
+            receive_image(path, wordlength, info)
+            if os.path.exists(path + ".journal"):
+                continue                                            #Incomplete, the journal resumes it on the next request
+            layout = read_layout(stem)
+            layout["full"] = [int(value) for value in info["full"].split(":")]
+            layout["tiles"][key] = [os.path.basename(path), [int(value) for value in info["box"].split(":")]]
+            write_layout(stem, layout)
+            decodePool.submit(("mosaic", stem), build_mosaic, stem)
         except:
-            with open(event_logFileName, "a") as logFile:
-                logFile.write("\r\n--- ")
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- CRITICAL ERROR: MOST RECENT PHOTO ---\r\n\r\n".format(time.time()))
-                e = sys.exc_info()
-                logFile.write("{}\r\n".format(e[0]))
-                logFile.write("{}\r\n".format(e[1]))
-                logFile.write("{}".format(traceback.format_exc(e[2])))
-                print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- Finished receiving specific photo\r\n".format(time.time())) 
+            log_critical("TILE REQUEST")
+            print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+            break
+    log_event("Finished tile requests for {}".format(name))
+
+def build_mosaic(stem):                                             #Decode pool, pastes every tile received so far over the upscaled low resolution image
+    layout = read_layout(stem)
+    if ("full" not in layout):
+        return
+    size = tuple(layout["full"])
+    lowres = [path for path in glob.glob(os.path.join(sessionDir, stem[:10] + "b.*")) if (not path.endswith(".journal"))]
+    if (len(lowres) > 0):
+        base = PIL.Image.open(lowres[0]).convert("RGB").resize(size, PIL.Image.BILINEAR)
+        base = base.point(lambda value: int(value * MOSAIC_FADE))   #Dimmed so it is obvious which parts are still low resolution
+    else:
+        base = PIL.Image.new("RGB", size, (40, 40, 40))
+    for filename, box in layout["tiles"].values():
+        tile = PIL.Image.open(os.path.join(tile_dir(stem), filename))
+        base.paste(tile.convert("RGB"), (box[0], box[1]))
+    base.save(mosaic_path(stem), "JPEG", quality = 90)
+    display_image(mosaic_path(stem))
+
+def cmd_refine():                                                   #GUI thread, fetches the next layer of the shown image
+    name = None
+    if (shownImage is not None):
+        name = full_resolution_name(shownImage)
+    if (name is None):
+        tkMessageBox.showinfo("Refine", message = "Show a payload image (imageNNNNNa/b) to refine first")
+        return
+    linkWorker.submit(PRIORITY_BULK, "refine " + name, download_layer, name)
+
+def download_layer(name):                                           #runs on the link worker, one windowed transfer for the lowest layer not received yet
+    if (not payloadCaps.get("layers")):
+        print "Payload can't send layers, request the whole image instead"
+        log_event("ERROR: Layer requested but the payload has no layered transfers")
         return
+    stem = os.path.splitext(name)[0]
+    count = min(LAYER_COUNT, int(payloadCaps["layers"]))
+    level = layers_received(stem, count)
+    if (level == count):
+        print name, "is already at full resolution"
+        display_image(layered_path(stem))
+        return
+    if (not os.path.exists(layer_dir(stem))):
+        os.makedirs(layer_dir(stem))
+    log_event("Requested layer {} of {} of {}".format(level + 1, count, name))
+    try:
+        path = layer_path(stem, level, count)
+        info = request_windowed(name, resume_ranges(path), {"layer": level, "layers": count})
+        if (int(info.get("layers", count)) != count):
+            print "Payload answered with a different pyramid, not refining"
+            log_event("ERROR: Payload sent a {} layer pyramid, asked for {}".format(info.get("layers"), count))
+            ser.write(pack_frame(0, encode_params({"abort": 1}), FRAME_CTRL))
+            ser.flushInput()
+            return
+        size = layer_size([int(value) for value in info["full"].split(":")], level, count)
+        print "Layer {} of {} of {} ({}x{})".format(level + 1, count, name, size[0], size[1])
+        receive_image(path, wordlength, info)
+        if (not os.path.exists(path + ".journal")):
+            decodePool.submit(("layers", stem), build_layered, stem, count)
+    except:
+        log_critical("LAYER REQUEST")
+        print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+
+def build_layered(stem, count):                                     #Decode pool, adds up the layers received so far
+    levels = layers_received(stem, count)
+    if (levels == 0):
+        return
+    image = PIL.Image.open(layer_path(stem, 0, count)).convert("RGB")
+    for level in range(1, levels):
+        residual = PIL.Image.open(layer_path(stem, level, count)).convert("RGB")
+        offset = PIL.Image.new("RGB", residual.size, (LAYER_OFFSET,) * 3)
+        image = PIL.ImageChops.subtract_modulo(PIL.ImageChops.add_modulo(image.resize(residual.size, PIL.Image.NEAREST), residual), offset)
+    image.save(layered_path(stem), "PNG")
+    print "{} rebuilt from {} of {} layers at {}x{}".format(layered_path(stem), levels, count, image.size[0], image.size[1])
+    display_image(layered_path(stem))
 
 def cmd4(): #Retrieve current settings
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Requested current settings\r\n".format(time.time())) 
+    log_event("Requested current settings")
     global width
     global height
     global sharpness
@@ -590,11 +1803,8 @@ def cmd4(): #Retrieve current settings
     global timeupdateflag
     print "Retrieving Camera Settings"
     try:
-        killtime = time.time()+10
-        ser.write('4')
-        while ((ser.read() != 'A') & (time.time()<killtime)):
-            print "Waiting for Acknowledge"
-            ser.write('4')
+        if (command('4') == False):
+            return
         #sync()
         timecheck = time.time()
         #tkMessageBox.showinfo("In Progress..",message = "Downloading Settings")
@@ -607,10 +1817,7 @@ def cmd4(): #Retrieve current settings
             return
         timecheck = time.time()
         sys.stdin.flush()
-        temp = ser.read()
-        while((temp != "\r") & (temp != "") ):
-            file.write(temp)
-            temp = ser.read()
+        file.write(ser.read_until("\r").rstrip("\r"))                #Settings end at '\r', or at the timeout if it never comes
         file.close()
         print "Receive Time =", (time.time() - timecheck)
         sys.stdout.flush()
@@ -638,27 +1845,16 @@ def cmd4(): #Retrieve current settings
         print "iso = ",iso
         file.close()
         timeupdateflag = 1
-        updateslider()
-        with open(event_logFileName, "a") as logFile:
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- Finished receiving current settings\r\n".format(time.time())) 
+        gui_call(updateslider)
+        log_event("Finished receiving current settings")
     except:
-        with open(event_logFileName, "a") as logFile:
-            logFile.write("\r\n--- ")
-            logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-            logFile.write(" (aka {} UTC Epoch) -- CRITICAL ERROR: RECEIVING CURRENT SETTINGS ---\r\n\r\n".format(time.time()))
-            e = sys.exc_info()
-            logFile.write("{}\r\n".format(e[0]))
-            logFile.write("{}\r\n".format(e[1]))
-            logFile.write("{}".format(traceback.format_exc(e[2])))
-            print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
+        log_critical("RECEIVING CURRENT SETTINGS")
+        print("There was a critical error! Please see \"{}\" for details.".format(event_logFileName))
         print "Camera Setting Retrieval Error"
     return
 
-def cmd5():     #upload new settings
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Uploading new settings\r\n".format(time.time())) 
+def cmd5(settings):     #upload new settings, runs on the link worker with the slider values read by the GUI
+    log_event("Uploading new settings")
     global width
     global height
     global sharpness
@@ -666,13 +1862,7 @@ def cmd5():     #upload new settings
     global contrast
     global saturation
     global iso
-    width = widthslide.get()
-    height = heightslide.get()
-    sharpness = sharpnessslide.get()
-    brightness = brightnessslide.get()
-    contrast = contrastslide.get()
-    saturation = saturationslide.get()
-    iso = isoslide.get()
+    width, height, sharpness, brightness, contrast, saturation, iso = settings
     file = open("camerasettings.txt","w")
     file.write(str(width)+"\n")
     file.write(str(height)+"\n")
@@ -683,11 +1873,8 @@ def cmd5():     #upload new settings
     file.write(str(iso)+"\n")
     file.close()
     
-    ser.write('5')
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        #sys.stdin.flush()
-        ser.write('5')
+    if (command('5') == False):
+        return
     #sync()
     timecheck = time.time()
     #tkMessageBox.showinfo("In Progress..",message = "Downloading Settings")
@@ -703,66 +1890,33 @@ def cmd5():     #upload new settings
         ser.write(temp)
         temp = file.readline()
     file.close()
-    error = time.time()
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        sys.stdout.flush()
-        if(error+10<time.time()):
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: Timed-out when sending new settings, no acknowledge received\r\n".format(time.time())) 
-            print "Acknowledge not received"
-            return
+    if (wait_acknowledge(ser, '5', lastRequest, 10) == False):     #The payload confirms the new settings with a second acknowledge, never resent
+        log_event("ERROR: Timed-out when sending new settings, no acknowledge received")
+        print "Acknowledge not received"
+        return
     print "Send Time =", (time.time() - timecheck)
     sys.stdout.flush()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- New camera settings uploaded\r\n".format(time.time())) 
+    log_event("New camera settings uploaded")
     return
 
 def time_sync():
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Attempting a time sync\r\n".format(time.time())) 
+    log_event("Attempting a time sync")
     #ser.flushInput()
-    ser.write('T')
-    termtime = time.time() + 20
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        ser.write('T')
-        if (termtime < time.time()):
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: no acknowledge recieved, connection error\r\n".format(time.time())) 
-            print "No Acknowledge Recieved, Connection Error"
-            sys.stdout.flush()
-            return
+    if (command('T', 20) == False):
+        return
     localtime = str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"))
     rasptime = str(ser.readline())
     print "##################################\nRaspb Time = %s\nLocal Time = %s\n##################################" % (rasptime,localtime)
     sys.stdin.flush()
     connectiontest(10)
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Finished time sync\r\n".format(time.time())) 
+    probe_payload()                                                 #The payload may have been swapped or rebooted since the last check
+    log_event("Finished time sync")
     return
 
 def connectiontest(numping):
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Attempted ping, {} packets\r\n".format(time.time(), numping)) 
-    ser.write('6')
-    termtime = time.time() + 20
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        ser.write('6')
-        if (termtime < time.time()):
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: no acknowledge received, connection error\r\n".format(time.time())) 
-            print "No Acknowledge Recieved, Connection Error"
-            sys.stdout.flush()
-            return
+    log_event("Attempted ping, {} packets".format(numping))
+    if (command('6', 20) == False):
+        return
     avg = 0
     ser.write('P')
     temp = ""
@@ -776,9 +1930,8 @@ def connectiontest(numping):
             receivetime = time.time()
         if (receivetime == 0):
             print "Connection Error, No return ping within 10 seconds"
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: connection error, no return ping within 10 seconds\r\n".format(time.time())) 
+            log_event("ERROR: connection error, no return ping within 10 seconds")
+            save_metrics({"kind": "ping", "start": time.time(), "pings": numping, "error": "no return ping within 10 seconds"})
             ser.write('D')
             sys.stdout.flush()
             return
@@ -789,48 +1942,30 @@ def connectiontest(numping):
     ser.write('D')
     avg = avg/numping
     print "Ping Response Time = " + str(avg)[0:4] + " seconds"
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Finished ping test\r\n".format(time.time())) 
+    save_metrics({"kind": "ping", "start": time.time(), "pings": numping, "average": avg})
+    log_event("Finished ping test")
     sys.stdout.flush()
     return
 
 def requestGPS():
     ser.flushInput()
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Requesting GPS Data\r\n".format(time.time()))
-    ser.write('G')
-    termtime = time.time() + 5
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        sys.stdout.flush()
-        if (termtime < time.time()):
-            with open(event_logFileName, "a") as logFile:
-                logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-                logFile.write(" (aka {} UTC Epoch) -- ERROR: no acknowledge received, connection error\r\n".format(time.time())) 
-            print "No Acknowledge Recieved, Connection Error"
-            sys.stdout.flush()
-            return
-    payloadGPS = ser.read(GPSLength)
-    #TODO - process the input gps data
-    with open(event_logFileName, "a") as logFile:
-        logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        logFile.write(" (aka {} UTC Epoch) -- Payload location: {}\r\n".format(time.time(), payloadGPS))
+    log_event("Requesting GPS Data")
+    if (command('G', 5) == False):
+        return
+    payloadGPS = ser.read_exact(GPSLength)
+    record_gps(payloadGPS, "request")
+    log_event("Payload location: {}".format(repr(payloadGPS)))
     #print test
     
-    clientGPS.send(payloadGPS)
+    servoFeed.publish(payloadGPS)
     sys.stdout.flush()
     return
     
 #optional command to retreive runtime data from payload
 '''
 def cmd7(): #get payload runtime data
-    ser.write('7')
-    while (ser.read() != 'A'):
-        print "Waiting for Acknowledge"
-        sys.stdout.flush()
-        ser.write('7')
+    if (command('7') == False):
+        return
     #sync()
     timecheck = time.time()
     try:
@@ -856,14 +1991,41 @@ def cmd7(): #get payload runtime data
     sys.stdout.flush()
     return
 '''
-'''
-def changeGPSPing():
+def changeFEC(*args):                                               #GUI thread, takes effect on the next windowed transfer
+    global fecParity
+    fecParity = int(fecList.get())
+    log_event("FEC parity set to {} bytes per block".format(fecParity))
+    return
+
+def changePredict():                                                #GUI thread
+    predictor.enabled = (predictVar.get() == 1)
+    log_event("Predictive antenna pointing {}".format("on" if predictor.enabled else "off"))
+    return
+
+def changeGPSPing(*args):                                            #GUI thread, called only when the ping option changes
     global pingGPS
+    global gpsTimer
     timing = float(optionList.get())
     pingGPS = timing
     print("ping is now",pingGPS)
+    if (gpsTimer is not None):
+        mainGui.after_cancel(gpsTimer)
+        gpsTimer = None
+    if (pingGPS > 0.0):
+        gpsTimer = mainGui.after(int(pingGPS * 1000), pollGPS)
     return
-'''
+
+def pollGPS():                                                      #GUI thread, re-arms itself every pingGPS seconds
+    global gpsTimer
+    print(pingGPS)
+    if (time.time() - lastTelemetry < pingGPS):
+        print("GPS arriving on the telemetry channel, request skipped")
+    else:
+        print("GPS Automatically Requested")
+        linkWorker.submit(PRIORITY_GPS, "GPS request", requestGPS)   #Waits behind a running transfer instead of blocking the GUI, never queued twice
+    gpsTimer = mainGui.after(int(pingGPS * 1000), pollGPS)
+    return
+
 # ------ GUI DECLARATION ----- #
 
 #declare main GUI component
@@ -883,8 +2045,14 @@ contrastVar = StringVar()
 saturationVar = StringVar()
 isoVar = StringVar()
 timeVar = StringVar()
+statusVar = StringVar()
+messageVar = StringVar()
+progressVar = StringVar()
 
 optionList = StringVar(mainGui)
+fecList = StringVar(mainGui)
+codecList = StringVar(mainGui)
+qualityList = StringVar(mainGui)
 
 mainGui.geometry("1300x570+30+30")
 mainGui.title("McNeese State University LaACES Program")
@@ -903,10 +2071,46 @@ reim = im.resize((650,450),PIL.Image.ANTIALIAS)
 photo = ImageTk.PhotoImage(reim)
 tmplabel = Label(master = frame,image = photo)
 tmplabel.pack(fill=BOTH,expand = 1)
+tmplabel.bind("<ButtonPress-1>", region_press)                      #Drag across the preview to pick a region for cmd_region()
+tmplabel.bind("<ButtonRelease-1>", region_release)
+
+abortbutton = Button(mainGui, text = "Abort Transfer", command = abort_transfer, state = DISABLED)
+abortbutton.place(x=295,y=520)
+
+regionbutton = Button(mainGui, text = "Get Region at Full Resolution", command = cmd_region)
+regionbutton.place(x=690,y=520)
+
+refinebutton = Button(mainGui, text = "Refine Image", command = cmd_refine)
+refinebutton.place(x=965,y=520)
+
+progresslabel = Label(mainGui, textvariable = progressVar, font = "Verdana 8")
+progresslabel.place(x=400,y=524)
+
+galleryGui = Toplevel(mainGui)
+galleryGui.title("Session Gallery")
+galleryGui.geometry("700x125+20+450")
+galleryCanvas = Canvas(galleryGui, height = 95)
+galleryScroll = Scrollbar(galleryGui, orient = HORIZONTAL, command = galleryCanvas.xview)
+galleryCanvas.configure(xscrollcommand = galleryScroll.set)
+galleryScroll.pack(side = BOTTOM, fill = X)
+galleryCanvas.pack(side = TOP, fill = BOTH, expand = 1)
+galleryStrip = Frame(galleryCanvas)
+galleryCanvas.create_window((0,0), window = galleryStrip, anchor = NW)
+galleryPhotos = {}                                                  #path -> (button, thumbnail PhotoImage)
+galleryGui.protocol('WM_DELETE_WINDOW', galleryGui.withdraw)       #Hidden, not destroyed, the gallery button brings it back
+
+gallerybutton = Button(mainGui, text = "Session Gallery", command = galleryGui.deiconify)
+gallerybutton.place(x=860,y=520)
+
+statusVar.set("Link: idle")
+statuslabel = Label(mainGui, textvariable = statusVar, font = "Verdana 8 italic")
+statuslabel.place(x=10,y=25)
+messagelabel = Label(mainGui, textvariable = messageVar, font = "Verdana 8")
+messagelabel.place(x=10,y=5)
 
 #-------------------------------------------
     #Cmd1 Gui - Request Most Recent Image
-most_Recent_Button = Button(mainGui, text = "Most Recent Photo", command = most_Recent)
+most_Recent_Button = Button(mainGui, text = "Most Recent Photo", command = lambda: linkWorker.submit(PRIORITY_BULK, "most recent photo", most_Recent, imagename.get(), codecList.get(), int(qualityList.get())))
 #most_Recent_Button = Button(mainGui, text = "Most Recent Photo", command = requestGPS)
 most_Recent_Button.place(x=150,y=65)
 
@@ -917,7 +2121,7 @@ imagename = Entry(mainGui, textvariable=imageName)
 imagename.place(x=10,y=70)
 #-------------------------------------------
     #Cmd2 Gui - Request text file on image data
-cmd2button = Button(mainGui, text = "Request 'imagedata.txt'", command = cmd2)
+cmd2button = Button(mainGui, text = "Request 'imagedata.txt'", command = lambda: linkWorker.submit(PRIORITY_CONTROL, "image list", cmd2, datafilename.get()))
 cmd2button.place(x=150, y=115)
 
 datafilename = Entry(mainGui, textvariable=dataFileName)
@@ -1005,10 +2209,14 @@ isoslide.pack()
 isolabel = Label(master = camright,textvariable = isoVar, font = "Verdana 8")
 isolabel.pack(pady=18)
 
-cmd4button = Button(cambot, text = "Get Current Settings", command = cmd4,borderwidth = 2,background = "white",font = "Verdana 10")
+def send_settings():     #Sliders are read here on the GUI thread, the upload itself runs on the link worker
+    settings = (widthslide.get(), heightslide.get(), sharpnessslide.get(), brightnessslide.get(), contrastslide.get(), saturationslide.get(), isoslide.get())
+    linkWorker.submit(PRIORITY_CONTROL, "send settings", cmd5, settings)
+
+cmd4button = Button(cambot, text = "Get Current Settings", command = lambda: linkWorker.submit(PRIORITY_CONTROL, "get settings", cmd4),borderwidth = 2,background = "white",font = "Verdana 10")
 cmd4button.grid(row = 1,column = 1)
 
-cmd5button = Button(cambot, text = "Send New Settings", command = cmd5,borderwidth = 2,background = "white",font = "Verdana 10")
+cmd5button = Button(cambot, text = "Send New Settings", command = send_settings,borderwidth = 2,background = "white",font = "Verdana 10")
 cmd5button.grid(row = 1,column = 0)
 
 defaultbutton = Button(cambot,text = "Default Settings",command = reset_cam,borderwidth = 2,background = "white",font = "Verdana 10",width = 20)
@@ -1021,7 +2229,7 @@ updateslider()
 #-------------------------------------------
     #Cmd 6 - Gui setup for connection testing
 
-conbutton = Button(mainGui,text = "Connection Test",command = time_sync,borderwidth = 2,font = "Verdana 10",width = 25)
+conbutton = Button(mainGui,text = "Connection Test",command = lambda: linkWorker.submit(PRIORITY_CONTROL, "connection test", time_sync),borderwidth = 2,font = "Verdana 10",width = 25)
 conbutton.place(x=25,y=490)
 
 #-------------------------------------------
@@ -1034,6 +2242,39 @@ OPTIONS = ["-1","0.5","3","10"]
 optionList.set(OPTIONS[0])
 timingList = OptionMenu(mainGui,optionList,*OPTIONS)
 timingList.place(x=25,y=530)
+optionList.trace("w", changeGPSPing)
+
+#-------------------------------------------
+    #Forward error correction, parity bytes per 255 byte block for windowed transfers
+
+fecLabel = Label(mainGui, text = "FEC Parity (bytes per 255, 0 = off)")
+fecLabel.place(x=1065,y=405)
+
+FEC_OPTIONS = ["0","8","16","32"]
+fecList.set(str(fecParity))
+fecMenu = OptionMenu(mainGui,fecList,*FEC_OPTIONS)
+fecMenu.place(x=1000,y=400)
+fecList.trace("w", changeFEC)
+
+#-------------------------------------------
+    #Predictive antenna pointing, predictions reach the servo tracker in the same form as the payload's fixes
+
+predictVar = IntVar(mainGui)
+predictCheck = Checkbutton(mainGui, text = "Predictive antenna pointing ({:g} Hz)".format(PREDICT_RATE), variable = predictVar, command = changePredict)
+predictCheck.place(x=1000,y=440)
+
+#-------------------------------------------
+    #Downlink codec and quality, sent with each photo request to payloads that can re-encode
+
+codecLabel = Label(mainGui, text = "Photo codec / quality")
+codecLabel.place(x=1170,y=485)
+
+codecList.set(CODEC_OPTIONS[0])
+codecMenu = OptionMenu(mainGui,codecList,*CODEC_OPTIONS)
+codecMenu.place(x=1000,y=480)
+qualityList.set("75")
+qualityMenu = OptionMenu(mainGui,qualityList,*QUALITY_OPTIONS)
+qualityMenu.place(x=1100,y=480)
 
 #-------------------------------------------
     #HERE WE GO!!!
@@ -1047,50 +2288,55 @@ runscrollbar.pack(side=RIGHT,fill=Y)
 runlistbox.pack(side=LEFT,fill=Y)
 rframe.place(x=10,y=165)
 
-def callback():
+def callback():     #Adds the runtime log lines written since the last call, newest at the top
     global runlistbox
     global mainGui
-    try:
-        runlistbox.delete(0,END)
-    except:
-        print "Failed to delete Listbox"
     print str(datetime.datetime.now().strftime("%m/%d/%Y %H:%M:%S"))
     sys.stdout.flush()
-    for line in reversed(list(open(runtime_logFileName))):
-        runlistbox.insert(END,line.rstrip())
+    lines = runTail.take()
+    if (len(lines) > 0):
+        lines.reverse()
+        runlistbox.insert(0,*lines)                                 #One Tk call however many lines came in
+        if (runlistbox.size() > RUNLOG_LINES):
+            runlistbox.delete(RUNLOG_LINES,END)
     mainGui.after(5000,callback)
     return
 
 def mGuicloseall():    
-    with open(event_logFileName, "a") as event_logFile:
-        event_logFile.write(datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S'))
-        event_logFile.write(" (aka {} UTC Epoch) -- Program Closed\r\n".format(time.time())) 
+    global abortTransfer
+    log_event("Program Closed")
+    abortTransfer = True                                            #Lets a running transfer keep its journal instead of dying mid-write
+    linkWorker.stop()
+    linkWorker.join(LINK_STOP_TIMEOUT)                              #The port is only closed once nothing is using it, and its errors still reach the event log
+    if linkWorker.is_alive():
+        log_event("ERROR: Link worker still busy with {} at close".format(linkWorker.busy))
+    predictor.stop()
+    servoFeed.stop()
     subGui.destroy()
     mainGui.destroy()
     ser.close()
     print "Program Terminated"
+    gpsTrack.stop()
+    eventLog.stop()                                                 #Writes out whatever is still queued
+    runtimeLog.stop()
+    archiveHalt.set()                                               #One last pass so the catalog has the whole session
+    archiveThread.join(30)
     sys.stdout.close()
     return
 	
 # ----- RUNTIME / GUI LOOP ACTIVATION ----- #
 
 mainGui.protocol('WM_DELETE_WINDOW',mGuicloseall)
-mainGui.after(1000,time_sync())
+recover_partial_images()
+archiveThread.start()
+metricsThread.start()
+servoFeed.start()
+predictor.start()
+linkWorker.start()
+decodePool.start()
+pump_gui()
+fill_gallery()
+linkWorker.submit(PRIORITY_CONTROL, "connection test", time_sync)
 callback()
 
-deltTime = time.time()
-
-while True:
-    try:
-        pingGPS = float(optionList.get())
-        if((pingGPS > 0.0) and (time.time() - deltTime > pingGPS)):
-            print(pingGPS)
-            print("GPS Automatically Requested")
-            requestGPS()
-            deltTime = time.time()   
-        mainGui.update_idletasks()
-        mainGui.update()
-    except TclError as error:
-        exit()
-
-#mainGui.mainloop()
+mainGui.mainloop()                                                  #Everything periodic (GPS polling, log panel, link worker results) runs from after() timers
@@ -0,0 +1,753 @@
+#RFD900 Link Protocol
+#...Wire format shared by the ground station (RFD900_PC_REFACTORED.py) and the payload
+#...Kept free of serial/GUI state so both ends (and the test tools) can import it
+
+import collections
+import re
+import struct
+import threading
+import time
+import zlib
+
+# ----- BINARY FRAMING ----- #
+
+#Frame layout on the air:
+#   magic (2) | flags (1) | seq (4) | offset (4) | length (2) | body (length) | crc32 (4)
+#The CRC covers the header as well as the body so a corrupted length or offset is caught too.
+#Legacy payloads open every word with a 32 character hex MD5, which can never start with the magic,
+#so the receiver can tell the two framings apart from the first two bytes on the line.
+
+FRAME_MAGIC = b"\xa5\x5a"
+FRAME_HEADER = struct.Struct(">2sBIIH")
+FRAME_CRC = struct.Struct(">I")
+FRAME_MAX_BODY = 16384                  #Anything longer than this is treated as a corrupted header
+
+FRAME_LAST = 0x01                       #Final data frame of a transfer
+FRAME_GPS = 0x02                        #Body starts with GPSLength bytes of payload location
+FRAME_CTRL = 0x04                       #Body is a key=value parameter list (requests, capabilities, transfer headers)
+FRAME_ACK = 0x08                        #Body is a windowed transfer status from the receiver
+FRAME_FEC = 0x10                        #Body is Reed-Solomon coded, see fec_encode()
+FRAME_TELEM = 0x20                      #Body is a GPS slot on the telemetry channel, see ChannelMux
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff                            #Masked so python 2 and 3 agree on the value
+
+def pack_frame(seq, body, flags = 0, offset = 0):
+    header = FRAME_HEADER.pack(FRAME_MAGIC, flags, seq, offset, len(body))
+    return header + body + FRAME_CRC.pack(crc32(header + body))
+
+def unpack_header(header):                                          #Returns (flags, seq, offset, length) or None if the header can't be trusted
+    if (len(header) != FRAME_HEADER.size):
+        return None
+    magic, flags, seq, offset, length = FRAME_HEADER.unpack(header)
+    if ((magic != FRAME_MAGIC) or (length > FRAME_MAX_BODY)):
+        return None
+    return (flags, seq, offset, length)
+
+def check_frame(header, body, crc):
+    if (len(crc) != FRAME_CRC.size):
+        return False
+    return FRAME_CRC.unpack(crc)[0] == crc32(header + body)
+
+# ----- CONTROL PARAMETERS ----- #
+
+#Control frames carry "key=value,key=value" text so either end can add keys without breaking the other
+
+def encode_params(params):
+    return ",".join("{}={}".format(key, params[key]) for key in sorted(params))
+
+def decode_params(body):
+    params = {}
+    for item in body.split(","):
+        if ("=" in item):
+            key, value = item.split("=", 1)
+            params[key] = value
+    return params
+
+# ----- WINDOWED TRANSFER ----- #
+
+#Selective-repeat ARQ. The sender keeps up to `win` frames in flight past the receiver's base,
+#the receiver periodically answers with a status frame: the lowest sequence number it is still
+#missing (everything below it is done) followed by the other missing numbers it has noticed.
+#The sender drops everything below the base, resends only the listed frames and keeps streaming.
+
+ACK_STATUS = struct.Struct(">IH")       #base, count of missing sequence numbers that follow
+ACK_MISSING = struct.Struct(">I")
+ACK_MAX_MISSING = 64                    #Keeps a status frame small even on a very lossy link
+STATUS_HURRY = 0.25                     #Shortest gap between statuses sent early for a damaged frame or a sequence gap
+STATUS_INTERVAL = 1.0                   #Longest gap between statuses, repeats one that may have been lost
+
+def pack_ack(base, missing):
+    missing = missing[:ACK_MAX_MISSING]
+    return ACK_STATUS.pack(base, len(missing)) + b"".join(ACK_MISSING.pack(seq) for seq in missing)
+
+def unpack_ack(body):                                               #Returns (base, [missing seqs])
+    base, count = ACK_STATUS.unpack(body[:ACK_STATUS.size])
+    missing = []
+    for i in range(count):
+        start = ACK_STATUS.size + i*ACK_MISSING.size
+        missing.append(ACK_MISSING.unpack(body[start:start + ACK_MISSING.size])[0])
+    return (base, missing)
+
+class WindowReceiver:                                               #Bookkeeping for the receiving end, the caller does the serial I/O
+    def __init__(self, window):
+        self.window = max(1, window)
+        self.base = 0                   #Lowest sequence number not yet received
+        self.highest = -1               #Highest sequence number seen so far
+        self.last = None                #Sequence number of the FRAME_LAST frame once it shows up
+        self.early = set()              #Received frames above the base (out of order)
+        self.pending = 0                #New frames accepted since the last status went out
+        self.sent = time.time()         #When the last status went out, the request that started the transfer counts as one
+
+    def accept(self, seq, flags):                                   #Returns True if the frame is new and should be kept
+        if ((seq < self.base) or (seq in self.early)):
+            return False
+        self.early.add(seq)
+        self.highest = max(self.highest, seq)
+        if (flags & FRAME_LAST):
+            self.last = seq
+        while (self.base in self.early):
+            self.early.remove(self.base)
+            self.base += 1
+        self.pending += 1
+        return True
+
+    def missing(self):
+        return [seq for seq in range(self.base, self.highest + 1) if seq not in self.early][:ACK_MAX_MISSING]
+
+    def due(self):                                                  #Status every half window keeps the sender from stalling on a full window
+        return self.pending >= max(1, self.window // 2)
+
+    def gap(self, seq):                                             #True if seq skips past frames that never showed up
+        return seq > self.highest + 1
+
+    def hurry(self):                                                #A damaged frame or a gap was just seen, True if a status may go out now instead of at due()
+        return time.time() - self.sent >= STATUS_HURRY
+
+    def stale(self):                                                #True once a status is owed on the timer, however busy the link is with other frames
+        return time.time() - self.sent >= STATUS_INTERVAL
+
+    def complete(self):
+        return (self.last is not None) and (self.base > self.last)
+
+    def status(self):
+        self.pending = 0
+        self.sent = time.time()
+        return pack_ack(self.base, self.missing())
+
+# ----- ADAPTIVE CHUNK SIZE ----- #
+
+#The receiver measures how many frames fail and how many useful bytes per second get through at the
+#current frame size, then asks the sender for bigger frames on a clean link (less per-frame overhead)
+#or smaller ones on a noisy link (less to resend per error). Goodput seen at each size is remembered
+#for a while so the sizer doesn't keep stepping back up into a size that already did worse.
+
+CHUNK_PERIOD = 16                       #Frames measured before each decision
+CHUNK_FAIL_HIGH = 0.15                  #Shrink above this failure rate
+CHUNK_FAIL_LOW = 0.02                   #Grow below this failure rate
+CHUNK_MEMORY = 60.0                     #Seconds a goodput measurement stays trusted
+
+class ChunkSizer:
+    def __init__(self, size, smallest = 256, largest = 8192):
+        self.smallest = smallest
+        self.largest = largest
+        self.size = min(max(size, smallest), largest)
+        self.goodput = {}               #size -> (bytes per second, when measured)
+        self.reset()
+
+    def reset(self):
+        self.good = 0
+        self.bad = 0
+        self.bytes = 0
+        self.start = time.time()
+
+    def record(self, ok, length = 0):
+        if ok:
+            self.good += 1
+            self.bytes += length
+        else:
+            self.bad += 1
+
+    def measured(self, size, now):
+        if ((size in self.goodput) and (now - self.goodput[size][1] < CHUNK_MEMORY)):
+            return self.goodput[size][0]
+        return None
+
+    def decide(self):                                               #Returns (new size, reason) once a period is measured and a change is worth it, else None
+        frames = self.good + self.bad
+        if (frames < CHUNK_PERIOD):
+            return None
+        now = time.time()
+        rate = float(self.bad) / frames
+        goodput = self.bytes / max(now - self.start, 0.001)
+        self.goodput[self.size] = (goodput, now)
+        self.reset()
+        smaller = max(self.smallest, self.size // 2)
+        bigger = min(self.largest, self.size * 2)
+        change = None
+        if ((rate > CHUNK_FAIL_HIGH) and (smaller < self.size)):
+            change = (smaller, "{:.0f}% of frames failed".format(rate*100))
+        elif ((rate < CHUNK_FAIL_LOW) and (bigger > self.size)):
+            before = self.measured(bigger, now)
+            if ((before is None) or (before > goodput)):
+                change = (bigger, "link clean, {:.0f}% of frames failed at {:.0f} B/s".format(rate*100, goodput))
+        else:
+            before = self.measured(smaller, now)
+            if ((before is not None) and (before > goodput*1.05) and (smaller < self.size)):
+                change = (smaller, "goodput {:.0f} B/s was better than {:.0f} B/s".format(before, goodput))
+        if (change is not None):
+            self.size = change[0]
+        return change
+
+# ----- FORWARD ERROR CORRECTION ----- #
+
+#Systematic Reed-Solomon over GF(256) (primitive polynomial 0x11d, generator 2). A frame body is cut into
+#blocks of 255-nsym data bytes and each block is followed by nsym parity bytes, which repairs up to nsym/2
+#corrupted bytes per block. The frame CRC still covers the coded body, so the receiver only runs the
+#(slow, pure python) decoder on frames that fail their CRC, and re-checks the CRC after the repair.
+
+class FECError(Exception):
+    pass
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if (_x & 0x100):
+        _x ^= 0x11d
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+def gf_mul(x, y):
+    if ((x == 0) or (y == 0)):
+        return 0
+    return GF_EXP[GF_LOG[x] + GF_LOG[y]]
+
+def gf_div(x, y):
+    if (y == 0):
+        raise ZeroDivisionError()
+    if (x == 0):
+        return 0
+    return GF_EXP[(GF_LOG[x] + 255 - GF_LOG[y]) % 255]
+
+def gf_pow(x, power):
+    return GF_EXP[(GF_LOG[x] * power) % 255]
+
+def gf_inverse(x):
+    return GF_EXP[255 - GF_LOG[x]]
+
+def gf_poly_scale(p, x):
+    return [gf_mul(coef, x) for coef in p]
+
+def gf_poly_add(p, q):
+    r = [0] * max(len(p), len(q))
+    for i in range(len(p)):
+        r[i + len(r) - len(p)] = p[i]
+    for i in range(len(q)):
+        r[i + len(r) - len(q)] ^= q[i]
+    return r
+
+def gf_poly_mul(p, q):
+    r = [0] * (len(p) + len(q) - 1)
+    for j in range(len(q)):
+        for i in range(len(p)):
+            r[i + j] ^= gf_mul(p[i], q[j])
+    return r
+
+def gf_poly_eval(poly, x):                                          #Horner's method
+    y = poly[0]
+    for coef in poly[1:]:
+        y = gf_mul(y, x) ^ coef
+    return y
+
+def gf_poly_div(dividend, divisor):                                 #Returns (quotient, remainder), divisor must be monic
+    out = list(dividend)
+    for i in range(len(dividend) - (len(divisor) - 1)):
+        coef = out[i]
+        if (coef != 0):
+            for j in range(1, len(divisor)):
+                if (divisor[j] != 0):
+                    out[i + j] ^= gf_mul(divisor[j], coef)
+    separator = -(len(divisor) - 1)
+    return (out[:separator], out[separator:])
+
+_generators = {}
+
+def rs_generator(nsym):
+    if (nsym not in _generators):
+        g = [1]
+        for i in range(nsym):
+            g = gf_poly_mul(g, [1, gf_pow(2, i)])
+        _generators[nsym] = g
+    return _generators[nsym]
+
+def rs_parity(block, nsym):                                         #block is a list of ints, returns the nsym parity ints
+    gen = rs_generator(nsym)
+    out = list(block) + [0] * nsym
+    for i in range(len(block)):
+        coef = out[i]
+        if (coef != 0):
+            for j in range(1, len(gen)):
+                out[i + j] ^= gf_mul(gen[j], coef)
+    return out[len(block):]
+
+def rs_syndromes(block, nsym):
+    return [0] + [gf_poly_eval(block, gf_pow(2, i)) for i in range(nsym)]
+
+def rs_error_locator(synd, nsym):                                   #Berlekamp-Massey
+    err_loc = [1]
+    old_loc = [1]
+    shift = len(synd) - nsym
+    for i in range(nsym):
+        k = i + shift
+        delta = synd[k]
+        for j in range(1, len(err_loc)):
+            delta ^= gf_mul(err_loc[-(j + 1)], synd[k - j])
+        old_loc = old_loc + [0]
+        if (delta != 0):
+            if (len(old_loc) > len(err_loc)):
+                new_loc = gf_poly_scale(old_loc, delta)
+                old_loc = gf_poly_scale(err_loc, gf_inverse(delta))
+                err_loc = new_loc
+            err_loc = gf_poly_add(err_loc, gf_poly_scale(old_loc, delta))
+    while (len(err_loc) and (err_loc[0] == 0)):
+        del err_loc[0]
+    if ((len(err_loc) - 1) * 2 > nsym):
+        raise FECError("too many errors to correct")
+    return err_loc
+
+def rs_error_positions(err_loc, length):                            #Chien search
+    positions = []
+    for i in range(length):
+        if (gf_poly_eval(err_loc, gf_pow(2, i)) == 0):
+            positions.append(length - 1 - i)
+    if (len(positions) != len(err_loc) - 1):
+        raise FECError("error locator doesn't match the block")
+    return positions
+
+def rs_correct_errata(block, synd, positions):                      #Forney
+    coef_pos = [len(block) - 1 - p for p in positions]
+    err_loc = [1]
+    for i in coef_pos:
+        err_loc = gf_poly_mul(err_loc, gf_poly_add([1], [gf_pow(2, i), 0]))
+    rsynd = synd[::-1]
+    remainder = gf_poly_div(gf_poly_mul(rsynd, err_loc), [1] + [0] * len(err_loc))[1]
+    err_eval = remainder[::-1]
+    X = [gf_pow(2, -(255 - p)) for p in coef_pos]
+    E = [0] * len(block)
+    for i, Xi in enumerate(X):
+        Xi_inv = gf_inverse(Xi)
+        err_loc_prime = 1
+        for j in range(len(X)):
+            if (j != i):
+                err_loc_prime = gf_mul(err_loc_prime, 1 ^ gf_mul(Xi_inv, X[j]))
+        y = gf_mul(Xi, gf_poly_eval(err_eval[::-1], Xi_inv))
+        E[positions[i]] = gf_div(y, err_loc_prime)
+    return gf_poly_add(block, E)
+
+def rs_correct(block, nsym):                                        #Returns (corrected block, bytes fixed), raises FECError when beyond repair
+    synd = rs_syndromes(block, nsym)
+    if (max(synd) == 0):
+        return (block, 0)
+    err_loc = rs_error_locator(synd, nsym)
+    positions = rs_error_positions(err_loc[::-1], len(block))
+    fixed = rs_correct_errata(block, synd, positions)
+    if (max(rs_syndromes(fixed, nsym)) != 0):
+        raise FECError("could not correct block")
+    return (fixed, len(positions))
+
+def fec_encode(data, nsym):                                         #Data bytes -> coded body
+    if (nsym == 0):
+        return data
+    step = 255 - nsym
+    coded = bytearray()
+    for start in range(0, len(data), step):
+        block = bytearray(data[start:start + step])
+        coded += block
+        coded += bytearray(rs_parity(list(block), nsym))
+    return bytes(coded)
+
+def fec_strip(body, nsym):                                          #Coded body that already passed its CRC -> data bytes
+    if (nsym == 0):
+        return body
+    return b"".join(body[start:start + 255][:-nsym] for start in range(0, len(body), 255))
+
+def fec_repair(body, nsym):                                         #Returns (repaired coded body, bytes fixed), raises FECError
+    repaired = bytearray()
+    total = 0
+    for start in range(0, len(body), 255):
+        block, fixed = rs_correct(list(bytearray(body[start:start + 255])), nsym)
+        repaired += bytearray(block)
+        total += fixed
+    return (bytes(repaired), total)
+
+# ----- BUFFERED SERIAL READER ----- #
+
+class SerialReader(object):
+    #Wraps a pyserial port so every read is served from one buffer that is refilled with whatever the port already
+    #holds, instead of one read() call (and one system call) per byte. Plain read()/readline() keep pyserial's
+    #meaning, read_exact/read_until/find take an optional timeout in seconds (the port's own timeout otherwise).
+    #received/sent count every byte that crossed the port, for measuring what a transfer cost on the air.
+
+    def __init__(self, port):
+        self.port = port
+        self.timeout = port.timeout
+        self.buffer = bytearray()
+        self.received = 0
+        self.sent = 0
+
+    def waiting(self):                                              #Bytes the port holds that we haven't pulled in yet
+        if hasattr(self.port, "in_waiting"):
+            return self.port.in_waiting
+        return self.port.inWaiting()                                #pyserial 2.x
+
+    def fill(self, deadline):                                       #Pulls in at least one byte, False once the deadline passes with nothing new
+        waiting = self.waiting()
+        if (waiting == 0):
+            data = b""
+            while (len(data) == 0):                                 #An empty read is the port's own timeout, which can come before our deadline
+                remaining = deadline - time.time()
+                if (remaining <= 0):
+                    return False
+                if (remaining < self.timeout):
+                    self.port.timeout = remaining
+                try:
+                    data = self.port.read(1)                        #Blocks in the driver, no polling
+                finally:
+                    if (self.port.timeout != self.timeout):
+                        self.port.timeout = self.timeout
+            self.buffer += data
+            self.received += len(data)
+            waiting = self.waiting()
+        if (waiting > 0):
+            data = self.port.read(waiting)
+            self.buffer += data
+            self.received += len(data)
+        return True
+
+    def take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def deadline(self, timeout):
+        if (timeout is None):
+            timeout = self.timeout
+        return time.time() + timeout
+
+    def read_exact(self, size, timeout = None):                     #size bytes, fewer only if the deadline passes first
+        deadline = self.deadline(timeout)
+        while (len(self.buffer) < size):
+            if (self.fill(deadline) == False):
+                break
+        return self.take(min(size, len(self.buffer)))
+
+    def read_until(self, delimiter, timeout = None):                #Everything up to and including delimiter, or whatever arrived before the deadline
+        deadline = self.deadline(timeout)
+        start = 0
+        while True:
+            found = self.buffer.find(delimiter, start)
+            if (found >= 0):
+                return self.take(found + len(delimiter))
+            start = max(0, len(self.buffer) - len(delimiter) + 1)   #Only rescan the bytes that could still start a match
+            if (self.fill(deadline) == False):
+                return self.take(len(self.buffer))
+
+    def find(self, marker, timeout = None):                         #Drops everything up to and including marker, False if it never showed up
+        deadline = self.deadline(timeout)
+        while True:
+            found = self.buffer.find(marker)
+            if (found >= 0):
+                del self.buffer[:found + len(marker)]
+                return True
+            del self.buffer[:max(0, len(self.buffer) - len(marker) + 1)]    #Keep a tail that might be the start of the marker
+            if (self.fill(deadline) == False):
+                return False
+
+    def unread(self, data):                                         #Puts bytes back in front of the buffer
+        self.buffer[:0] = data
+
+    def read(self, size = 1):
+        return self.read_exact(size)
+
+    def readline(self):
+        return self.read_until(b"\n")
+
+    def inWaiting(self):
+        return len(self.buffer) + self.waiting()
+
+    def write(self, data):
+        self.sent += len(data)
+        return self.port.write(data)
+
+    def flushInput(self):
+        del self.buffer[:]
+        self.port.flushInput()
+
+    def flushOutput(self):
+        self.port.flushOutput()
+
+    def close(self):
+        self.port.close()
+
+# ----- FRAME READING ----- #
+
+def read_frame(ser, lead, fec = 0):                                 #Rest of a frame whose magic is already in lead: (flags, seq, offset, body, wire bytes, bytes corrected)
+    header = lead + ser.read_exact(FRAME_HEADER.size - len(lead))   #body is None when the frame is damaged beyond repair, the whole result None when its header can't be trusted
+    fields = unpack_header(header)
+    if (fields is None):
+        return None
+    flags, seq, offset, length = fields
+    body = ser.read_exact(length)
+    crc = ser.read_exact(FRAME_CRC.size)
+    wire = len(header) + len(body) + len(crc)
+    if (len(body) != length):
+        return (flags, seq, offset, None, wire, 0)
+    if ((flags & FRAME_FEC) and (fec == 0)):                        #Parity we never negotiated, can't tell data from parity
+        return (flags, seq, offset, None, wire, 0)
+    fixed = 0
+    if (check_frame(header, body, crc) == False):
+        if ((flags & FRAME_FEC) == 0):
+            return (flags, seq, offset, None, wire, 0)
+        try:
+            body, fixed = fec_repair(body, fec)                     #Only damaged frames pay for the decoder
+        except FECError:
+            return (flags, seq, offset, None, wire, 0)
+        if (check_frame(header, body, crc) == False):               #The CRC has the last word, a miscorrection is still a lost frame
+            return (flags, seq, offset, None, wire, 0)
+    if (flags & FRAME_FEC):
+        body = fec_strip(body, fec)
+    return (flags, seq, offset, body, wire, fixed)
+
+# ----- COMMANDS ----- #
+
+#Every command is a single byte the payload answers with 'A'. Payloads that report "req" also take a command as a
+#control frame "cmd=<byte>" whose seq is a request ID, and answer with a control frame "ack=<byte>" carrying the same
+#ID, so neither a stray 'A' in leftover image data nor the late answer to an earlier command passes as the acknowledge.
+#send_command() drops whatever input is left over, waits COMMAND_BACKOFF for the acknowledge, then resends with the
+#wait doubled each time up to COMMAND_BACKOFF_MAX until the deadline, instead of writing the command again after every
+#unexpected byte. A plain byte command starts at the port timeout instead: a slow 'A' can't be told from the answer to
+#a resend, and every resend is another run of the command that leaves an extra 'A' behind.
+
+COMMAND_DEADLINE = 10.0                 #Seconds before a command is given up
+COMMAND_BACKOFF = 0.5                   #Wait for the first acknowledge, comfortably above a round trip at 38400 baud
+COMMAND_BACKOFF_MAX = 4.0
+
+class CommandTimeout(IOError):
+    pass
+
+def pack_command(rid, code):
+    return pack_frame(rid, encode_params({"cmd": code}).encode("ascii"), FRAME_CTRL)
+
+def pack_acknowledge(rid, code):
+    return pack_frame(rid, encode_params({"ack": code}).encode("ascii"), FRAME_CTRL)
+
+def wait_acknowledge(ser, code, rid = None, timeout = COMMAND_DEADLINE):    #True once the acknowledge arrives, whatever came before it is dropped
+    if (rid is None):
+        return ser.find(b"A", timeout)
+    deadline = time.time() + timeout
+    while ser.find(FRAME_MAGIC, max(0.0, deadline - time.time())):
+        header = FRAME_MAGIC + ser.read_exact(FRAME_HEADER.size - len(FRAME_MAGIC))
+        fields = unpack_header(header)
+        if (fields is None):
+            continue
+        flags, seq, offset, length = fields
+        body = ser.read_exact(length)
+        if (check_frame(header, body, ser.read_exact(FRAME_CRC.size)) and (flags & FRAME_CTRL) and (seq == rid)):
+            if (decode_params(body.decode("ascii", "replace")).get("ack") == code):
+                return True
+    return False
+
+def send_command(ser, code, rid = None, timeout = COMMAND_DEADLINE, retry = None):  #Attempts it took, raises CommandTimeout. retry(attempt) is called before each resend
+    deadline = time.time() + timeout
+    wait = COMMAND_BACKOFF
+    if (rid is None):
+        wait = max(wait, ser.timeout or 0.0)                        #No quicker than the original single read timeout
+    attempt = 1
+    ser.flushInput()                                                #An acknowledge still on its way from an earlier command is dropped here
+    while True:
+        if (rid is None):
+            ser.write(code)
+        else:
+            ser.write(pack_command(rid, code))
+        if wait_acknowledge(ser, code, rid, max(0.0, min(wait, deadline - time.time()))):
+            return attempt
+        if (time.time() >= deadline):
+            raise CommandTimeout("no acknowledge for {!r} in {:.0f} s".format(code, timeout))
+        attempt += 1
+        wait = min(wait * 2, COMMAND_BACKOFF_MAX)
+        if (retry is not None):
+            retry(attempt)
+
+# ----- GPS RECORD ----- #
+
+#The payload's position rides in a fixed 35 byte slot (GPSLength) of every image frame and of the 'G' reply.
+#Upgraded payloads fill it with a packed record, older ones with text, so decode_gps() accepts either:
+#   magic (2) | epoch seconds (4) | milliseconds (2) | lat (4) | lon (4) | alt (4) | fix (1) | sats (1) | crc16 (2) | zero padding
+#lat/lon are degrees * 1e7 and alt is centimetres, all signed.
+
+GPS_MAGIC = b"\xa7\x47"
+GPS_RECORD = struct.Struct(">2sIHiiiBB")
+GPS_CHECK = struct.Struct(">H")
+GPS_SLOT = 35
+
+GPS_FIX_NONE = 0
+GPS_FIX_2D = 2
+GPS_FIX_3D = 3
+GPS_FIX_PREDICTED = 4                   #Not a receiver fix, extrapolated by the ground station for the antenna tracker
+
+_number = re.compile(r"[-+]?\d+(?:\.\d+)?")
+
+def pack_gps(stamp, lat, lon, alt, fix = GPS_FIX_3D, sats = 0):     #Payload side, returns the full slot
+    seconds = int(stamp)
+    record = GPS_RECORD.pack(GPS_MAGIC, seconds, int((stamp - seconds) * 1000), int(round(lat * 1e7)), int(round(lon * 1e7)), int(round(alt * 100)), fix, sats)
+    record += GPS_CHECK.pack(zlib.crc32(record) & 0xffff)
+    return record.ljust(GPS_SLOT, b"\x00")
+
+def unpack_gps(data):                                               #Packed record -> fix dict, None if it is damaged
+    size = GPS_RECORD.size + GPS_CHECK.size
+    if (len(data) < size):
+        return None
+    record = data[:GPS_RECORD.size]
+    if (GPS_CHECK.unpack(data[GPS_RECORD.size:size])[0] != (zlib.crc32(record) & 0xffff)):
+        return None
+    magic, seconds, millis, lat, lon, alt, fix, sats = GPS_RECORD.unpack(record)
+    return {"time": seconds + millis / 1000.0, "lat": lat / 1e7, "lon": lon / 1e7, "alt": alt / 100.0, "fix": fix, "sats": sats}
+
+def parse_gps_text(data):                                           #Older payloads send text, the first three numbers are taken as lat, lon, alt
+    if isinstance(data, bytes):
+        data = data.decode("ascii", "replace")                      #Slots come off the port as bytes, the pattern is text
+    numbers = [float(n) for n in _number.findall(data)]
+    if (len(numbers) < 3):
+        return None
+    lat, lon, alt = numbers[:3]
+    if ((abs(lat) > 90) or (abs(lon) > 180)):
+        return None
+    return {"time": None, "lat": lat, "lon": lon, "alt": alt, "fix": None, "sats": None}
+
+def format_gps_text(lat, lon, alt):                                 #Text slot in the form older payloads send, padded like theirs
+    return "{:.6f},{:.6f},{:.1f}".format(lat, lon, alt).ljust(GPS_SLOT)[:GPS_SLOT].encode("ascii")
+
+def decode_gps(data):                                               #Either form -> fix dict, None if nothing usable
+    if (data.startswith(GPS_MAGIC)):
+        return unpack_gps(data)
+    return parse_gps_text(data)
+
+# ----- LOGICAL CHANNELS ----- #
+
+#One radio link carries three logical channels, told apart by their frame flags:
+#   telemetry  FRAME_TELEM frames with the payload's position, on a clock of their own
+#   control    FRAME_CTRL / FRAME_ACK frames (requests, transfer headers, window status)
+#   bulk       image data frames
+#The sending end queues frames per channel and always sends the most urgent one next, pacing the port to the link
+#rate so nothing piles up in buffers below it. A telemetry frame that comes due therefore waits for at most the
+#bulk frame already on the air, and position updates keep flowing through a long download without a GPS slot in
+#every image frame.
+
+CHANNEL_TELEMETRY = 0
+CHANNEL_CONTROL = 1
+CHANNEL_BULK = 2
+
+RESEND_HOLDOFF = 0.5                    #A frame isn't resent until this long after its last copy went out, a status older than that can't know about it
+
+class ChannelMux(object):                                           #Sending end, frames wait here per channel and one writer thread hands them to the port
+    def __init__(self, port, rate = 0):
+        self.port = port
+        self.rate = rate                                            #Link bytes per second, 0 writes as fast as the port takes them
+        self.queues = [collections.deque() for channel in (CHANNEL_TELEMETRY, CHANNEL_CONTROL, CHANNEL_BULK)]
+        self.interval = None
+        self.source = None
+        self.due = 0.0
+        self.busy = False                                           #A frame is being written outside the lock
+        self.queued = collections.Counter()                         #key -> copies waiting in the queues
+        self.finished = {}                                          #key -> when that frame was last fully sent
+        self.ready = threading.Condition()
+        thread = threading.Thread(target = self.run, name = "channel mux")
+        thread.daemon = True
+        thread.start()
+
+    def send(self, channel, frame, key = None):                     #key (e.g. the sequence number) lets written() tell when the frame went out
+        with self.ready:
+            self.queues[channel].append((frame, key))
+            if (key is not None):
+                self.queued[key] += 1
+            self.ready.notify_all()
+
+    def written(self, key):                                         #When the frame sent with key was last fully sent, None while a copy is still queued, 0 if never
+        with self.ready:
+            if (self.queued[key] > 0):
+                return None
+            return self.finished.get(key, 0.0)
+
+    def resendable(self, key):                                      #No copy queued and the last one has had time to arrive and be reported
+        written = self.written(key)
+        return (written is not None) and (time.time() - written >= RESEND_HOLDOFF)
+
+    def telemetry(self, interval, source = None):                   #source() returns a telemetry frame, sent every interval seconds until interval is None
+        with self.ready:
+            self.interval = interval
+            self.source = source
+            self.due = time.time()
+            self.ready.notify_all()
+
+    def clear(self, channel):                                       #Drops what a channel still has queued, e.g. the rest of an aborted transfer
+        with self.ready:
+            for frame, key in self.queues[channel]:
+                if (key is not None):
+                    self.queued[key] -= 1
+            self.queues[channel].clear()
+
+    def drain(self, timeout = 30.0):                                #Waits until everything queued has been written, so direct port writes can follow
+        deadline = time.time() + timeout
+        with self.ready:
+            while ((self.busy or any(self.queues)) and (time.time() < deadline)):
+                self.ready.wait(deadline - time.time())
+
+    def pending(self):                                              #Lock held, the next frame to send or None
+        if ((self.interval is not None) and (time.time() >= self.due)):
+            self.due = time.time() + self.interval
+            return (self.source(), None)
+        for frames in self.queues:
+            if frames:
+                return frames.popleft()
+        return None
+
+    def run(self):
+        while True:
+            with self.ready:
+                item = self.pending()
+                while (item is None):
+                    wait = None
+                    if (self.interval is not None):
+                        wait = max(0.0, self.due - time.time())
+                    self.ready.wait(wait)
+                    item = self.pending()
+                self.busy = True
+            frame, key = item
+            self.port.write(frame)
+            if (self.rate > 0):
+                time.sleep(len(frame) / float(self.rate))           #Paced, so the next choice is made when the link is actually free
+            with self.ready:
+                self.busy = False
+                if (key is not None):
+                    self.queued[key] -= 1
+                    self.finished[key] = time.time()
+                self.ready.notify_all()
+
+# ----- LAYERED IMAGES ----- #
+
+#A layered transfer sends one image as a residual pyramid, one windowed transfer per layer ("layer=k,layers=n").
+#Layer 0 is the image shrunk to layer_size(full, 0, n). Every later layer k is a PNG of
+#   (image at layer_size(full, k, n) - previous layer scaled up with nearest neighbour + LAYER_OFFSET) mod 256
+#per channel, so adding it to what the receiver already has rebuilds that size exactly and the last layer is the
+#full image pixel for pixel. Nearest neighbour is used because it scales to the same pixels in every PIL version,
+#the two ends have to agree on the prediction to the bit.
+
+LAYER_OFFSET = 128                      #Keeps small residuals away from the 0/255 wrap so the PNG compresses
+
+def layer_size(full, level, count):                                 #(width, height) of layer level out of count, the last one is full
+    scale = 2 ** (count - 1 - level)
+    return (-(-full[0] // scale), -(-full[1] // scale))
@@ -0,0 +1,113 @@
+#RFD900 Track Prediction
+#...Real fixes only arrive once per image frame or GPS ping, seconds apart, so the antenna trails a fast climbing or
+#...falling balloon. Between fixes the recent track is fitted with a constant velocity (or, with enough fixes, constant
+#...acceleration) model and the position it predicts for "now" is published PREDICT_RATE times a second
+#...Kept free of serial/GUI state so the ground station and the tests can both import it
+
+import collections
+import threading
+import time
+from RFD900_Protocol import GPS_FIX_PREDICTED, format_gps_text, pack_gps
+
+PREDICT_RATE = 10.0                         #Predicted positions per second
+PREDICT_HISTORY = 12                        #Most recent fixes the model is fitted to
+PREDICT_WINDOW = 120.0                      #Fixes older than this many seconds are left out of the fit
+PREDICT_HORIZON = 30.0                      #Never extrapolate further than this past the last real fix, the servo just holds
+PREDICT_QUADRATIC = 5                       #Fixes needed before acceleration is fitted too
+PREDICT_ACCELERATION = 5.0                  #Seconds past the last fix the acceleration term is trusted, after that the velocity it reached carries on
+
+def solve_linear(matrix, columns):                                  #Gauss-Jordan with partial pivoting, one elimination for every right hand side
+    size = len(matrix)
+    rows = [list(matrix[i]) + [column[i] for column in columns] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key = lambda r: abs(rows[r][col]))
+        if (abs(rows[pivot][col]) < 1e-9):
+            return None
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(size):
+            if ((r != col) and (rows[r][col] != 0.0)):
+                factor = rows[r][col] / rows[col][col]
+                rows[r] = [a - factor * b for a, b in zip(rows[r], rows[col])]
+    return [[rows[i][size + c] / rows[i][i] for i in range(size)] for c in range(len(columns))]
+
+def fit_track(points, degree):                                      #Least squares polynomial in t for lat, lon and alt together, points are (t, lat, lon, alt)
+    size = degree + 1
+    sums = [0.0] * (2 * degree + 1)
+    columns = [[0.0] * size for axis in range(3)]
+    for point in points:
+        powers = [point[0] ** k for k in range(2 * degree + 1)]
+        for k in range(len(sums)):
+            sums[k] += powers[k]
+        for axis in range(3):
+            for k in range(size):
+                columns[axis][k] += powers[k] * point[axis + 1]
+    return solve_linear([sums[i:i + size] for i in range(size)], columns)
+
+def extrapolate(coefficients, t):                                   #One axis of a fit at t, a noisy acceleration term only bends the first PREDICT_ACCELERATION seconds
+    bend = min(t, PREDICT_ACCELERATION)
+    value = sum(c * bend ** k for k, c in enumerate(coefficients))
+    slope = sum(k * c * bend ** (k - 1) for k, c in enumerate(coefficients) if (k > 0))
+    return value + slope * (t - bend)
+
+class TrackPredictor(threading.Thread):
+    def __init__(self, publish):                                    #publish(slot) gets every prediction, in the same form as the payload's own slots
+        threading.Thread.__init__(self, name = "track predictor")
+        self.daemon = True
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.points = collections.deque(maxlen = PREDICT_HISTORY)
+        self.model = None                                           #(time of last fix, coefficients per axis), t in the fit is relative to that fix
+        self.offset = 0.0                                           #Payload clock minus ground clock, 0 for payloads that don't send time
+        self.text = False                                           #The payload sends text fixes, predictions go out as text too
+        self.enabled = False                                        #Set from the GUI
+        self.halt = threading.Event()
+
+    def add(self, fix, received):                                   #Any thread, refits on every real fix
+        stamp = fix["time"]
+        self.text = (stamp is None)                                 #Only text fixes come without a time
+        if (stamp is None):
+            stamp = received
+        with self.lock:
+            self.offset = stamp - received
+            if ((len(self.points) > 0) and (stamp <= self.points[-1][0])):
+                return                                              #Repeat of a fix we have (a resent frame), or out of order
+            self.points.append((stamp, fix["lat"], fix["lon"], fix["alt"]))
+            recent = [point for point in self.points if (stamp - point[0] <= PREDICT_WINDOW)]
+        relative = [(point[0] - stamp,) + point[1:] for point in recent]
+        model = None
+        if (len(relative) >= PREDICT_QUADRATIC):
+            model = fit_track(relative, 2)
+        if ((model is None) and (len(relative) >= 2)):
+            model = fit_track(relative, 1)
+        with self.lock:
+            if (model is None):
+                self.model = None
+            else:
+                self.model = (stamp, model)
+
+    def predict(self, now):                                         #(lat, lon, alt) for payload time now, None if there is no model or it is too far out
+        with self.lock:
+            model = self.model
+        if (model is None):
+            return None
+        t = now - model[0]
+        if ((t < 0) or (t > PREDICT_HORIZON)):
+            return None
+        return tuple([extrapolate(axis, t) for axis in model[1]])
+
+    def slot(self, now, position):                                  #The servo tracker gets one format for real and predicted fixes alike
+        if self.text:
+            return format_gps_text(position[0], position[1], position[2])
+        return pack_gps(now, position[0], position[1], position[2], GPS_FIX_PREDICTED)
+
+    def run(self):
+        while (self.halt.wait(1.0 / PREDICT_RATE) == False):        #Event.wait() returns the flag on python 2.7
+            if (self.enabled == False):
+                continue
+            now = time.time() + self.offset
+            position = self.predict(now)
+            if (position is not None):
+                self.publish(self.slot(now, position))
+
+    def stop(self):
+        self.halt.set()
@@ -0,0 +1,236 @@
+#RFD900 Session Archive
+#...Indexes every SESSIONS/Session_*/ directory (images, GPS track, event log) into one SQLite catalog
+#...Incremental: each run only reads what was added since the last one, so the ground station can keep
+#...its live session indexed while it runs and the query commands stay fast across dozens of flights
+
+#Usage:
+#   python SessionArchive.py index                                  index everything new under SESSIONS/
+#   python SessionArchive.py sessions                               list flights
+#   python SessionArchive.py images --min-alt 20000                 images taken above 20 km
+#   python SessionArchive.py events --match "Packet Failure" --last packet failures in the last flight
+#   python SessionArchive.py track --session Session_2019-04-06-10-31-02
+#   python SessionArchive.py sql "SELECT count(*) FROM fixes"
+#Every query command indexes first unless --no-index is given
+
+import argparse
+import datetime
+import glob
+import os
+import re
+import sqlite3
+import sys
+import time
+
+ARCHIVE_NAME = "archive.sqlite"
+IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".webp")
+
+#"<date> (aka <epoch> UTC Epoch) -- <message>", critical errors are wrapped in "--- ... ---" and followed by a traceback
+EVENT_LINE = re.compile(r"^(?:--- )?\d{4}-\d\d-\d\d \d\d:\d\d:\d\d \(aka ([0-9.]+) UTC Epoch\) -- (.*?)(?: ---)?$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (name TEXT PRIMARY KEY, started REAL, directory TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, position INTEGER);
+CREATE TABLE IF NOT EXISTS events (session TEXT, stamp REAL, level TEXT, message TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS events_unique ON events (session, stamp, message);
+CREATE INDEX IF NOT EXISTS events_level ON events (level, stamp);
+CREATE TABLE IF NOT EXISTS fixes (session TEXT, received REAL, time REAL, lat REAL, lon REAL, alt REAL, fix INTEGER, sats INTEGER, source TEXT);
+CREATE INDEX IF NOT EXISTS fixes_session ON fixes (session, received);
+CREATE INDEX IF NOT EXISTS fixes_alt ON fixes (alt);
+CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, session TEXT, name TEXT, size INTEGER, mtime REAL, lat REAL, lon REAL, alt REAL);
+CREATE INDEX IF NOT EXISTS images_session ON images (session, mtime);
+CREATE INDEX IF NOT EXISTS images_alt ON images (alt);
+"""
+
+def event_level(message):
+    if message.startswith("CRITICAL ERROR"):
+        return "CRITICAL"
+    if message.startswith("ERROR"):
+        return "ERROR"
+    return "INFO"
+
+def session_start(name):                                            #Session_2019-04-06-10-31-02 -> epoch, None for anything else
+    try:
+        return time.mktime(datetime.datetime.strptime(name[len("Session_"):], "%Y-%m-%d-%H-%M-%S").timetuple())
+    except ValueError:
+        return None
+
+class Archive:
+    def __init__(self, root = "SESSIONS"):
+        self.root = root
+        self.db = sqlite3.connect(os.path.join(root, ARCHIVE_NAME), timeout = 30)  #The ground station and the CLI may both be indexing
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def position(self, path):
+        row = self.db.execute("SELECT position FROM files WHERE path = ?", (path,)).fetchone()
+        if (row is None):
+            return 0
+        return row[0]
+
+    def set_position(self, path, position):
+        self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?)", (path, position))
+
+    def index(self):                                                #Every session under the root, returns how many were looked at
+        directories = sorted(glob.glob(os.path.join(self.root, "Session_*")))
+        for directory in directories:
+            self.index_session(directory)
+        return len(directories)
+
+    def index_session(self, directory):
+        name = os.path.basename(os.path.normpath(directory))
+        self.db.execute("INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)", (name, session_start(name), directory))
+        self.index_events(name, directory)
+        self.index_fixes(name, directory)
+        self.index_images(name, directory)                          #After the fixes, images are placed from them
+        self.db.commit()
+
+    def index_events(self, session, directory):                     #Reads each event log from where the last run stopped, rotated parts included
+        for path in glob.glob(os.path.join(directory, "Event_Log_File_*.txt")):
+            position = self.position(path)
+            size = os.path.getsize(path)
+            if (size < position):                                   #The live log was rotated, what it held is now in a _part file
+                position = 0
+            if (size == position):
+                continue
+            with open(path, "rb") as logFile:
+                logFile.seek(position)
+                text = logFile.read()
+            end = text.rfind(b"\n") + 1                             #A line still being written is left for the next run
+            rows = []
+            for line in text[:end].decode("utf-8", "replace").split("\n"):   #Bytes keep the position exact, the pattern matches text
+                match = EVENT_LINE.match(line.strip())
+                if (match is not None):
+                    message = match.group(2)
+                    rows.append((session, float(match.group(1)), event_level(message), message))
+            self.db.executemany("INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?)", rows)     #A rotated part repeats lines already read from the live file
+            self.set_position(path, position + end)
+
+    def index_fixes(self, session, directory):                      #Copies the rows added to the session's GPS track since the last run
+        for path in glob.glob(os.path.join(directory, "GPS_Track_*.sqlite")):
+            last = self.position(path)
+            track = sqlite3.connect(path, timeout = 30)
+            try:
+                rows = track.execute("SELECT rowid, received, time, lat, lon, alt, fix, sats, source FROM fixes WHERE rowid > ? ORDER BY rowid", (last,)).fetchall()
+            except sqlite3.OperationalError:
+                rows = []                                           #The ground station hasn't created the table yet
+            track.close()
+            if (len(rows) == 0):
+                continue
+            self.db.executemany("INSERT INTO fixes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [(session,) + tuple(row[1:]) for row in rows])
+            self.set_position(path, rows[-1][0])
+
+    def nearest_fix(self, session, stamp):
+        before = self.db.execute("SELECT received, lat, lon, alt FROM fixes WHERE session = ? AND received <= ? ORDER BY received DESC LIMIT 1", (session, stamp)).fetchone()
+        after = self.db.execute("SELECT received, lat, lon, alt FROM fixes WHERE session = ? AND received > ? ORDER BY received LIMIT 1", (session, stamp)).fetchone()
+        if ((before is None) or ((after is not None) and (after[0] - stamp < stamp - before[0]))):
+            before = after
+        if (before is None):
+            return (None, None, None)
+        return before[1:]
+
+    def index_images(self, session, directory):                     #Each image is placed at the fix received closest to when it was saved
+        known = dict(self.db.execute("SELECT path, mtime FROM images WHERE session = ?", (session,)).fetchall())
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if ((os.path.splitext(name)[1].lower() not in IMAGE_TYPES) or (os.path.isfile(path) == False)):
+                continue
+            mtime = os.path.getmtime(path)
+            if (known.get(path) == mtime):
+                continue
+            lat, lon, alt = self.nearest_fix(session, mtime)
+            self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (path, session, name, os.path.getsize(path), mtime, lat, lon, alt))
+
+    def last_session(self):
+        row = self.db.execute("SELECT name FROM sessions ORDER BY started DESC, name DESC LIMIT 1").fetchone()
+        if (row is None):
+            return None
+        return row[0]
+
+# ----- QUERY COMMANDS ----- #
+
+def where(clauses):
+    if (len(clauses) == 0):
+        return ""
+    return " WHERE " + " AND ".join(clauses)
+
+def query_sessions(archive, args):
+    return archive.db.execute("SELECT s.name, (SELECT count(*) FROM images i WHERE i.session = s.name), (SELECT count(*) FROM fixes f WHERE f.session = s.name), "
+                              "(SELECT max(alt) FROM fixes f WHERE f.session = s.name), (SELECT count(*) FROM events e WHERE e.session = s.name AND e.level != 'INFO') "
+                              "FROM sessions s ORDER BY s.started, s.name").fetchall()
+
+def query_images(archive, args):
+    clauses, values = session_filter(archive, args)
+    if (args.min_alt is not None):
+        clauses.append("alt >= ?")
+        values.append(args.min_alt)
+    if (args.max_alt is not None):
+        clauses.append("alt <= ?")
+        values.append(args.max_alt)
+    return archive.db.execute("SELECT session, name, size, alt, lat, lon FROM images" + where(clauses) + " ORDER BY mtime", values).fetchall()
+
+def query_events(archive, args):
+    clauses, values = session_filter(archive, args)
+    if (args.level is not None):
+        clauses.append("level = ?")
+        values.append(args.level.upper())
+    if (args.match is not None):
+        clauses.append("message LIKE ?")
+        values.append("%" + args.match + "%")
+    return archive.db.execute("SELECT session, stamp, level, message FROM events" + where(clauses) + " ORDER BY stamp", values).fetchall()
+
+def query_track(archive, args):
+    clauses, values = session_filter(archive, args)
+    return archive.db.execute("SELECT session, received, lat, lon, alt, fix, source FROM fixes" + where(clauses) + " ORDER BY received", values).fetchall()
+
+def query_sql(archive, args):
+    return archive.db.execute(args.statement).fetchall()
+
+def session_filter(archive, args):
+    if args.last:
+        return (["session = ?"], [archive.last_session()])
+    if (args.session is not None):
+        return (["session = ?"], [args.session])
+    return ([], [])
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Search the ground station sessions")
+    parser.add_argument("--root", default = "SESSIONS", help = "directory holding the Session_* folders")
+    parser.add_argument("--no-index", action = "store_true", help = "query the catalog as it is, without indexing new data first")
+    commands = parser.add_subparsers(dest = "command")
+    commands.add_parser("index")
+    commands.add_parser("sessions").set_defaults(query = query_sessions)
+    for name, query in (("images", query_images), ("events", query_events), ("track", query_track)):
+        command = commands.add_parser(name)
+        command.set_defaults(query = query)
+        command.add_argument("--session", help = "only this session (folder name)")
+        command.add_argument("--last", action = "store_true", help = "only the most recent session")
+        if (name == "images"):
+            command.add_argument("--min-alt", type = float, help = "metres")
+            command.add_argument("--max-alt", type = float, help = "metres")
+        if (name == "events"):
+            command.add_argument("--match", help = "text the message contains")
+            command.add_argument("--level", help = "INFO, ERROR or CRITICAL")
+    command = commands.add_parser("sql")
+    command.set_defaults(query = query_sql)
+    command.add_argument("statement")
+    args = parser.parse_args(argv)
+
+    archive = Archive(args.root)
+    if ((args.command == "index") or (args.no_index == False)):
+        start = time.time()
+        count = archive.index()
+        if (args.command == "index"):
+            print("Indexed {} sessions in {:.2f} s".format(count, time.time() - start))
+    if (args.command != "index"):
+        start = time.time()
+        rows = args.query(archive, args)
+        for row in rows:
+            print("\t".join([str(value) for value in row]))
+        sys.stderr.write("{} rows in {:.3f} s\n".format(len(rows), time.time() - start))
+    archive.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,17 +1,293 @@
+#RFD900 Link Benchmark
+#...Measures the serial link to the payload and writes the results as JSON, one run per baud rate:
+#...   latency    'T' acknowledge time and ping round trips ('6' then 'P' echoes), as percentiles
+#...   transfers  windowed image transfers at each chunk size and transfer size: wire throughput, image goodput,
+#...              bad frames and resends (needs a payload that answers 'V' with win=...), or for older payloads one
+#...              transfer of the most recent image in the original base64 words
+#...Compare the JSON files between radio configurations and software versions
+
+#Usage:
+#   python TestSerialRT.py --port /dev/ttyS0 --bauds 38400,57600 --output radio_a.json
+#   python TestSerialRT.py --emulate "--ber 1e-5 --latency 0.1" --bauds 38400,115200
+#       starts PayloadEmulator.py at each baud rate with those options instead of opening a port
+#The radios (or the emulator) have to be set to each baud rate listed, the port is reopened at each one
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import subprocess
+import sys
 import time
 import serial
+from RFD900_Protocol import *
 
 port  = "/dev/ttyS0"
 baud = 38400
 timeout = 3
 
-ser = serial.Serial(port = port, baudrate = baud, timeout = timeout)
+WORD_LENGTH = 3000                      #Frame size the ground station starts at
+QUIET_LIMIT = 5                         #Timeouts in a row before a transfer is counted as failed
+RESEND_LIMIT = 5                        #Checksum failures in a row before a base64 word transfer is counted as failed, as in the ground station
+NAME_LENGTH = 15                        #Legacy file names come as exactly 15 characters
+
+# ----- MEASUREMENTS ----- #
+
+def percentiles(samples):                                           #Nearest rank, seconds
+    if (len(samples) == 0):
+        return {"samples": 0}
+    ordered = sorted(samples)
+    result = {"samples": len(ordered), "mean": sum(ordered) / len(ordered), "max": ordered[-1]}
+    for rank in (50, 90, 99):
+        result["p{}".format(rank)] = ordered[min(len(ordered) - 1, int(len(ordered) * rank / 100.0))]
+    return result
+
+def acknowledge(ser, command, wait = 10):                           #Seconds until the payload answers command with 'A', None if it never does
+    ser.flushInput()
+    start = time.time()
+    try:
+        send_command(ser, command, None, wait)                      #The plain byte, so payloads with and without request IDs are timed the same way
+    except CommandTimeout:
+        return None
+    return time.time() - start
+
+def time_ack(ser, count):                                           #The original test: 'T' and the payload's clock line
+    samples = []
+    lost = 0
+    for i in range(count):
+        taken = acknowledge(ser, "T")
+        if (taken is None):
+            lost += 1
+            continue
+        samples.append(taken)
+        ser.readline()
+    result = percentiles(samples)
+    result["lost"] = lost
+    return result
+
+def ping(ser, count):                                               #'P' round trips inside the payload's ping loop
+    if (acknowledge(ser, "6") is None):
+        return {"samples": 0, "lost": count}
+    samples = []
+    lost = 0
+    for i in range(count):
+        start = time.time()
+        ser.write("P")
+        if (ser.read_until("P").endswith("P")):
+            samples.append(time.time() - start)
+        else:
+            lost += 1
+    ser.write("D")
+    result = percentiles(samples)
+    result["lost"] = lost
+    return result
+
+def capabilities(ser):                                              #The payload's 'V' report, {} for payloads that don't have one
+    if (acknowledge(ser, "V", 5) is None):
+        return {}
+    if (ser.find(FRAME_MAGIC) == False):
+        return {}
+    frame = read_frame(ser, FRAME_MAGIC)
+    if ((frame is None) or (frame[3] is None) or ((frame[0] & FRAME_CTRL) == 0)):
+        return {}
+    return decode_params(frame[3])
+
+def transfer(ser, caps, chunk, size, fec, window):                  #One windowed transfer of the most recent image, size None for all of it
+    if (acknowledge(ser, "W") is None):
+        return {"chunk": chunk, "size": size, "error": "no acknowledge"}
+    params = {"name": "", "win": min(window, int(caps.get("win", window)))}
+    if caps.get("chunk"):
+        params["chunk"] = chunk                                     #Fixed for the whole transfer, the ground station's adaptive sizing is left out
+    if (size is not None):
+        params["ranges"] = "0-{}".format(size)
+    if (fec > 0):
+        params["fec"] = fec
+    start = time.time()
+    ser.write(pack_frame(0, encode_params(params), FRAME_CTRL))
+    receiver = WindowReceiver(params["win"])
+    stats = {"chunk": chunk, "size": size, "fec": fec, "frames": 0, "bad_frames": 0, "duplicates": 0, "timeouts": 0, "wire_bytes": 0, "image_bytes": 0}
+    header = None
+    quiet = 0
+    while (receiver.complete() == False):
+        if (ser.find(FRAME_MAGIC) == False):
+            quiet += 1
+            stats["timeouts"] += 1
+            if (quiet > QUIET_LIMIT):
+                stats["error"] = "payload went quiet"
+                break
+            if ((header is None) and (receiver.highest < 0)):       #Nothing at all came back, the request itself was lost
+                ser.write(pack_frame(0, encode_params(params), FRAME_CTRL))
+            else:
+                ser.write(pack_frame(0, receiver.status(), FRAME_ACK))
+            continue
+        quiet = 0
+        frame = read_frame(ser, FRAME_MAGIC, fec)
+        if (frame is None):
+            stats["bad_frames"] += 1
+            continue
+        flags, seq, offset, body, wire, fixed = frame
+        stats["wire_bytes"] += wire
+        if (body is None):
+            stats["bad_frames"] += 1
+            if receiver.hurry():
+                ser.write(pack_frame(0, receiver.status(), FRAME_ACK))
+            continue
+        if (flags & FRAME_CTRL):
+            header = decode_params(body)
+            fec = int(header.get("fec", 0))                         #The payload may grant less parity than we asked for, or none
+            stats["fec"] = fec
+            continue
+        skipped = receiver.gap(seq)
+        if (receiver.accept(seq, flags) == False):
+            stats["duplicates"] += 1
+            continue
+        if (skipped and receiver.hurry()):
+            ser.write(pack_frame(0, receiver.status(), FRAME_ACK))
+        stats["frames"] += 1
+        if (flags & FRAME_GPS):
+            body = body[GPS_SLOT:]
+        stats["image_bytes"] += len(body)
+        if (receiver.due()):
+            ser.write(pack_frame(0, receiver.status(), FRAME_ACK))
+    ser.write(pack_frame(0, receiver.status(), FRAME_ACK))          #Final status lets the payload finish
+    seconds = time.time() - start
+    stats["seconds"] = seconds
+    stats["throughput"] = stats["wire_bytes"] / seconds             #Bytes per second on the wire, overhead and resends included
+    stats["goodput"] = stats["image_bytes"] / seconds               #Image bytes per second delivered
+    stats["retry_rate"] = (stats["bad_frames"] + stats["duplicates"]) / float(max(1, stats["frames"]))
+    if (header is not None):
+        stats["image_size"] = int(header.get("size", 0))
+    time.sleep(0.5)                                                 #Let the payload drop back to waiting for commands
+    return stats
+
+def word_transfer(ser):                                             #The whole most recent image in the original base64 words, what payloads without win=... still use
+    if (acknowledge(ser, "1") is None):
+        return {"framing": "b64", "error": "no acknowledge"}
+    start = time.time()
+    name = ser.read_exact(NAME_LENGTH)
+    stats = {"framing": "b64", "chunk": WORD_LENGTH, "size": None, "name": name.strip(), "frames": 0, "bad_frames": 0, "syncs": 0,
+             "wire_bytes": len(name), "image_bytes": 0}
+    characters = 0
+    padding = 0
+    tries = 0
+    finished = start
+    while True:
+        check = ser.read_exact(32)
+        if (check == ""):                                           #No more words, the payload is done
+            break
+        if (check.startswith(FRAME_MAGIC)):
+            stats["error"] = "payload answers with binary frames"
+            break
+        slot = ser.read_exact(GPS_SLOT)
+        word = ser.read_exact(WORD_LENGTH)                          #The last word is short, so this waits out the port timeout just like the ground station does
+        stats["wire_bytes"] += len(check) + len(slot) + len(word)
+        if (hashlib.md5(slot + word).hexdigest() == check):
+            ser.write("Y")
+            tries = 0
+            stats["frames"] += 1
+            characters += len(word)
+            padding = word.count("=")
+            finished = time.time()
+            continue
+        stats["bad_frames"] += 1
+        tries += 1
+        ser.write("N")
+        if (tries > RESEND_LIMIT):
+            stats["error"] = "ran out of resends"
+            break
+        ser.find("sync")                                            #Same resync as the ground station's sync()
+        ser.write("S")
+        ser.flushInput()
+        stats["syncs"] += 1
+    seconds = max(finished - start, 1e-6)
+    stats["image_bytes"] = characters * 3 // 4 - padding
+    stats["seconds"] = seconds
+    stats["throughput"] = stats["wire_bytes"] / seconds
+    stats["goodput"] = stats["image_bytes"] / seconds
+    stats["retry_rate"] = stats["bad_frames"] / float(max(1, stats["frames"]))
+    time.sleep(0.5)
+    return stats
+
+# ----- BENCHMARK RUNS ----- #
+
+def software_version():                                             #git commit of this checkout, None outside a repository
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start_emulator(options, rate):                                  #(process, pty path) of a PayloadEmulator.py throttled to rate
+    command = [sys.executable, "-u", os.path.join(os.path.dirname(os.path.abspath(__file__)), "PayloadEmulator.py"), "--baud", str(rate)] + options.split()
+    emulator = subprocess.Popen(command, stdout = subprocess.PIPE)
+    return (emulator, emulator.stdout.readline().split()[-1])
+
+def run(args, rate):
+    emulator = None
+    path = args.port
+    if (args.emulate is not None):
+        emulator, path = start_emulator(args.emulate, rate)
+    ser = SerialReader(serial.Serial(port = path, baudrate = rate, timeout = timeout))
+    result = {"baud": rate, "port": path}
+    try:
+        result["caps"] = capabilities(ser)
+        result["ack_latency"] = time_ack(ser, args.acks)
+        result["ping"] = ping(ser, args.pings)
+        print ("{} baud: 'T' ack p50 {:.3f} s, ping p50 {:.3f} s".format(rate, result["ack_latency"].get("p50", -1), result["ping"].get("p50", -1)))
+        result["transfers"] = []
+        if (result["caps"].get("win") is None):
+            stats = word_transfer(ser)                              #Chunk and size sweeps need windowed transfers, the original framing sends the whole image
+            result["transfers"].append(stats)
+            print ("{} baud, base64 words, {} bytes: {:.0f} B/s goodput, {:.0f} B/s on the wire, retry rate {:.3f}".format(rate, stats.get("image_bytes", 0),
+                   stats.get("goodput", 0), stats.get("throughput", 0), stats.get("retry_rate", 0)))
+        else:
+            chunks = args.chunks
+            if (result["caps"].get("chunk") is None):
+                chunks = chunks[:1]                                 #The payload has one frame size, sweeping would repeat the same run
+            for chunk in chunks:
+                for size in args.sizes:
+                    stats = transfer(ser, result["caps"], chunk, size, args.fec, args.window)
+                    result["transfers"].append(stats)
+                    print ("{} baud, chunk {}, {} bytes: {:.0f} B/s goodput, {:.0f} B/s on the wire, retry rate {:.3f}".format(rate, chunk, stats.get("image_bytes", 0),
+                           stats.get("goodput", 0), stats.get("throughput", 0), stats.get("retry_rate", 0)))
+    finally:
+        ser.close()
+        if (emulator is not None):
+            emulator.kill()
+    return result
+
+def number_list(text, kind = int):
+    return [kind(item) for item in text.split(",") if item]
+
+def size_list(text):                                                #"all" is the whole most recent image
+    return [None if (item == "all") else int(item) for item in text.split(",") if item]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Benchmark the RFD900 link to the payload, results as JSON")
+    parser.add_argument("--port", default = port)
+    parser.add_argument("--bauds", type = number_list, default = [baud])
+    parser.add_argument("--acks", type = int, default = 10, help = "'T' acknowledges to time")
+    parser.add_argument("--pings", type = int, default = 50)
+    parser.add_argument("--chunks", type = number_list, default = [256, 1024, WORD_LENGTH, 8192])
+    parser.add_argument("--sizes", type = size_list, default = [None], help = "bytes of the most recent image per transfer, e.g. 4096,65536,all")
+    parser.add_argument("--fec", type = int, default = 0, help = "Reed-Solomon parity bytes per block, 0 for none")
+    parser.add_argument("--window", type = int, default = 8)
+    parser.add_argument("--emulate", help = "PayloadEmulator.py options, runs against the emulator instead of --port")
+    parser.add_argument("--output", help = "JSON file, stdout if not given")
+    args = parser.parse_args(argv)
 
-i = 0
+    report = {"benchmark": "TestSerialRT", "format": 1, "started": time.time(), "software": software_version(), "host": platform.node(),
+              "emulated": args.emulate, "runs": []}
+    for rate in args.bauds:
+        report["runs"].append(run(args, rate))
+    report["finished"] = time.time()
+    text = json.dumps(report, indent = 2, sort_keys = True)
+    if (args.output is None):
+        print (text)
+    else:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+        print ("results written to " + args.output)
 
-while (i < 10):
-    time.sleep(1)
-    print ("writing " + str(ser.write('T')) + " bytes")
-    print (str(ser.inWaiting()) + " bytes waiting")
-    print ("reading: " + ser.read())
-    i = i + 1
+if __name__ == "__main__":
+    main(sys.argv[1:])
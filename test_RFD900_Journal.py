@@ -0,0 +1,122 @@
+#RFD900 Journal Tests
+#...Checks resuming, restarting and moving partial images in RFD900_Journal.py on a scratch directory
+
+#Usage:
+#   python -m unittest test_RFD900_Journal
+
+import os
+import shutil
+import tempfile
+import unittest
+from RFD900_Journal import *
+
+def contents(path):
+    with open(path, "rb") as fl:
+        return fl.read()
+
+class MissingRangesTest(unittest.TestCase):
+    def test_gaps(self):
+        self.assertEqual(missing_ranges({}, 10), [(0, 10)])
+        self.assertEqual(missing_ranges({0: 4, 6: 2}, 10), [(4, 6), (8, 10)])
+        self.assertEqual(missing_ranges({0: 6, 2: 2}, 6), [])       #Overlapping ranges
+        self.assertEqual(missing_ranges({0: 4}, 0), [])             #Size unknown
+
+class IdentityTest(unittest.TestCase):
+    def test_transport_keys_ignored(self):                          #Frame size, parity and telemetry can change between tries of the same image
+        header = {"name": "image00001b.png", "size": "4500", "fec": "32", "win": "16"}
+        self.assertEqual(journal_identity(header), journal_identity({"name": "image00001b.png", "size": "4500", "chunk": "1024"}))
+        self.assertNotEqual(journal_identity(header), journal_identity({"name": "image00002b.png", "size": "4500"}))
+        self.assertNotEqual(journal_identity(header), journal_identity({"name": "image00001b.png", "size": "4500", "codec": "webp"}))
+        self.assertEqual(journal_identity(None), 0)
+
+class ImageWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.png")
+        partialJournals.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        partialJournals.clear()
+
+    def partial(self, path, size, identity, chunks):                #Leaves an unfinished transfer behind, chunks are (offset, data)
+        writer = ImageWriter(path, size, identity)
+        for offset, data in chunks:
+            writer.write(offset, data)
+        writer.close(False)
+
+    def test_complete_removes_journal(self):
+        writer = ImageWriter(self.path, 4, 7)
+        writer.write(0, b"abcd")
+        self.assertEqual(writer.missing(), [])
+        writer.close(True)
+        self.assertEqual(contents(self.path), b"abcd")
+        self.assertFalse(os.path.exists(self.path + ".journal"))
+
+    def test_read_journal_checks_bytes(self):                       #A range whose bytes changed on disk is no longer claimed
+        self.partial(self.path, 8, 7, [(0, b"abcd"), (4, b"efgh")])
+        with open(self.path, "r+b") as fl:
+            fl.seek(5)
+            fl.write(b"X")
+        self.assertEqual(read_journal(self.path + ".journal"), (8, 7, {0: 4}))
+
+    def test_resume_same_image(self):
+        self.partial(self.path, 8, 7, [(4, b"efgh")])
+        writer = ImageWriter(self.path, 8, 7)
+        self.assertFalse(writer.discarded)
+        self.assertEqual(writer.missing(), [(0, 4)])
+        writer.write(0, b"abcd")
+        writer.close(True)
+        self.assertEqual(contents(self.path), b"abcdefgh")
+
+    def test_legacy_transfer_never_resumes(self):                   #Aborted legacy image A, then legacy image B under the same name
+        self.partial(self.path, 0, 0, [(0, b"A" * 2250)])
+        writer = ImageWriter(self.path, 0, 0)
+        self.assertTrue(writer.discarded)
+        self.assertEqual(writer.received(), 0)
+        writer.write(0, b"B" * 2250)
+        writer.write(2250, b"B" * 2250)
+        writer.close(True)
+        self.assertEqual(contents(self.path), b"B" * 4500)
+
+    def test_other_image_same_size(self):
+        self.partial(self.path, 8, 7, [(0, b"abcd")])
+        writer = ImageWriter(self.path, 8, 9)
+        self.assertTrue(writer.discarded)
+        self.assertEqual(writer.missing(), [(0, 8)])
+        writer.close(False)
+        self.assertEqual(read_journal(self.path + ".journal"), (8, 9, {}))
+
+    def test_size_change_truncates(self):
+        self.partial(self.path, 8, 7, [(0, b"abcd"), (4, b"efgh")])
+        writer = ImageWriter(self.path, 6, 7)
+        self.assertEqual(writer.received(), 0)
+        writer.close(False)
+        self.assertEqual(os.path.getsize(self.path), 6)
+
+    def test_moved_from_older_session(self):                        #Bytes are carried over, the old files go
+        old = os.path.join(self.directory, "old")
+        os.mkdir(old)
+        oldpath = os.path.join(old, "test.png")
+        self.partial(oldpath, 8, 7, [(0, b"abcd")])
+        partialJournals["test.png"] = oldpath + ".journal"
+        writer = ImageWriter(self.path, 8, 7)
+        self.assertEqual(writer.missing(), [(4, 8)])
+        writer.close(False)
+        self.assertEqual(contents(self.path)[:4], b"abcd")
+        self.assertEqual(os.listdir(old), [])
+        self.assertEqual(partialJournals, {})
+
+    def test_moved_other_image(self):                               #Nothing stale is copied, the old files still go
+        old = os.path.join(self.directory, "old")
+        os.mkdir(old)
+        oldpath = os.path.join(old, "test.png")
+        self.partial(oldpath, 8, 7, [(0, b"abcd")])
+        partialJournals["test.png"] = oldpath + ".journal"
+        writer = ImageWriter(self.path, 8, 9)
+        self.assertEqual(writer.received(), 0)
+        writer.close(False)
+        self.assertEqual(os.listdir(old), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,403 @@
+#RFD900 Protocol Tests
+#...Checks the parts of RFD900_Protocol.py that both ends of the link depend on, without a radio or the emulator
+
+#Usage:
+#   python -m unittest test_RFD900_Protocol
+
+import random
+import threading
+import time
+import unittest
+from RFD900_Protocol import *
+
+# ----- WINDOWED TRANSFER ----- #
+
+class StatusFrameTest(unittest.TestCase):
+    def test_round_trip(self):
+        self.assertEqual(unpack_ack(pack_ack(5, [6, 9])), (5, [6, 9]))
+        self.assertEqual(unpack_ack(pack_ack(0, [])), (0, []))
+
+    def test_missing_list_is_capped(self):                          #The rest are reported by later statuses
+        base, missing = unpack_ack(pack_ack(0, list(range(1, 200))))
+        self.assertEqual(len(missing), ACK_MAX_MISSING)
+        self.assertEqual(missing[0], 1)
+
+class WindowReceiverTest(unittest.TestCase):
+    def test_gaps(self):
+        window = WindowReceiver(8)
+        self.assertTrue(window.accept(0, 0))
+        self.assertTrue(window.accept(1, 0))
+        self.assertTrue(window.gap(4))
+        self.assertTrue(window.accept(4, 0))
+        self.assertFalse(window.gap(5))
+        self.assertFalse(window.accept(4, 0))                       #Duplicate
+        self.assertFalse(window.accept(0, 0))                       #Already below the base
+        self.assertEqual(window.missing(), [2, 3])
+        self.assertEqual(unpack_ack(window.status()), (2, [2, 3]))
+
+    def test_due(self):                                             #Every half window, counted from the last status
+        window = WindowReceiver(8)
+        for seq in (0, 1, 2):
+            window.accept(seq, 0)
+        self.assertFalse(window.due())
+        window.accept(5, 0)
+        self.assertTrue(window.due())
+        window.status()
+        self.assertFalse(window.due())
+        window.accept(5, 0)                                         #Duplicates don't count towards the next one
+        self.assertFalse(window.due())
+
+    def test_status_timers(self):
+        window = WindowReceiver(8)
+        window.status()
+        self.assertFalse(window.hurry())
+        self.assertFalse(window.stale())
+        window.sent -= STATUS_INTERVAL
+        self.assertTrue(window.hurry())
+        self.assertTrue(window.stale())
+
+    def test_complete(self):
+        window = WindowReceiver(4)
+        window.accept(1, FRAME_LAST)
+        self.assertFalse(window.complete())
+        self.assertEqual(unpack_ack(window.status()), (0, [0]))
+        window.accept(0, 0)
+        self.assertTrue(window.complete())
+        self.assertEqual(unpack_ack(window.status()), (2, []))
+
+# ----- ADAPTIVE CHUNK SIZE ----- #
+
+def measure(sizer, good, bad, length):                              #One period of frames, then the sizer's decision
+    for i in range(good):
+        sizer.record(True, length)
+    for i in range(bad):
+        sizer.record(False)
+    return sizer.decide()
+
+class ChunkSizerTest(unittest.TestCase):
+    def test_clamped(self):
+        self.assertEqual(ChunkSizer(100000, 256, 8192).size, 8192)
+        self.assertEqual(ChunkSizer(10, 256, 8192).size, 256)
+
+    def test_waits_for_a_period(self):
+        sizer = ChunkSizer(1024)
+        self.assertEqual(measure(sizer, CHUNK_PERIOD - 1, 0, 1024), None)
+        self.assertEqual(sizer.size, 1024)
+
+    def test_clean_link_grows_to_largest(self):
+        sizer = ChunkSizer(2048, 256, 4096)
+        self.assertEqual(measure(sizer, CHUNK_PERIOD, 0, 2048)[0], 4096)
+        self.assertEqual(measure(sizer, CHUNK_PERIOD, 0, 4096), None)
+        self.assertEqual(sizer.size, 4096)
+
+    def test_noisy_link_shrinks_to_smallest(self):
+        sizer = ChunkSizer(512, 256, 8192)
+        self.assertEqual(measure(sizer, CHUNK_PERIOD // 2, CHUNK_PERIOD // 2, 512)[0], 256)
+        self.assertEqual(measure(sizer, CHUNK_PERIOD // 2, CHUNK_PERIOD // 2, 256), None)
+        self.assertEqual(sizer.size, 256)
+
+    def test_remembers_worse_size(self):                            #A clean period doesn't step back up into a size that did worse
+        sizer = ChunkSizer(1024)
+        sizer.goodput[2048] = (0.001, time.time())
+        self.assertEqual(measure(sizer, CHUNK_PERIOD, 0, 1024), None)
+        sizer.goodput[2048] = (0.001, time.time() - CHUNK_MEMORY)   #Until the measurement is too old to trust
+        self.assertEqual(measure(sizer, CHUNK_PERIOD, 0, 1024)[0], 2048)
+
+    def test_goes_back_to_better_size(self):                        #In between the failure thresholds, goodput decides
+        sizer = ChunkSizer(1024)
+        sizer.goodput[512] = (1e9, time.time())
+        failing = int(CHUNK_PERIOD * (CHUNK_FAIL_LOW + CHUNK_FAIL_HIGH) / 2) + 1
+        self.assertEqual(measure(sizer, CHUNK_PERIOD - failing, failing, 1024)[0], 512)
+
+# ----- FORWARD ERROR CORRECTION ----- #
+
+def split_frame(frame):                                             #(header, body, crc) as check_frame takes them
+    return (frame[:FRAME_HEADER.size], frame[FRAME_HEADER.size:-FRAME_CRC.size], frame[-FRAME_CRC.size:])
+
+def damage(body, count, rng):                                       #count bytes flipped in every 255 byte block
+    body = bytearray(body)
+    for start in range(0, len(body), 255):
+        for position in rng.sample(range(start, min(start + 255, len(body))), count):
+            body[position] ^= rng.randint(1, 255)
+    return bytes(body)
+
+class FECTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+        self.data = bytes(bytearray(self.rng.randint(0, 255) for i in range(1000)))
+
+    def test_round_trip(self):
+        body = fec_encode(self.data, 32)
+        self.assertEqual(fec_strip(body, 32), self.data)
+        self.assertEqual(fec_encode(self.data, 0), self.data)
+
+    def test_repairs_symbol_errors(self):                           #Up to nsym/2 bad bytes per block come back and pass the frame CRC
+        header, body, crc = split_frame(pack_frame(7, fec_encode(self.data, 32), FRAME_FEC))
+        broken = damage(body, 16, self.rng)
+        self.assertFalse(check_frame(header, broken, crc))
+        repaired, fixed = fec_repair(broken, 32)
+        self.assertTrue(check_frame(header, repaired, crc))
+        self.assertEqual(fixed, 16 * ((len(body) + 254) // 255))
+        self.assertEqual(fec_strip(repaired, 32), self.data)
+
+    def test_too_many_errors(self):                                 #Beyond what the parity covers the frame must not come back as good
+        header, body, crc = split_frame(pack_frame(7, fec_encode(self.data, 8), FRAME_FEC))
+        broken = damage(body, 20, self.rng)
+        try:
+            repaired = fec_repair(broken, 8)[0]
+        except FECError:
+            return
+        self.assertFalse(check_frame(header, repaired, crc))
+
+# ----- BUFFERED SERIAL READER ----- #
+
+class FakePort(object):                                             #Hands out the chunks it was given, one per read, like bytes trickling in
+    def __init__(self, chunks):
+        self.chunks = [bytearray(chunk) for chunk in chunks]
+        self.timeout = 0.05
+
+    @property
+    def in_waiting(self):
+        if self.chunks:
+            return len(self.chunks[0])
+        return 0
+
+    def read(self, size = 1):
+        if (len(self.chunks) == 0):
+            time.sleep(self.timeout)
+            return b""
+        data = bytes(self.chunks[0][:size])
+        del self.chunks[0][:size]
+        if (len(self.chunks[0]) == 0):
+            self.chunks.pop(0)
+        return data
+
+    def write(self, data):
+        return len(data)
+
+class SerialReaderTest(unittest.TestCase):
+    def test_find_skips_noise(self):
+        ser = SerialReader(FakePort([b"noise\xa5", b"\x5aafter"]))    #Magic split across two reads
+        self.assertTrue(ser.find(FRAME_MAGIC))
+        self.assertEqual(ser.read_exact(5), b"after")
+        self.assertEqual(ser.received, 12)
+
+    def test_find_times_out(self):
+        ser = SerialReader(FakePort([b"no marker here"]))
+        start = time.time()
+        self.assertFalse(ser.find(FRAME_MAGIC, 0.2))
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_unread(self):
+        ser = SerialReader(FakePort([b"\xa5\x5aABCD"]))
+        self.assertEqual(ser.read_exact(4), b"\xa5\x5aAB")
+        ser.unread(b"\xa5\x5aAB")                                   #Put back, the way hunt_frame hands a header back
+        self.assertTrue(ser.find(FRAME_MAGIC))
+        self.assertEqual(ser.read_exact(4), b"ABCD")
+
+    def test_read_until(self):
+        ser = SerialReader(FakePort([b"line o", b"ne\nline two\n"]))
+        self.assertEqual(ser.readline(), b"line one\n")
+        self.assertEqual(ser.inWaiting(), 9)
+        self.assertEqual(ser.read_until(b"\n"), b"line two\n")
+        self.assertEqual(ser.read_until(b"\n", 0.1), b"")           #Nothing more came before the deadline
+
+    def test_frame_through_reader(self):
+        frame = pack_frame(3, b"body", FRAME_LAST, 96)
+        ser = SerialReader(FakePort([b"\x00" + frame[:5], frame[5:]]))
+        self.assertTrue(ser.find(FRAME_MAGIC))
+        header = FRAME_MAGIC + ser.read_exact(FRAME_HEADER.size - len(FRAME_MAGIC))
+        self.assertEqual(unpack_header(header), (FRAME_LAST, 3, 96, 4))
+        body = ser.read_exact(4)
+        self.assertTrue(check_frame(header, body, ser.read_exact(FRAME_CRC.size)))
+
+# ----- FRAME READING ----- #
+
+class ReadFrameTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(2)
+        self.data = bytes(bytearray(self.rng.randint(0, 255) for i in range(600)))
+
+    def read(self, frame, fec = 0):
+        ser = SerialReader(FakePort([frame]))
+        self.assertTrue(ser.find(FRAME_MAGIC))
+        return read_frame(ser, FRAME_MAGIC, fec)
+
+    def test_plain(self):
+        frame = pack_frame(4, self.data, FRAME_LAST, 1200)
+        self.assertEqual(self.read(frame), (FRAME_LAST, 4, 1200, self.data, len(frame), 0))
+
+    def test_damaged(self):                                         #Still counted on the wire, no body
+        header, body, crc = split_frame(pack_frame(4, self.data))
+        result = self.read(header + damage(body, 1, self.rng) + crc)
+        self.assertEqual(result[3], None)
+        self.assertEqual(result[4], len(header) + len(body) + len(crc))
+
+    def test_repaired(self):
+        header, body, crc = split_frame(pack_frame(5, fec_encode(self.data, 16), FRAME_FEC))
+        flags, seq, offset, data, wire, fixed = self.read(header + damage(body, 3, self.rng) + crc, 16)
+        self.assertEqual(data, self.data)
+        self.assertEqual(fixed, 3 * ((len(body) + 254) // 255))
+
+    def test_parity_not_negotiated(self):                           #A clean FEC frame still can't be split into data and parity without nsym
+        self.assertEqual(self.read(pack_frame(5, fec_encode(self.data, 16), FRAME_FEC))[3], None)
+
+    def test_short_frame(self):                                     #The port went quiet partway through the body
+        frame = pack_frame(6, self.data)
+        self.assertEqual(self.read(frame[:-100])[3], None)
+
+# ----- COMMANDS ----- #
+
+class CommandPort(FakePort):                                        #Every write gets answer(write number, data) back, flushInput() drops what is waiting like a real port
+    def __init__(self, chunks, answer, timeout = 0.05):
+        FakePort.__init__(self, chunks)
+        self.timeout = timeout
+        self.answer = answer
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+        reply = self.answer(len(self.writes), data)
+        if reply:
+            self.chunks.append(bytearray(reply))
+        return len(data)
+
+    def flushInput(self):
+        del self.chunks[:]
+
+def silent(number, data):
+    return b""
+
+class CommandTest(unittest.TestCase):
+    def test_leftovers_dropped(self):                               #Whatever came before the acknowledge, e.g. the tail of a line
+        ser = SerialReader(CommandPort([b"12:00:03\r\nA"], silent))
+        self.assertTrue(wait_acknowledge(ser, "T", None, 0.2))
+
+    def test_stale_acknowledge_flushed(self):                       #An 'A' left over from the last command isn't taken as the answer to this one
+        port = CommandPort([b"A"], silent)
+        self.assertRaises(CommandTimeout, send_command, SerialReader(port), "T", None, 0.2)
+        self.assertEqual(port.writes, ["T"])
+
+    def test_plain_resend(self):
+        port = CommandPort([], lambda number, data: b"A" if (number == 2) else b"")
+        self.assertEqual(send_command(SerialReader(port), "T", None, 2.0), 2)
+
+    def test_plain_waits_for_port_timeout(self):                    #A slow 'A' mustn't be overtaken by a resend that runs the command twice
+        port = CommandPort([], silent, 1.0)
+        self.assertRaises(CommandTimeout, send_command, SerialReader(port), "T", None, 0.9)
+        self.assertEqual(len(port.writes), 1)
+
+    def test_request_id(self):                                      #Late answers to earlier requests and stray bytes are skipped
+        stale = pack_acknowledge(6, "T") + b"A" + pack_acknowledge(7, "G")
+        port = CommandPort([], lambda number, data: stale + pack_acknowledge(7, "T"))
+        self.assertEqual(send_command(SerialReader(port), "T", 7, 1.0), 1)
+        self.assertEqual(port.writes, [pack_command(7, "T")])
+
+    def test_request_id_short_backoff(self):                        #Request IDs can't be confused, so resends start at COMMAND_BACKOFF
+        port = CommandPort([], lambda number, data: pack_acknowledge(6, "T"), 1.0)
+        resends = []
+        self.assertRaises(CommandTimeout, send_command, SerialReader(port), "T", 7, COMMAND_BACKOFF * 1.5, resends.append)
+        self.assertEqual(resends, [2])
+        self.assertEqual(port.writes, [pack_command(7, "T")] * 2)
+
+# ----- GPS RECORD ----- #
+
+class GPSRecordTest(unittest.TestCase):
+    def test_round_trip(self):
+        slot = pack_gps(1700000000.25, 30.2265, -93.2174, 31250.5, GPS_FIX_3D, 9)
+        self.assertEqual(len(slot), GPS_SLOT)
+        fix = decode_gps(slot)
+        self.assertAlmostEqual(fix["time"], 1700000000.25, 3)
+        self.assertAlmostEqual(fix["lat"], 30.2265, 6)
+        self.assertAlmostEqual(fix["lon"], -93.2174, 6)
+        self.assertAlmostEqual(fix["alt"], 31250.5, 2)
+        self.assertEqual((fix["fix"], fix["sats"]), (GPS_FIX_3D, 9))
+
+    def test_damaged_record(self):
+        slot = bytearray(pack_gps(1700000000, 30.2265, -93.2174, 100.0))
+        slot[10] ^= 0x01
+        self.assertEqual(decode_gps(bytes(slot)), None)
+        self.assertEqual(unpack_gps(bytes(slot[:10])), None)
+
+    def test_text(self):                                            #Older payloads, padded out to the slot
+        fix = decode_gps(b"30.226500,-93.217400,31250.5".ljust(GPS_SLOT))
+        self.assertEqual((fix["lat"], fix["lon"], fix["alt"]), (30.2265, -93.2174, 31250.5))
+        self.assertEqual(fix["time"], None)
+        self.assertEqual(parse_gps_text(b"LAT 30.2 LON -93.2"), None)   #Only two numbers
+        self.assertEqual(parse_gps_text(b"130.2,-93.2,100"), None)      #Not a latitude
+
+# ----- LOGICAL CHANNELS ----- #
+
+class GatedPort(object):                                            #Records what the mux writes, every write holds until the gate opens
+    def __init__(self):
+        self.frames = []
+        self.writing = threading.Event()
+        self.gate = threading.Event()
+
+    def write(self, data):
+        self.frames.append(data)
+        self.writing.set()
+        self.gate.wait(5.0)
+        return len(data)
+
+class ChannelMuxTest(unittest.TestCase):
+    def setUp(self):
+        self.port = GatedPort()
+        self.mux = ChannelMux(self.port)
+
+    def tearDown(self):
+        self.mux.telemetry(None)
+        self.port.gate.set()
+
+    def hold(self):                                                 #First bulk frame goes out and blocks the writer, so the rest queue up behind it
+        self.mux.send(CHANNEL_BULK, b"bulk0", 0)
+        self.assertTrue(self.port.writing.wait(5.0))
+
+    def test_priority(self):                                        #Telemetry, then control, then bulk, whatever order they were queued in
+        self.hold()
+        self.mux.send(CHANNEL_BULK, b"bulk1", 1)
+        self.mux.send(CHANNEL_CONTROL, b"ctrl")
+        self.mux.send(CHANNEL_TELEMETRY, b"telem")
+        self.port.gate.set()
+        self.mux.drain(5.0)
+        self.assertEqual(self.port.frames, [b"bulk0", b"telem", b"ctrl", b"bulk1"])
+
+    def test_written(self):
+        self.hold()
+        self.mux.send(CHANNEL_BULK, b"bulk1", 1)
+        self.assertEqual(self.mux.written(0), None)                 #Still on the air
+        self.assertEqual(self.mux.written(1), None)
+        self.assertFalse(self.mux.resendable(1))
+        self.assertEqual(self.mux.written(2), 0.0)                  #Never sent
+        self.port.gate.set()
+        self.mux.drain(5.0)
+        self.assertTrue(self.mux.written(1) > 0)
+        self.assertFalse(self.mux.resendable(1))                    #Too recent for a status to have reported it
+        self.mux.finished[1] -= RESEND_HOLDOFF
+        self.assertTrue(self.mux.resendable(1))
+
+    def test_clear(self):                                           #Queued copies are forgotten, the one on the air still finishes
+        self.hold()
+        self.mux.send(CHANNEL_BULK, b"bulk1", 1)
+        self.mux.send(CHANNEL_BULK, b"bulk1", 1)
+        self.mux.send(CHANNEL_CONTROL, b"ctrl")
+        self.mux.clear(CHANNEL_BULK)
+        self.assertEqual(self.mux.written(1), 0.0)
+        self.assertTrue(self.mux.resendable(1))
+        self.port.gate.set()
+        self.mux.drain(5.0)
+        self.assertEqual(self.port.frames, [b"bulk0", b"ctrl"])
+
+    def test_telemetry_during_bulk(self):                           #Paced bulk frames don't hold position updates back until the transfer ends
+        self.port.gate.set()
+        mux = ChannelMux(self.port, 10000)
+        for seq in range(20):
+            mux.send(CHANNEL_BULK, b"b" * 100, seq)                 #10 ms each on the link
+        mux.telemetry(0.05, lambda: b"T")
+        mux.drain(5.0)
+        mux.telemetry(None)
+        last = max(i for i, frame in enumerate(self.port.frames) if (frame != b"T"))
+        self.assertTrue(self.port.frames[:last].count(b"T") >= 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#RFD900 Tracking Tests
+#...Checks the track fit and the predictions RFD900_Tracking.py hands to the servo tracker
+
+#Usage:
+#   python -m unittest test_RFD900_Tracking
+
+import time
+import unittest
+from RFD900_Protocol import GPS_FIX_PREDICTED, GPS_SLOT, decode_gps
+from RFD900_Tracking import *
+
+def fix(stamp, lat, lon, alt):
+    return {"time": stamp, "lat": lat, "lon": lon, "alt": alt, "fix": 3, "sats": 9}
+
+def text_fix(lat, lon, alt):                                        #What parse_gps_text() makes of an older payload's slot
+    return {"time": None, "lat": lat, "lon": lon, "alt": alt, "fix": None, "sats": None}
+
+class FitTest(unittest.TestCase):
+    def test_linear(self):
+        points = [(t, 30.0 + 0.001 * t, -93.0, 1000.0 + 5.0 * t) for t in (-8.0, -6.0, -4.0, -2.0, 0.0)]
+        lat, lon, alt = fit_track(points, 1)
+        self.assertAlmostEqual(lat[0], 30.0, 9)
+        self.assertAlmostEqual(lat[1], 0.001, 9)
+        self.assertAlmostEqual(alt[1], 5.0, 6)
+
+    def test_quadratic(self):
+        points = [(t, 0.0, 0.0, 100.0 + 2.0 * t + 0.5 * t * t) for t in (-10.0, -7.0, -5.0, -2.0, 0.0)]
+        alt = fit_track(points, 2)[2]
+        for value, expected in zip(alt, (100.0, 2.0, 0.5)):
+            self.assertAlmostEqual(value, expected, 6)
+
+    def test_singular(self):                                        #Every fix at the same time, no slope to fit
+        self.assertEqual(fit_track([(0.0, 1.0, 2.0, 3.0)] * 3, 1), None)
+
+    def test_acceleration_is_capped(self):                          #Past PREDICT_ACCELERATION the velocity it reached carries on
+        coefficients = [100.0, 2.0, 0.5]
+        self.assertAlmostEqual(extrapolate(coefficients, 2.0), 100.0 + 4.0 + 2.0)
+        edge = extrapolate(coefficients, PREDICT_ACCELERATION)
+        slope = 2.0 + 2 * 0.5 * PREDICT_ACCELERATION
+        self.assertAlmostEqual(extrapolate(coefficients, PREDICT_HORIZON), edge + slope * (PREDICT_HORIZON - PREDICT_ACCELERATION))
+        self.assertAlmostEqual(extrapolate([100.0, 2.0], PREDICT_HORIZON), 100.0 + 2.0 * PREDICT_HORIZON)
+
+class TrackPredictorTest(unittest.TestCase):
+    def setUp(self):
+        self.published = []
+        self.predictor = TrackPredictor(self.published.append)
+
+    def test_needs_two_fixes(self):
+        self.predictor.add(fix(1000.0, 30.0, -93.0, 1000.0), 1000.0)
+        self.assertEqual(self.predictor.predict(1001.0), None)
+
+    def test_constant_velocity(self):
+        for t in (1000.0, 1002.0):
+            self.predictor.add(fix(t, 30.0, -93.0, 1000.0 + 5.0 * (t - 1000.0)), t)
+        self.assertAlmostEqual(self.predictor.predict(1004.0)[2], 1020.0, 6)
+        self.assertEqual(self.predictor.predict(1001.0), None)       #Before the last fix
+        self.assertEqual(self.predictor.predict(1002.0 + PREDICT_HORIZON + 1.0), None)
+
+    def test_repeated_fix_ignored(self):                            #A resent frame carries the same fix again
+        for t in (1000.0, 1002.0, 1002.0, 1001.0):
+            self.predictor.add(fix(t, 30.0, -93.0, 1000.0 + 5.0 * (t - 1000.0)), t)
+        self.assertEqual(len(self.predictor.points), 2)
+
+    def test_noisy_altitude_stays_near_track(self):                 #Alternating noise fits a large acceleration, the cap keeps it bounded
+        for i in range(PREDICT_QUADRATIC):
+            t = 1000.0 + 2.0 * i
+            self.predictor.add(fix(t, 30.0, -93.0, 1000.0 + 5.0 * (t - 1000.0) + (40.0 if i in (1, 3) else 0.0)), t)
+        last = 1000.0 + 2.0 * (PREDICT_QUADRATIC - 1)
+        far = self.predictor.predict(last + PREDICT_HORIZON)[2]
+        model = self.predictor.model[1][2]
+        unbounded = sum(c * PREDICT_HORIZON ** k for k, c in enumerate(model))
+        truth = 1000.0 + 5.0 * (last + PREDICT_HORIZON - 1000.0)
+        self.assertLess(abs(far - truth), abs(unbounded - truth))
+
+    def test_slot_matches_payload_form(self):                       #Packed predictions for packed fixes, text for text
+        self.predictor.add(fix(1000.0, 30.0, -93.0, 1000.0), 1000.0)
+        slot = self.predictor.slot(1001.0, (30.5, -93.5, 1200.0))
+        self.assertEqual(decode_gps(slot)["fix"], GPS_FIX_PREDICTED)
+        self.predictor.add(text_fix(30.0, -93.0, 1000.0), 1001.0)
+        slot = self.predictor.slot(1002.0, (30.5, -93.5, 1200.0))
+        self.assertEqual(len(slot), GPS_SLOT)
+        self.assertEqual(decode_gps(slot)["time"], None)
+        self.assertEqual(decode_gps(slot)["alt"], 1200.0)
+
+    def test_publishes_while_enabled(self):
+        now = time.time()
+        self.predictor.add(text_fix(30.0, -93.0, 1000.0), now - 2.0)
+        self.predictor.add(text_fix(30.0, -93.0, 1010.0), now)
+        self.predictor.enabled = True
+        self.predictor.start()
+        time.sleep(3.5 / PREDICT_RATE)
+        self.predictor.stop()
+        self.predictor.join(1.0)
+        self.assertTrue(len(self.published) >= 2)
+        self.assertTrue(all(decode_gps(slot)["time"] is None for slot in self.published))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#RFD900 Session Archive Tests
+#...Indexes a scratch SESSIONS directory with SessionArchive.py and checks what lands in the catalog
+
+#Usage:
+#   python -m unittest test_SessionArchive
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import SessionArchive
+
+SESSION = "Session_2019-04-06-10-31-02"
+
+def event(stamp, message):                                          #One line the way the ground station's event log writes it
+    return "2019-04-06 10:31:02 (aka {:.2f} UTC Epoch) -- {}\r\n".format(stamp, message).encode("utf-8")
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.root, SESSION)
+        os.mkdir(self.directory)
+        self.log = os.path.join(self.directory, "Event_Log_File_2019-04-06-10-31-02.txt")
+        self.track = os.path.join(self.directory, "GPS_Track_2019-04-06-10-31-02.sqlite")
+        self.archive = SessionArchive.Archive(self.root)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.root)
+
+    def append(self, data):
+        with open(self.log, "ab") as fl:
+            fl.write(data)
+
+    def add_fixes(self, fixes):                                     #(received, alt) rows, the way GPSTrack stores them
+        track = sqlite3.connect(self.track)
+        track.execute("CREATE TABLE IF NOT EXISTS fixes (received REAL, time REAL, lat REAL, lon REAL, alt REAL, fix INTEGER, sats INTEGER, source TEXT)")
+        track.executemany("INSERT INTO fixes VALUES (?, ?, 30.2, -93.2, ?, 3, 9, 'image')", [(received, received, alt) for received, alt in fixes])
+        track.commit()
+        track.close()
+
+    def events(self):
+        return self.archive.db.execute("SELECT stamp, level, message FROM events ORDER BY stamp").fetchall()
+
+    def test_events_incremental(self):
+        self.append(event(100.0, "Ground Station Software Starts") + event(101.0, "ERROR: No Acknowledge"))
+        self.append(b"2019-04-06 10:31:02 (aka 102.00 UTC Epoch) -- half writ")
+        self.archive.index()
+        self.assertEqual([row[1] for row in self.events()], ["INFO", "ERROR"])
+        self.append(b"ten\r\n" + b"--- " + event(103.0, "CRITICAL ERROR: GUI update ---").rstrip() + b"\r\ntraceback line\r\n")
+        self.archive.index()
+        self.assertEqual([(row[0], row[1]) for row in self.events()], [(100.0, "INFO"), (101.0, "ERROR"), (102.0, "INFO"), (103.0, "CRITICAL")])
+        self.assertEqual(self.events()[2][2], "half written")
+        self.archive.index()
+        self.assertEqual(len(self.events()), 4)                     #Nothing read twice
+
+    def test_events_not_utf8(self):                                 #A stray byte from the link can end up in a logged message
+        self.append(event(100.0, "Payload location:").rstrip() + b" \xff\xfe\r\n" + event(101.0, "Finished"))
+        self.archive.index()
+        self.assertEqual(len(self.events()), 2)
+        self.assertTrue(self.events()[0][2].startswith("Payload location:"))
+
+    def test_rotated_log(self):                                     #The live file starts over smaller than where the last run stopped
+        self.append(event(100.0, "one") + event(101.0, "two"))
+        self.archive.index()
+        os.remove(self.log)
+        self.append(event(102.0, "three"))
+        self.archive.index()
+        self.assertEqual([row[2] for row in self.events()], ["one", "two", "three"])
+
+    def test_fixes_and_images(self):                                #Images are placed at the fix received closest to their mtime
+        self.add_fixes([(1000.0, 500.0), (1010.0, 600.0)])
+        self.archive.index()
+        self.add_fixes([(1020.0, 700.0)])
+        image = os.path.join(self.directory, "image00001b.png")
+        with open(image, "wb") as fl:
+            fl.write(b"png")
+        os.utime(image, (1018.0, 1018.0))
+        with open(image + ".journal", "wb") as fl:                  #Not an image, never cataloged
+            fl.write(b"journal")
+        self.archive.index()
+        self.assertEqual(self.archive.db.execute("SELECT count(*) FROM fixes").fetchone()[0], 3)
+        self.assertEqual(self.archive.db.execute("SELECT name, alt FROM images").fetchall(), [("image00001b.png", 700.0)])
+        self.assertEqual(self.archive.last_session(), SESSION)
+
+if __name__ == "__main__":
+    unittest.main()